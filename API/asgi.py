@@ -0,0 +1,381 @@
+"""
+This is the async (ASGI) entry point of our API, for serving many
+long-lived chat connections from one process. It is what the Procfile's
+web process serves:
+    uvicorn API.asgi:app
+It serves the same routes as API/endpoints.py. The chat-heavy ones (room
+lookups, joining by code, messages and event streams) are handled here
+with awaited database calls, so a waiting client holds no thread. Every
+other route is passed to the Flask app on a worker thread.
+"""
+
+import asyncio
+import json
+import re
+import time
+from urllib.parse import parse_qs
+
+import werkzeug.exceptions as wz
+from werkzeug.http import parse_etags, quote_etag
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+import API.endpoints as ep
+import API.metrics as metrics
+import db.async_data as adata
+import db.data as db
+from db import codec, events
+
+JSON = b'application/json'
+
+routes = []
+
+
+class NotModified(Exception):
+    """
+    Raised by a handler when the client already holds the current
+    version of what it asked for.
+    """
+
+
+def route(method, pattern):
+    """
+    Registers an async handler for requests matching pattern; its groups
+    are passed to the handler after the request.
+    """
+    def register(handler):
+        routes.append((method, re.compile(pattern + "$"), handler))
+        return handler
+    return register
+
+
+class Request:
+    """
+    What our handlers need to know about an ASGI request.
+    """
+    def __init__(self, scope, receive, body):
+        self.scope = scope
+        self.receive = receive
+        self.body = body
+        self.args = {key: values[-1] for key, values in
+                     parse_qs(scope.get("query_string", b"").decode())
+                     .items()}
+        self.headers = {key.decode("latin-1").lower():
+                        value.decode("latin-1")
+                        for key, value in scope.get("headers", [])}
+        # the listing the response is, and its version, sent as its ETag:
+        self.version_key = None
+        self.version = None
+        self.since = None
+
+    def holds_version(self):
+        return parse_etags(self.headers.get("if-none-match")).contains_weak(
+            self.version)
+
+    def check_version(self, key):
+        """
+        Looks up the version of the listing key we last read, like
+        listing_response in API/endpoints.py, raising NotModified if the
+        client has it.
+        """
+        self.version_key = key
+        self.version = db.get_version(key)
+        if self.version is not None and self.holds_version():
+            raise NotModified()
+        self.since = db.last_write
+
+    def check_body(self, data):
+        """
+        Works out the version of the listing from its encoded body,
+        raising NotModified if the client has it.
+        """
+        self.version = db.set_version(self.version_key, data, self.since)
+        if self.holds_version():
+            raise NotModified()
+
+    def json(self):
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError:
+            raise (wz.BadRequest("Invalid JSON body."))
+
+    def int_arg(self, name, default):
+        value = self.args.get(name)
+        if not value:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise (wz.BadRequest(f"Invalid {name} {value}."))
+
+
+def etag_header(version):
+    # weak, like the ETags of the Flask app's listings:
+    return (b"etag", quote_etag(version, weak=True).encode())
+
+
+def encode(body):
+    return codec.dumps(body) + b"\n"
+
+
+async def send_json(send, status, body, headers = ()):
+    await send_data(send, status, encode(body), headers)
+
+
+async def send_data(send, status, data, headers = ()):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", JSON),
+                            (b"content-length", str(len(data)).encode()),
+                            *headers]})
+    await send({"type": "http.response.body", "body": data})
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+@route("GET", r"/hello")
+async def hello(request):
+    return {ep.HELLO: ep.WORLD}
+
+
+@route("GET", r"/rooms/([^/]+)/id")
+async def room_id(request, roomname):
+    code = await adata.get_room_code(roomname)
+    if code is None:
+        raise (wz.NotFound(f"Room {roomname} not found."))
+    return code
+
+
+@route("GET", r"/users/list/([^/]+)")
+async def list_users_room(request, roomname):
+    request.check_version((db.USERS_LIST, roomname))
+    users = await adata.get_users_room(roomname)
+    if users is None:
+        raise (wz.NotFound(f"Chat room {roomname} not found."))
+    return users
+
+
+@route("POST", r"/rooms/join/(?!random/|preset/|interests/)([^/]+)/([^/]+)")
+async def join_room_code(request, roomcode, username):
+    ret = await adata.join_room_code(roomcode, username)
+    if ret == db.NOT_ACCEPTABLE:
+        raise (wz.NotAcceptable(f"No chat room exists w/ ID {roomcode}."))
+    elif ret == db.ROOM_FULL:
+        raise (wz.Conflict(f"Chat room {roomcode} is full."))
+    return f"{username} has joined room {roomcode}."
+
+
+@route("POST", r"/rooms/([^/]+)/messages/([^/]+)")
+async def send_messages(request, roomcode, username):
+    payload = request.json()
+    texts = payload.get('texts') if isinstance(payload, dict) else None
+    if (not isinstance(texts, list)
+            or not all(isinstance(text, str) for text in texts)):
+        raise (wz.BadRequest("Input payload validation failed"))
+    ret = await adata.add_messages(roomcode, username, texts)
+    if ret == db.NOT_FOUND:
+        raise (wz.NotFound(f"No chat room exists w/ ID {roomcode}."))
+    elif ret == db.NOT_ACCEPTABLE:
+        raise (wz.NotAcceptable(f"{username} is not in room {roomcode}."))
+    return {ep.SEQS: ret}
+
+
+@route("GET", r"/rooms/([^/]+)/messages")
+async def list_messages(request, roomcode):
+    after = request.int_arg('after', 0)
+    messages = await adata.get_messages(roomcode, after,
+                                        request.int_arg('limit',
+                                                        db.MESSAGE_LIMIT))
+    if messages is None:
+        raise (wz.NotFound(f"No chat room exists w/ ID {roomcode}."))
+    last = messages[-1][db.SEQ] if messages else after
+    return {ep.ITEMS: messages, ep.NEXT: last}
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+@route("GET", r"/rooms/([^/]+)/events")
+async def room_events(request, roomcode, send):
+    """
+    Streams a room's events like RoomEvents in API/endpoints.py, waiting
+    on the event loop instead of a thread.
+    """
+    room = await adata.get_room_by_code(roomcode, {db.ID: 1})
+    if room is None:
+        raise (wz.NotFound(f"No chat room exists w/ ID {roomcode}."))
+    after = request.int_arg('after', None)
+    if after is None and request.headers.get('last-event-id'):
+        try:
+            after = int(request.headers['last-event-id'])
+        except ValueError:
+            raise (wz.BadRequest("Invalid Last-Event-ID."))
+    # subscribe before reading the backlog, so nothing falls between.
+    sub = events.subscribe_async(room[db.ID])
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request.receive))
+    try:
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type",
+                                 ep.EVENT_STREAM.encode()),
+                                (b"cache-control", b"no-cache"),
+                                (b"x-accel-buffering", b"no")]})
+
+        async def push(text):
+            await send({"type": "http.response.body",
+                        "body": text.encode(), "more_body": True})
+
+        async def push_all(ready):
+            for event in ready:
+                await push(ep.sse(event, event[events.DATA][db.SEQ]))
+
+        async def read_log(after):
+            """
+            Returns all of the room's messages after sequence number
+            after, read a page at a time.
+            """
+            messages = []
+            while True:
+                page = await adata.get_messages(roomcode, after,
+                                                db.MAX_MESSAGE_LIMIT) or []
+                messages += page
+                if len(page) < db.MAX_MESSAGE_LIMIT:
+                    return messages
+                after = page[-1][db.SEQ]
+
+        # as in event_stream in API/endpoints.py, messages that arrive
+        # ahead of a gap are held until it is filled from the log:
+        order = ep.MessageOrder(after)
+        if after is not None:
+            await push_all(order.fill(await read_log(after)))
+        while not sub.dropped and not disconnected.done():
+            getter = asyncio.ensure_future(sub.get())
+            done, _ = await asyncio.wait({getter, disconnected},
+                                         timeout=ep.GAP_WAIT_SECS
+                                         if order.held else ep.HEARTBEAT_SECS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if getter not in done:
+                getter.cancel()
+                if disconnected.done():
+                    continue
+                if order.held:
+                    await push_all(order.fill(await read_log(order.after)))
+                    continue
+                # like room_gone in API/endpoints.py:
+                if await adata.get_room_by_code(roomcode, {db.ID: 1}) is None:
+                    db.forget_room(roomcode)
+                    await push(ep.sse(ep.CLOSED_EVENT))
+                    break
+                await push(": keep-alive\n\n")
+                continue
+            event = getter.result()
+            if event[events.TYPE] == events.MESSAGE:
+                await push_all(order.add(event))
+                if order.held:
+                    await push_all(order.fill(await read_log(order.after)))
+                continue
+            if event[events.TYPE] == events.CLOSED:
+                await push_all(order.rest())
+                await push(ep.sse(event))
+                break
+            await push(ep.sse(event))
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnected.cancel()
+        events.unsubscribe(sub)
+
+
+# handlers that send their own (streamed) response:
+streaming = {room_events}
+
+
+def call_flask(scope, body):
+    """
+    Serves a request with the Flask app; run on a worker thread.
+    """
+    headers = [(key.decode("latin-1"), value.decode("latin-1"))
+               for key, value in scope.get("headers", [])]
+    environ = EnvironBuilder(path=scope["path"], method=scope["method"],
+                             query_string=scope.get("query_string", b"")
+                             .decode(),
+                             headers=headers, data=body).get_environ()
+    app_iter, status, resp_headers = run_wsgi_app(ep.app, environ)
+    try:
+        data = b"".join(app_iter)
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+    return int(status.split()[0]), resp_headers, data
+
+
+async def fallback(scope, receive, send):
+    """
+    Passes a request we have no async handler for to the Flask app.
+    """
+    body = await read_body(receive)
+    status, headers, data = await asyncio.to_thread(call_flask, scope, body)
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(key.lower().encode("latin-1"),
+                             value.encode("latin-1"))
+                            for key, value in headers.items()]})
+    await send({"type": "http.response.body", "body": data})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            # connects, builds our indexes and loads the name corpus.
+            await asyncio.to_thread(ep.start_worker)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    The ASGI application.
+    """
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    for method, pattern, handler in routes:
+        match = pattern.match(scope["path"])
+        if match is None or scope["method"] != method:
+            continue
+        started = time.perf_counter()
+        status = 200
+        try:
+            if handler in streaming:
+                # the body is left unread: receive is watched for the
+                # client going away instead.
+                request = Request(scope, receive, b"")
+                await handler(request, *match.groups(), send)
+            else:
+                request = Request(scope, receive, await read_body(receive))
+                data = encode(await handler(request, *match.groups()))
+                headers = []
+                if request.version_key is not None:
+                    request.check_body(data)
+                    headers.append(etag_header(request.version))
+                await send_data(send, status, data, headers)
+        except NotModified:
+            status = 304
+            await send({"type": "http.response.start", "status": status,
+                        "headers": [etag_header(request.version)]})
+            await send({"type": "http.response.body", "body": b""})
+        except wz.HTTPException as err:
+            status = err.code
+            await send_json(send, status, {"message": err.description})
+        metrics.observe_request(handler.__name__, method, status,
+                                time.perf_counter() - started)
+        return
+    await fallback(scope, receive, send)
@@ -0,0 +1,289 @@
+"""
+This file benchmarks our endpoints.
+It seeds a database with a given number of rooms and users, drives each
+resource through Flask's test client, and reports latency percentiles,
+throughput and database round-trips per request.
+Results are saved as JSON so runs can be compared across commits:
+    python3 API/benchmark.py --rooms 100 10000 --output new.json
+    python3 API/benchmark.py --compare old.json new.json
+The in-memory backend is used unless --backend mongo is given, in which
+case MONGO_URI/MONGO_DB pick the database. Its rooms and users
+collections are wiped before seeding, so MONGO_URI must point at a
+server on this machine!
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+DEF_ROOM_COUNTS = [100]
+DEF_REQUESTS = 200
+USERS_PER_ROOM = 5
+INTERESTS = ["Reading", "Music", "Sports", "Gaming", "Movies", "Travel",
+             "Cooking", "Art", "Science", "Coding", "Hiking", "Dance"]
+PERCENTILES = (50, 95, 99)
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+
+class CountingBackend:
+    """
+    Wraps a storage backend and counts the operations made through it.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+def percentile(samples, pct):
+    """
+    Returns the pct-th percentile of samples (nearest-rank method).
+    """
+    ordered = sorted(samples)
+    rank = max(1, -(-pct * len(ordered) // 100))
+    return ordered[int(rank) - 1]
+
+
+def local_uri(uri):
+    """
+    Checks whether uri is a plain connection string whose servers are
+    all on this machine.
+    """
+    from pymongo import uri_parser
+    if not uri.startswith("mongodb://"):
+        return False
+    try:
+        nodes = uri_parser.parse_uri(uri)["nodelist"]
+    except Exception:
+        return False
+    return all(host in LOCAL_HOSTS for host, port in nodes)
+
+
+def seed(db, db_connect, num_rooms, users_per_room=USERS_PER_ROOM):
+    """
+    Replaces the rooms and users collections with num_rooms rooms, each
+    holding a few users and interests.
+    Raises ValueError rather than wipe a database that isn't local.
+    Returns the names of the seeded rooms.
+    """
+    if (db_connect.backend_nm != db_connect.MEMORY
+            and not local_uri(db_connect.mongo_uri)):
+        raise ValueError("Benchmarks only seed a local MONGO_URI.")
+    db_connect.delete_docs(db.ROOMS)
+    db_connect.delete_docs(db.USERS)
+    names = [f"bench room {i}" for i in range(num_rooms)]
+    rooms = []
+    users = []
+    for i, name in enumerate(names):
+        members = [f"bench user {i}-{j}" for j in range(users_per_room)]
+        rooms.append({
+            db.ROOM_NM: name,
+            db.NUM_USERS: len(members),
+            db.USERS_LIST: members,
+            db.COMMON_INTERESTS: random.sample(INTERESTS, 3),
+            db.LAST_ACTIVITY: db.now(),
+        })
+        users.extend({db.USER_NM: user} for user in members)
+    db_connect.insert_docs(db.ROOMS, rooms)
+    db_connect.insert_docs(db.USERS, users)
+    db.room_changed()
+    return names
+
+
+def scenarios(db, rooms):
+    """
+    Returns (resource name, HTTP method, URL maker) for each resource we
+    benchmark. URL makers are called with the request number.
+    """
+    def room(i):
+        return rooms[i % len(rooms)]
+
+    def code(i):
+        return db.get_room_code(room(i))
+
+    return [
+        ("HelloWorld", "get", lambda i: "/hello"),
+        ("ListRooms", "get", lambda i: "/rooms/list"),
+        ("ListRoomsPage", "get", lambda i: "/rooms/list?limit=100"),
+        ("ListUsers", "get", lambda i: "/users/list?limit=100"),
+        ("RoomID", "get", lambda i: f"/rooms/{room(i)}/id"),
+        ("ListUsersRoom", "get", lambda i: f"/users/list/{room(i)}"),
+        ("CreateRoom", "post", lambda i: f"/rooms/create/new bench {i}"),
+        ("CreateUser", "post", lambda i: f"/users/create/new bench {i}"),
+        ("JoinRandomRoom", "post",
+         lambda i: f"/rooms/join/random/random joiner {i}"),
+        ("JoinPresetRoom", "post",
+         lambda i: f"/rooms/join/preset/preset joiner {i}"),
+        ("JoinRoomCode", "post",
+         lambda i: f"/rooms/join/{code(i)}/code joiner {i}"),
+        ("JoinRoomInterests", "post",
+         lambda i: (f"/rooms/join/interests/interest joiner {i}"
+                    + f"?interests={random.choice(INTERESTS)}")),
+        ("RemoveUserFromRoom", "put",
+         lambda i: f"/users/remove/bench user {i % len(rooms)}-0/{room(i)}"),
+    ]
+
+
+def run_scenario(client, counter, method, make_url, num_requests):
+    """
+    Sends num_requests requests and returns their statistics.
+    URLs are built before the clock starts.
+    """
+    urls = [make_url(i) for i in range(num_requests)]
+    latencies = []
+    statuses = {}
+    start_calls = counter.calls
+    start = time.perf_counter()
+    for url in urls:
+        before = time.perf_counter()
+        resp = getattr(client, method)(url)
+        resp.get_data()
+        latencies.append((time.perf_counter() - before) * 1000)
+        statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+    elapsed = time.perf_counter() - start
+    stats = {f"p{pct}_ms": round(percentile(latencies, pct), 3)
+             for pct in PERCENTILES}
+    stats.update({
+        "requests": num_requests,
+        "mean_ms": round(sum(latencies) / num_requests, 3),
+        "throughput_rps": round(num_requests / elapsed, 1),
+        "db_ops_per_request": round((counter.calls - start_calls)
+                                    / num_requests, 2),
+        "statuses": {str(code): count for code, count in statuses.items()},
+    })
+    return stats
+
+
+def run_benchmark(room_counts=DEF_ROOM_COUNTS, num_requests=DEF_REQUESTS,
+                  only=None):
+    """
+    Benchmarks every resource (or the ones named in only) at each room
+    count, and returns the results.
+    """
+    import API.endpoints as ep
+    import db.data as db
+    import db.db_connect as db_connect
+
+    counter = CountingBackend(db_connect.get_backend())
+    db_connect.backend = counter
+    client = ep.app.test_client()
+    results = {}
+    try:
+        for num_rooms in room_counts:
+            rooms = seed(db, db_connect, num_rooms)
+            results[str(num_rooms)] = {
+                name: run_scenario(client, counter, method, make_url,
+                                   num_requests)
+                for name, method, make_url in scenarios(db, rooms)
+                if only is None or name in only
+            }
+    finally:
+        db_connect.backend = counter.backend
+    return results
+
+
+def git_commit():
+    """
+    Returns the commit we are benchmarking, if we are in a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    """
+    Prints how p50 and p99 latency changed between two saved runs.
+    """
+    with open(old_path) as file:
+        old = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+    print(f"{old['commit']} -> {new['commit']}")
+    for num_rooms, resources in new["results"].items():
+        for name, stats in resources.items():
+            before = old["results"].get(num_rooms, {}).get(name)
+            if before is None:
+                continue
+            changes = []
+            for key in ("p50_ms", "p99_ms"):
+                ratio = stats[key] / before[key] if before[key] else 0
+                changes.append(f"{key} {before[key]} -> {stats[key]}"
+                               + f" (x{ratio:.2f})")
+            print(f"{num_rooms:>7} rooms {name:<20} " + ", ".join(changes))
+
+
+def print_results(results):
+    for num_rooms, resources in results.items():
+        print(f"--- {num_rooms} rooms ---")
+        for name, stats in resources.items():
+            print(f"{name:<20} p50 {stats['p50_ms']:>8}ms"
+                  + f"  p95 {stats['p95_ms']:>8}ms"
+                  + f"  p99 {stats['p99_ms']:>8}ms"
+                  + f"  {stats['throughput_rps']:>8} req/s"
+                  + f"  {stats['db_ops_per_request']:>6} db ops")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, nargs="+",
+                        default=DEF_ROOM_COUNTS,
+                        help="room counts to benchmark, e.g. 100 10000")
+    parser.add_argument("--requests", type=int, default=DEF_REQUESTS,
+                        help="requests per resource")
+    parser.add_argument("--only", nargs="+",
+                        help="resource names to benchmark")
+    parser.add_argument("--backend", choices=("memory", "mongo"),
+                        default="memory")
+    parser.add_argument("--output", help="where to save the JSON results")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two saved runs instead")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.backend == "mongo" and not local_uri(
+            os.environ.get("MONGO_URI", "")):
+        parser.error("--backend mongo wipes its database: set MONGO_URI"
+                     + " to a local server, e.g. mongodb://localhost:27017")
+    # has to be set before db_connect is imported:
+    os.environ["DB_BACKEND"] = args.backend
+    results = run_benchmark(args.rooms, args.requests, args.only)
+    print_results(results)
+    report = {
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "backend": args.backend,
+        "requests_per_resource": args.requests,
+        "results": results,
+    }
+    output = args.output or f"benchmark-{report['commit'] or 'local'}.json"
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    main()
@@ -4,22 +4,309 @@ The endpoint called `endpoints` will return all available endpoints.
 """
 
 from http import HTTPStatus
-from flask import Flask
+import gzip
+import os
+import threading
+import time
+from flask import Flask, Response, g, has_request_context, request
+from flask import make_response
+from flask import stream_with_context
 from flask_cors import CORS
 from flask_restx import Resource, Api, fields, reqparse
 import werkzeug.exceptions as wz
+import bson.json_util as bsutil
 import db.data as db
+import db.db_connect as db_connect
+from db import broker, codec, events, trace
+from db.cache import TTLCache
+import API.metrics as metrics
 import random
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 CORS(app)
 api = Api(app)
 
+# DB_TRACE=1 reports the database work behind each request:
+app.config["DB_TRACE"] = os.environ.get("DB_TRACE", "") == "1"
+DB_OPS_HEADER = 'X-DB-Ops'
+DB_DOCS_HEADER = 'X-DB-Docs'
+DB_TIME_HEADER = 'X-DB-Time-Ms'
+
+trace.listeners.append(metrics.observe_db_op)
+metrics.registry.gauge(
+    "crow_db_pool_connections", "Open and checked-out Mongo connections.",
+    ("state",),
+    lambda: [(("open",), db_connect.pool_monitor.open),
+             (("checked_out",), db_connect.pool_monitor.checked_out)])
+metrics.registry.gauge(
+    "crow_db_pool_check_out_failures_total",
+    "Times a Mongo connection could not be checked out.", (),
+    lambda: [((), db_connect.pool_monitor.check_out_failures)], "counter")
+metrics.registry.gauge(
+    "crow_cache_lookups_total", "Room cache lookups by result.",
+    ("cache", "result"),
+    lambda: [(("rooms", "hit"), db.room_cache.hits),
+             (("rooms", "miss"), db.room_cache.misses)], "counter")
+metrics.registry.gauge(
+    "crow_cache_entries", "Entries held in the room cache.", ("cache",),
+    lambda: [(("rooms",), len(db.room_cache))])
+metrics.registry.gauge(
+    "crow_event_subscribers", "Open room event streams.", (),
+    lambda: [((), events.num_subscribers())])
+metrics.registry.gauge(
+    "crow_broker_events_total", "Events passed between workers.",
+    ("direction",),
+    lambda: [] if broker.broker is None else [
+        (("sent",), broker.broker.sent),
+        (("received",), broker.broker.received),
+        (("dropped",), broker.broker.dropped)], "counter")
+
 HELLO = 'Hello'
 WORLD = 'World'
+READY = 'ready'
+HELLO_PATH = '/hello'
+READY_PATH = '/ready'
+
+# the process start_worker last ran in:
+started_pid = None
+start_lock = threading.Lock()
+
+ITEMS = 'items'
+NEXT = 'next'
+NDJSON = 'application/x-ndjson'
+SEQS = 'seqs'
+ROOM = 'room'
+USER = 'user'
+ADDED = 'added'
+DUPLICATES = 'duplicates'
+# the most names one bulk request may create:
+MAX_BULK = int(os.environ.get("MAX_BULK", 1000))
+EVENT_STREAM = 'text/event-stream'
+JSON = 'application/json'
+# listings at least this many bytes long are compressed, if the client
+# accepts it:
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# the compressions we offer, preferred first:
+COMPRESSORS = {'gzip': lambda data: gzip.compress(data, GZIP_LEVEL)}
+if brotli is not None:
+    COMPRESSORS = {'br': lambda data: brotli.compress(data,
+                                                      quality=BROTLI_QUALITY),
+                   **COMPRESSORS}
+# encoded listings, by version (and compression); see listing_response.
+body_cache = TTLCache(db.ROOM_CACHE_SIZE, db.ROOM_CACHE_TTL)
+# what a stream sends when its room has closed:
+CLOSED_EVENT = {events.TYPE: events.CLOSED, events.DATA: None}
+# how often, in seconds, an idle event stream sends a keep-alive, and
+# checks that its room is still there:
+HEARTBEAT_SECS = float(os.environ.get("EVENT_HEARTBEAT_SECS", 15))
+# how long, in seconds, a stream holding messages that arrived ahead of a
+# gap waits before looking for the missing ones in the log again:
+GAP_WAIT_SECS = float(os.environ.get("EVENT_GAP_WAIT_SECS", 1))
+
+list_parser = reqparse.RequestParser()
+list_parser.add_argument('after', type=str,
+                         help='Return entries after this id.')
+list_parser.add_argument('limit', type=int,
+                         help='Return at most this many entries.')
+list_parser.add_argument('format', type=str, choices=('json', 'ndjson'),
+                         help='Use ndjson to stream one entry per line.')
+
+
+def start_worker():
+    """
+    Gets this worker ready to serve: see db.start. It also joins the
+    event broker, which passes room events on to the other workers if
+    EVENT_BROKER_DIR is set.
+    API/asgi.py runs this when a worker starts up, as gunicorn.conf.py
+    does when one is forked; otherwise it runs on the first request that
+    needs it. It does its work once
+    per process.
+    """
+    global started_pid
+    if started_pid == os.getpid():
+        return
+    with start_lock:
+        if started_pid != os.getpid():
+            db.start()
+            broker.start()
+            started_pid = os.getpid()
+
+
+@app.before_request
+def start_lazily():
+    """
+    Starts a worker that wasn't started when it was forked. Liveness
+    checks are answered without it.
+    """
+    if request.path != HELLO_PATH:
+        start_worker()
+
+
+@app.before_request
+def start_db_trace():
+    """
+    Starts timing this request and recording its database operations.
+    """
+    g.request_started = time.perf_counter()
+    if app.config["DB_TRACE"]:
+        g.db_trace = trace.start()
+
+
+@app.after_request
+def report_db_trace(response):
+    """
+    Records this request in our metrics, and adds the database work it
+    did to the response headers and the log.
+    """
+    started = g.pop("request_started", None)
+    if started is not None:
+        metrics.observe_request(request.endpoint or "unknown",
+                                request.method, response.status_code,
+                                time.perf_counter() - started)
+    db_trace = g.pop("db_trace", None)
+    if db_trace is not None:
+        trace.stop(db_trace)
+        response.headers[DB_OPS_HEADER] = str(db_trace.num_ops)
+        response.headers[DB_DOCS_HEADER] = str(db_trace.num_docs)
+        response.headers[DB_TIME_HEADER] = f"{db_trace.duration_ms:.2f}"
+        app.logger.info(f"{request.method} {request.path}:"
+                        + f" {db_trace.num_ops} db ops,"
+                        + f" {db_trace.num_docs} docs\n"
+                        + db_trace.describe())
+    return response
+
+
+@api.representation(JSON)
+def output_json(data, code, headers = None):
+    """
+    Encodes what our resources return with our fast JSON encoder.
+    """
+    response = make_response(codec.dumps(data) + b"\n", code)
+    response.headers.extend(headers or {})
+    return response
+
+
+def accepted_encoding():
+    """
+    Returns the compression the client prefers among the ones we have,
+    or None.
+    """
+    return request.accept_encodings.best_match(list(COMPRESSORS))
+
+
+def not_modified(version):
+    """
+    Returns a 304 for a client that holds version, or None.
+    """
+    if not request.if_none_match.contains_weak(version):
+        return None
+    response = Response(status=HTTPStatus.NOT_MODIFIED)
+    response.set_etag(version, weak=True)
+    return response
+
+
+def listing_response(key, fetch, missing):
+    """
+    Serves the full listing key (see db.get_version), read with fetch.
+    The response carries the listing's version, a digest of its body, as
+    its ETag, so every worker gives the same listing the same ETag:
+    - a client that holds the version we last read gets a 304, and the
+      listing isn't read at all;
+    - otherwise the listing is read (unless we still have its body) and
+      a client that holds its version still gets a 304;
+    - the body is compressed, once per version, if it is large and the
+      client accepts it.
+    Called outside a request (e.g. from our tests), it just returns the
+    listing.
+    Raises NotFound with the message missing if fetch returns None.
+    """
+    if not has_request_context():
+        docs = fetch()
+        if docs is None:
+            raise (wz.NotFound(missing))
+        return docs
+    version = db.get_version(key)
+    plain = None
+    if version is not None:
+        response = not_modified(version)
+        if response is not None:
+            return response
+        plain = body_cache.get(version)
+    if plain is None:
+        since = db.last_write
+        docs = fetch()
+        if docs is None:
+            raise (wz.NotFound(missing))
+        plain = codec.dumps(docs) + b"\n"
+        version = db.set_version(key, plain, since)
+        body_cache.set(version, plain)
+        response = not_modified(version)
+        if response is not None:
+            return response
+    encoding = None
+    body = plain
+    if len(plain) >= COMPRESS_MIN_BYTES:
+        encoding = accepted_encoding()
+    if encoding is not None:
+        body = body_cache.get((version, encoding))
+        if body is None:
+            body = COMPRESSORS[encoding](plain)
+            body_cache.set((version, encoding), body)
+    response = Response(body, mimetype=JSON)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # weak, as the same version may be sent compressed or not:
+    response.set_etag(version, weak=True)
+    return response
+
+
+def list_args():
+    """
+    Parses the listing arguments of the current request.
+    Resources can also be called directly (e.g. from our tests), in which
+    case every argument is left unset.
+    """
+    if not has_request_context():
+        return {arg.name: None for arg in list_parser.args}
+    return list_parser.parse_args()
+
+
+def wants_ndjson(args):
+    """
+    Checks whether the client asked for a streamed NDJSON listing.
+    """
+    return (args["format"] == 'ndjson'
+            or (has_request_context()
+                and request.accept_mimetypes.best == NDJSON))
+
 
+def ndjson_response(docs):
+    """
+    Streams docs to the client as newline-delimited JSON.
+    """
+    lines = (codec.dumps(doc) + b"\n" for doc in docs)
+    return Response(stream_with_context(lines), mimetype=NDJSON)
+
+
+def page_response(page, name):
+    """
+    Wraps a page of entries with the cursor for the next page.
+    """
+    if page is None:
+        raise (wz.BadRequest(f"Invalid {name} cursor."))
+    next_id = str(page[-1][db.ID]) if page else None
+    return {ITEMS: page, NEXT: next_id}
 
-@api.route('/hello')
+
+@api.route(HELLO_PATH)
 class HelloWorld(Resource):
     """
     The purpose of the HelloWorld class is to have a simple test to see if the
@@ -34,22 +321,50 @@ class HelloWorld(Resource):
         return {HELLO: WORLD}
 
 
+@api.route(READY_PATH)
+class Ready(Resource):
+    """
+    This endpoint tells whether this worker is ready to serve requests,
+    where /hello only tells whether it is running.
+    """
+    @api.response(HTTPStatus.OK, 'Ready')
+    @api.response(HTTPStatus.SERVICE_UNAVAILABLE, 'Not ready')
+    def get(self):
+        """
+        Answers once the worker is connected and has loaded the name
+        corpus, starting it if it hasn't been.
+        """
+        try:
+            start_worker()
+        except Exception as err:
+            raise (wz.ServiceUnavailable(f"Not ready: {err}"))
+        return {READY: True}
+
+
 @api.route('/users/list')
 class ListUsers(Resource):
     """
     This endpoint returns a list of all users.
     """
+    @api.doc(parser = list_parser)
     @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid cursor')
     @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
     def get(self):
         """
         Returns a list of all users.
+        Pass `after` and/or `limit` to page through users, or
+        `format=ndjson` to stream them.
         """
-        users = db.get_users()
-        if users is None:
-            raise (wz.NotFound("User db not found."))
-        else:
-            return users
+        args = list_args()
+        if wants_ndjson(args):
+            return ndjson_response(db.iter_users())
+        if args["after"] or args["limit"]:
+            page = db.get_users_page(args["after"],
+                                     args["limit"] or db.PAGE_SIZE)
+            return page_response(page, "user")
+        return listing_response(db.USERS, db.get_users,
+                                "User db not found.")
 
 
 @api.route('/rooms/<roomname>/id')
@@ -81,11 +396,9 @@ class ListUsersRoom(Resource):
         """
         Returns a list of all users for a specific room.
         """
-        users = db.get_users_room(roomname)
-        if users is None:
-            raise (wz.NotFound(f"Chat room {roomname} not found."))
-        else:
-            return users
+        return listing_response((db.USERS_LIST, roomname),
+                                lambda: db.get_users_room(roomname),
+                                f"Chat room {roomname} not found.")
 
 
 @api.route('/rooms/list')
@@ -93,17 +406,25 @@ class ListRooms(Resource):
     """
     This endpoint returns a list of all rooms.
     """
+    @api.doc(parser = list_parser)
     @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid cursor')
     @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
     def get(self):
         """
         Returns a list of all chat rooms.
+        Pass `after` and/or `limit` to page through rooms, or
+        `format=ndjson` to stream them.
         """
-        rooms = db.get_rooms()
-        if rooms is None:
-            raise (wz.NotFound("Chat room db not found."))
-        else:
-            return rooms
+        args = list_args()
+        if wants_ndjson(args):
+            return ndjson_response(db.iter_rooms())
+        if args["after"] or args["limit"]:
+            page = db.get_rooms_page(args["after"],
+                                     args["limit"] or db.PAGE_SIZE)
+            return page_response(page, "room")
+        return listing_response(db.ROOMS, db.get_rooms,
+                                "Chat room db not found.")
 
 
 @api.route('/rooms/create/<roomname>')
@@ -127,6 +448,65 @@ class CreateRoom(Resource):
             return f"{roomname} added."
 
 
+names_model = api.model('Names', {
+    'names': fields.List(fields.String, required=True,
+                         description='The names to create.'),
+})
+
+
+def bulk_response(results):
+    """
+    Splits the results of a bulk create into the names added and the
+    duplicates that were skipped.
+    """
+    return {ADDED: [name for name, ret in results.items() if ret == db.OK],
+            DUPLICATES: [name for name, ret in results.items()
+                         if ret == db.DUPLICATE]}
+
+
+def bulk_names():
+    """
+    Returns the names in a bulk create's payload, refusing more than
+    MAX_BULK at once.
+    """
+    names = api.payload['names']
+    if len(names) > MAX_BULK:
+        raise (wz.BadRequest(f"At most {MAX_BULK} names per request."))
+    return names
+
+
+@api.route('/rooms/create')
+class CreateRooms(Resource):
+    """
+    This class supports adding many chat rooms at once.
+    """
+    @api.expect(names_model, validate=True)
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Too many names')
+    def post(self):
+        """
+        This method adds rooms to the room db with one bulk insert, and
+        reports which names already existed.
+        """
+        return bulk_response(db.add_rooms(bulk_names()))
+
+
+@api.route('/users/create')
+class CreateUsers(Resource):
+    """
+    This class supports adding many users at once.
+    """
+    @api.expect(names_model, validate=True)
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Too many names')
+    def post(self):
+        """
+        This method adds users to the users db with one bulk insert, and
+        reports which names were already taken.
+        """
+        return bulk_response(db.add_users(bulk_names()))
+
+
 @api.route('/users/create/<username>')
 class CreateUser(Resource):
     """
@@ -227,6 +607,21 @@ class JoinPresetRoom(Resource):
             return f"{username} has joined room {ret}."
 
 
+@api.route('/rooms/join/anonymous')
+class JoinAnonymousRoom(Resource):
+    """
+    This class supports joining a chat room under a generated name.
+    """
+    @api.response(HTTPStatus.OK, 'Success')
+    def post(self):
+        """
+        This method places a newcomer in an open chat room and gives them
+        a name nobody else in the room is using.
+        """
+        roomname, username = db.join_anonymous_room()
+        return {ROOM: roomname, USER: username}
+
+
 @api.route('/rooms/join/<roomcode>/<username>')
 class JoinRoomCode(Resource):
     """
@@ -235,6 +630,7 @@ class JoinRoomCode(Resource):
     @api.response(HTTPStatus.OK, 'Success')
     @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
     @api.response(HTTPStatus.NOT_ACCEPTABLE, 'No room with this code exists')
+    @api.response(HTTPStatus.CONFLICT, 'The chat room is full')
     def post(self, roomcode, username):
         """
         This method adds the user to a chat room using its room code.
@@ -244,6 +640,8 @@ class JoinRoomCode(Resource):
             raise (wz.NotFound(f"No chat rooms available"))
         elif ret == db.NOT_ACCEPTABLE:
             raise (wz.NotAcceptable(f"No chat room exists w/ ID {roomcode}."))
+        elif ret == db.ROOM_FULL:
+            raise (wz.Conflict(f"Chat room {roomcode} is full."))
         else:
             return f"{username} has joined room {roomcode}."
 
@@ -273,6 +671,273 @@ class JoinRoomInterests(Resource):
             return {f"{username} has joined room {ret}.": f"{ret}"}
 
 
+message_model = api.model('Messages', {
+    'texts': fields.List(fields.String, required=True,
+                         description='The messages to send, in order.'),
+})
+
+messages_parser = reqparse.RequestParser()
+messages_parser.add_argument('after', type=int, default=0,
+                             help='Return messages after this sequence'
+                             + ' number.')
+messages_parser.add_argument('limit', type=int, default=db.MESSAGE_LIMIT,
+                             help='Return at most this many messages.')
+
+
+@api.route('/rooms/<roomcode>/messages/<username>')
+class SendMessages(Resource):
+    """
+    This class supports sending messages to a chat room.
+    """
+    @api.expect(message_model, validate=True)
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
+    @api.response(HTTPStatus.NOT_ACCEPTABLE, 'The user is not in the room')
+    def post(self, roomcode, username):
+        """
+        This method appends a batch of messages to a chat room and returns
+        their sequence numbers.
+        """
+        ret = db.add_messages(roomcode, username, api.payload['texts'])
+        if ret == db.NOT_FOUND:
+            raise (wz.NotFound(f"No chat room exists w/ ID {roomcode}."))
+        elif ret == db.NOT_ACCEPTABLE:
+            raise (wz.NotAcceptable(f"{username} is not in room {roomcode}."))
+        else:
+            return {SEQS: ret}
+
+
+@api.route('/rooms/<roomcode>/messages')
+class ListMessages(Resource):
+    """
+    This class supports reading a chat room's messages.
+    """
+    @api.doc(parser = messages_parser)
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
+    def get(self, roomcode):
+        """
+        Returns a chat room's messages, oldest first.
+        Pass the `next` value of one response as `after` to get only the
+        messages sent since.
+        """
+        args = messages_parser.parse_args()
+        messages = db.get_messages(roomcode, args['after'], args['limit'])
+        if messages is None:
+            raise (wz.NotFound(f"No chat room exists w/ ID {roomcode}."))
+        last = messages[-1][db.SEQ] if messages else args['after']
+        return {ITEMS: messages, NEXT: last}
+
+
+def sse(event, event_id=None):
+    """
+    Formats one event for a text/event-stream response.
+    """
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return (head + f"event: {event[events.TYPE]}\n"
+            + f"data: {bsutil.dumps(event[events.DATA])}\n\n")
+
+
+def room_gone(roomcode):
+    """
+    Checks whether a room we stream has closed without telling us: rooms
+    closed by other processes (idle ones, by the clock process) send our
+    subscribers no event.
+    """
+    if db.get_room_by_code(roomcode, {db.ID: 1}) is not None:
+        return False
+    db.forget_room(roomcode)
+    return True
+
+
+class MessageOrder:
+    """
+    Puts a stream's message events in sequence order. after is the last
+    sequence number sent (None until the first message). A message that
+    arrives ahead of a gap is held, not sent, until the gap is filled by
+    a later event or from the log.
+    """
+    def __init__(self, after):
+        self.after = after
+        self.held = {}
+
+    def add(self, event):
+        """
+        Takes a live message event; returns the events that can be sent
+        now, in order.
+        """
+        seq = event[events.DATA][db.SEQ]
+        if self.after is None:
+            self.after = seq - 1
+        if seq > self.after:
+            self.held[seq] = event
+        return self.release()
+
+    def fill(self, messages):
+        """
+        Takes the room's messages after self.after, read from the log;
+        returns the events that can be sent now, in order.
+        The log stops at a gap still being written (see
+        db.written_messages), so any gap it skips is lost for good.
+        """
+        ready = []
+        for message in messages:
+            seq = message[db.SEQ]
+            if self.after is None or seq > self.after:
+                self.after = seq
+                ready.append(self.held.pop(seq, None)
+                             or {events.TYPE: events.MESSAGE,
+                                 events.DATA: message})
+        self.held = {seq: event for seq, event in self.held.items()
+                     if seq > self.after}
+        return ready + self.release()
+
+    def release(self):
+        ready = []
+        while self.held and self.after + 1 in self.held:
+            self.after += 1
+            ready.append(self.held.pop(self.after))
+        return ready
+
+    def rest(self):
+        """
+        Returns the held events, in order, when the stream ends.
+        """
+        ready = [self.held[seq] for seq in sorted(self.held)]
+        self.held = {}
+        return ready
+
+
+def messages_sse(ready):
+    """
+    Formats message events, each with its sequence number as its id.
+    """
+    for event in ready:
+        yield sse(event, event[events.DATA][db.SEQ])
+
+
+def event_stream(sub, roomcode, backlog, after):
+    """
+    Yields a room's missed messages, then its events as they happen,
+    until the room closes, the client goes away or falls too far behind.
+    backlog is the first page of missed messages; if it is a full page,
+    the rest are read from the log as they are sent. after is None if
+    nothing was missed; the first live message then sets where the
+    stream starts.
+    Message events can be lost on the way (a busy broker drops them) or
+    arrive out of order, so a gap in the sequence numbers is filled from
+    the log; see MessageOrder.
+    """
+    order = MessageOrder(after)
+    try:
+        yield from messages_sse(order.fill(backlog))
+        if len(backlog) == db.MAX_MESSAGE_LIMIT:
+            yield from messages_sse(
+                order.fill(db.iter_messages(roomcode, order.after)))
+        while not sub.dropped:
+            event = sub.get(timeout=GAP_WAIT_SECS if order.held
+                            else HEARTBEAT_SECS)
+            if event is None and order.held:
+                yield from messages_sse(
+                    order.fill(db.iter_messages(roomcode, order.after)))
+                continue
+            if event is None:
+                if room_gone(roomcode):
+                    yield sse(CLOSED_EVENT)
+                    break
+                yield ": keep-alive\n\n"
+                continue
+            if event[events.TYPE] == events.MESSAGE:
+                yield from messages_sse(order.add(event))
+                if order.held:
+                    yield from messages_sse(
+                        order.fill(db.iter_messages(roomcode, order.after)))
+                continue
+            if event[events.TYPE] == events.CLOSED:
+                yield from messages_sse(order.rest())
+                yield sse(event)
+                break
+            yield sse(event)
+    finally:
+        events.unsubscribe(sub)
+
+
+@api.route('/rooms/<roomcode>/events')
+class RoomEvents(Resource):
+    """
+    This class pushes a chat room's events to the client as they happen.
+    """
+    @api.doc(params={'after': 'Replay messages after this sequence number.'})
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
+    def get(self, roomcode):
+        """
+        Streams new messages, joins, leaves and the room's closure as
+        Server-Sent Events.
+        Message events carry their sequence number as the event id, so a
+        client that reconnects (with `Last-Event-ID` or `after`) gets the
+        messages it missed first.
+        """
+        room = db.get_room_by_code(roomcode, {db.ID: 1})
+        if room is None:
+            raise (wz.NotFound(f"No chat room exists w/ ID {roomcode}."))
+        after = request.args.get('after',
+                                 request.headers.get('Last-Event-ID'))
+        try:
+            after = int(after) if after else None
+        except ValueError:
+            raise (wz.BadRequest(f"Invalid sequence number {after}."))
+        # subscribe before reading the backlog, so nothing falls between.
+        sub = events.subscribe(room[db.ID])
+        backlog = []
+        if after is not None:
+            backlog = db.get_messages(roomcode, after, db.MAX_MESSAGE_LIMIT)
+        resp = Response(stream_with_context(
+            event_stream(sub, roomcode, backlog, after)),
+            mimetype=EVENT_STREAM)
+        resp.headers['Cache-Control'] = 'no-cache'
+        resp.headers['X-Accel-Buffering'] = 'no'
+        return resp
+
+
+@api.route('/users/<username>/rooms')
+class UserRooms(Resource):
+    """
+    This class lists the chat rooms a user is in.
+    """
+    @api.response(HTTPStatus.OK, 'Success')
+    def get(self, username):
+        """
+        Returns the names of the chat rooms the user is in.
+        """
+        return db.get_user_rooms(username)
+
+
+@api.route('/users/remove/<username>')
+class RemoveUserFromAllRooms(Resource):
+    """
+    This class supports removing a user from every room they are in.
+    """
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
+    @api.response(HTTPStatus.NOT_ACCEPTABLE, 'Anonymous users leave one room at a time.')
+    def put(self, username):
+        """
+        This method removes a user from all of their rooms at once, e.g.
+        when their session expires.
+        Anonymous users share names across rooms, so they have to leave
+        each room by name or code instead.
+        """
+        ret = db.remove_user_from_all_rooms(username)
+        if ret == db.NOT_FOUND:
+            raise (wz.NotFound(f"User {username} is not in any room."))
+        elif ret == db.NOT_ACCEPTABLE:
+            raise (wz.NotAcceptable(f"{username} is an anonymous name; "
+                                    + "leave each room separately."))
+        else:
+            return f"{username} has been removed from {len(ret)} rooms."
+
+
 @api.route('/users/remove/<username>/<roomname>')
 class RemoveUserFromRoom(Resource):
     """
@@ -322,14 +987,16 @@ class UpdateRoom(Resource):
     """
     @api.response(HTTPStatus.OK, 'Success')
     @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
-    @api.response(HTTPStatus.NOT_ACCEPTABLE, 'You are not an authorized user.')
+    @api.response(HTTPStatus.NOT_ACCEPTABLE, 'The new name is taken.')
     def put(self, roomname, newname):
         """
         This method updates a room already in the room database.
         """
         ret = db.update_room(roomname, newname)
         if ret == db.NOT_FOUND:
-            raise (wz.NotFound("Chat room {roomname} cannot be found."))
+            raise (wz.NotFound(f"Chat room {roomname} cannot be found."))
+        elif ret == db.DUPLICATE:
+            raise (wz.NotAcceptable(f"Chat room {newname} already exists."))
         else:
             return f"{roomname} updated to {newname}."
 
@@ -341,18 +1008,35 @@ class UpdateUser(Resource):
     """
     @api.response(HTTPStatus.OK, 'Success')
     @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
-    @api.response(HTTPStatus.NOT_ACCEPTABLE, 'You are not an authorized user.')
+    @api.response(HTTPStatus.NOT_ACCEPTABLE, 'The new name is taken.')
     def put(self, username, newname):
         """
         This method updates a user already in the user database.
         """
         ret = db.update_user(username, newname)
         if ret == db.NOT_FOUND:
-            raise (wz.NotFound("User {username} cannot be found."))
+            raise (wz.NotFound(f"User {username} cannot be found."))
+        elif ret == db.DUPLICATE:
+            raise (wz.NotAcceptable(f"Username {newname} already exists."))
         else:
             return f"{username} updated to {newname}."
 
 
+@api.route('/metrics')
+class Metrics(Resource):
+    """
+    This endpoint exports our runtime metrics for Prometheus to scrape.
+    """
+    @api.response(HTTPStatus.OK, 'Success')
+    def get(self):
+        """
+        Returns request, database and cache metrics in the Prometheus
+        text format.
+        """
+        return Response(metrics.registry.render(),
+                        content_type=metrics.CONTENT_TYPE)
+
+
 @api.route('/endpoints')
 class Endpoints(Resource):
     """
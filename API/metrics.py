@@ -0,0 +1,167 @@
+"""
+This file collects our runtime metrics in process and renders them in the
+Prometheus text format for the /metrics endpoint.
+Recording a sample is a dictionary lookup and a bisect under a lock, so
+it is cheap enough to do on every request and database operation.
+"""
+
+import bisect
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# upper bounds, in seconds, of our latency histogram buckets:
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """
+    Counts observations in cumulative buckets, Prometheus style.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def cumulative(self):
+        """
+        Yields (upper bound, observations at or below it) for every
+        bucket, ending with +Inf.
+        """
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),),
+                                self.counts):
+            running += count
+            yield bound, running
+
+
+def _labels(names, values):
+    pairs = ",".join(f'{name}="{value}"' for name, value
+                     in zip(names, values))
+    return "{" + pairs + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """
+    Holds every counter and histogram, keyed by metric name and labels.
+    Gauges are read from callbacks when the metrics are rendered.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = []
+        self.help = {}
+
+    def describe(self, name, kind, text, label_names=()):
+        self.help[name] = (kind, text, label_names)
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name, text, label_names, read, kind="gauge"):
+        """
+        Registers a metric whose samples come from read(), a function
+        returning (label values, value) pairs, e.g. for counts kept
+        elsewhere.
+        """
+        self.describe(name, kind, text, label_names)
+        self.gauges.append((name, read))
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        samples = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, []).append(
+                    (_labels(self.help[name][2], labels), value))
+            for (name, labels), histogram in self.histograms.items():
+                label_names = self.help[name][2]
+                lines = samples.setdefault(name, [])
+                for bound, count in histogram.cumulative():
+                    bucket_labels = _labels(label_names + ("le",),
+                                            labels + (_number(bound),))
+                    lines.append((bucket_labels, count, "_bucket"))
+                lines.append((_labels(label_names, labels),
+                              histogram.total, "_sum"))
+                lines.append((_labels(label_names, labels),
+                              histogram.count, "_count"))
+        for name, read in self.gauges:
+            samples[name] = [(_labels(self.help[name][2], labels), value)
+                             for labels, value in read()]
+        out = []
+        for name, lines in samples.items():
+            kind, text, label_names = self.help[name]
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            for line in lines:
+                suffix = line[2] if len(line) > 2 else ""
+                out.append(f"{name}{suffix}{line[0]} {_number(line[1])}")
+        return "\n".join(out) + "\n"
+
+
+REQUESTS = "crow_http_requests_total"
+REQUEST_ERRORS = "crow_http_request_errors_total"
+REQUEST_LATENCY = "crow_http_request_duration_seconds"
+DB_OPS = "crow_db_operations_total"
+DB_LATENCY = "crow_db_operation_duration_seconds"
+
+registry = Registry()
+registry.describe(REQUESTS, "counter", "HTTP requests served.",
+                  ("resource", "method", "status"))
+registry.describe(REQUEST_ERRORS, "counter",
+                  "HTTP requests answered with an error status.",
+                  ("resource", "status"))
+registry.describe(REQUEST_LATENCY, "histogram",
+                  "Time taken to serve HTTP requests.", ("resource",))
+registry.describe(DB_OPS, "counter", "Database operations made.",
+                  ("collection", "operation"))
+registry.describe(DB_LATENCY, "histogram",
+                  "Time taken by database operations.",
+                  ("collection", "operation"))
+
+
+def observe_request(resource, method, status, seconds):
+    """
+    Records one HTTP request.
+    """
+    registry.inc(REQUESTS, (resource, method, str(status)))
+    registry.observe(REQUEST_LATENCY, (resource,), seconds)
+    if status >= 400:
+        registry.inc(REQUEST_ERRORS, (resource, str(status)))
+
+
+def observe_db_op(op):
+    """
+    Records one database operation; registered as a db.trace listener.
+    """
+    labels = (op["collection"], op["operation"])
+    registry.inc(DB_OPS, labels)
+    registry.observe(DB_LATENCY, labels, op["ms"] / 1000)
@@ -0,0 +1,211 @@
+"""
+This file holds the tests for asgi.py.
+"""
+
+from unittest import TestCase
+import asyncio
+import json
+import random
+
+import API.asgi as asgi
+import API.endpoints as ep
+import db.data as db
+import db.db_connect as db_connect
+from db import events
+
+HUGE_NUM = 10000000000000
+
+
+def new_entity_name(entity_name):
+    int_name = random.randint(0, HUGE_NUM)
+    return "new " + str(entity_name) + " - " + str(int_name)
+
+
+async def call(method, path, body=None, query=b"", disconnect=None,
+               headers=()):
+    """
+    Sends one request to the ASGI app and returns its status and body.
+    disconnect, if given, is awaited before the client goes away.
+    """
+    data = json.dumps(body).encode() if body is not None else b""
+    scope = {"type": "http", "method": method, "path": path,
+             "query_string": query,
+             "headers": [(b"content-type", b"application/json"),
+                         *headers]}
+    sent = []
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": data}
+        if disconnect is not None:
+            await disconnect
+        else:
+            await asyncio.Event().wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.app(scope, receive, send)
+    status = sent[0]["status"]
+    content = b"".join(message.get("body", b"") for message in sent[1:])
+    return status, content.decode()
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class AsgiTestCase(TestCase):
+    def test_hello(self):
+        """
+        Post-condition 1: the async app answers like the Flask one.
+        """
+        status, body = run(call("GET", "/hello"))
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), {"Hello": "World"})
+
+    def test_fallback(self):
+        """
+        Post-condition 1: routes without an async handler are served by
+        the Flask app.
+        """
+        room = new_entity_name("room")
+        status, _ = run(call("POST", f"/rooms/create/{room}"))
+        self.assertEqual(status, 200)
+        self.assertTrue(db.room_exists(room))
+        status, _ = run(call("POST", f"/rooms/delete/{room}"))
+        self.assertEqual(status, 200)
+
+    def test_join_and_messages(self):
+        """
+        Post-condition 1: joining by code and posting messages work.
+        Post-condition 2: reading after a sequence number returns only
+        newer messages.
+        Post-condition 3: errors come back as JSON with their status.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        status, body = run(call("GET", f"/rooms/{room}/id"))
+        code = json.loads(body)
+        status, _ = run(call("POST", f"/rooms/join/{code}/{user}"))
+        self.assertEqual(status, 200)
+        self.assertIn(user, db.get_users_room(room))
+        status, body = run(call("POST", f"/rooms/{code}/messages/{user}",
+                                {"texts": ["a", "b"]}))
+        self.assertEqual(json.loads(body), {"seqs": [1, 2]})
+        status, body = run(call("GET", f"/rooms/{code}/messages",
+                                query=b"after=1"))
+        page = json.loads(body)
+        self.assertEqual([msg[db.TEXT] for msg in page["items"]], ["b"])
+        self.assertEqual(page["next"], 2)
+        status, body = run(call("POST", f"/rooms/{code}/messages/{user}",
+                                {"texts": "not a list"}))
+        self.assertEqual(status, 400)
+        db.delete_room(room)
+        status, body = run(call("GET", f"/rooms/{room}/id"))
+        self.assertEqual(status, 404)
+        self.assertIn("message", json.loads(body))
+
+    def test_list_users_room_etag(self):
+        """
+        Post-condition 1: a room's users are served with their version.
+        Post-condition 2: a client holding that version gets a 304.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        status, body = run(call("GET", f"/users/list/{room}"))
+        self.assertEqual(status, 200)
+        etag = f'"{db.get_version((db.USERS_LIST, room))}"'.encode()
+        status, body = run(call("GET", f"/users/list/{room}",
+                                headers=[(b"if-none-match", etag)]))
+        self.assertEqual(status, 304)
+        self.assertEqual(body, "")
+        db.delete_room(room)
+        status, body = run(call("GET", f"/users/list/{room}",
+                                headers=[(b"if-none-match", etag)]))
+        self.assertEqual(status, 404)
+
+    def test_room_events(self):
+        """
+        Post-condition 1: the stream replays missed messages, then pushes
+        live ones, and ends when the room closes.
+        Post-condition 2: the subscription is released.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        db.join_room_code(code, user)
+        db.add_messages(code, user, ["old", "missed"])
+
+        async def scenario():
+            stream = asyncio.ensure_future(
+                call("GET", f"/rooms/{code}/events", query=b"after=1"))
+            while events.num_subscribers() == 0:
+                await asyncio.sleep(0.01)
+            # published from another thread, as a sync worker would.
+            await asyncio.to_thread(db.add_message, code, user, "live")
+            await asyncio.to_thread(db.delete_room, room)
+            return await asyncio.wait_for(stream, 5)
+
+        status, body = run(scenario())
+        self.assertEqual(status, 200)
+        self.assertNotIn('"old"', body)
+        self.assertLess(body.index('"missed"'), body.index('"live"'))
+        self.assertTrue(body.endswith("event: closed\ndata: null\n\n"))
+        self.assertEqual(events.num_subscribers(), 0)
+
+    def test_room_events_closed_elsewhere(self):
+        """
+        Post-condition 1: a stream whose room was closed by another
+        process, which sends no event, ends with a closed event.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        code = db.get_room_code(room)
+
+        async def scenario():
+            stream = asyncio.ensure_future(
+                call("GET", f"/rooms/{code}/events"))
+            while events.num_subscribers() == 0:
+                await asyncio.sleep(0.01)
+            db_connect.delete_docs(db.ROOMS,
+                                   {db.ID: db.room_object_id(code)})
+            return await asyncio.wait_for(stream, 5)
+
+        heartbeat = ep.HEARTBEAT_SECS
+        ep.HEARTBEAT_SECS = 0.01
+        try:
+            status, body = run(scenario())
+        finally:
+            ep.HEARTBEAT_SECS = heartbeat
+        self.assertEqual(status, 200)
+        self.assertTrue(body.endswith("event: closed\ndata: null\n\n"))
+        self.assertEqual(events.num_subscribers(), 0)
+
+    def test_room_events_disconnect(self):
+        """
+        Post-condition 1: a client going away ends its stream.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        code = db.get_room_code(room)
+
+        async def scenario():
+            gone = asyncio.get_running_loop().create_future()
+            stream = asyncio.ensure_future(
+                call("GET", f"/rooms/{code}/events", disconnect=gone))
+            while events.num_subscribers() == 0:
+                await asyncio.sleep(0.01)
+            gone.set_result(None)
+            return await asyncio.wait_for(stream, 5)
+
+        status, _ = run(scenario())
+        self.assertEqual(status, 200)
+        self.assertEqual(events.num_subscribers(), 0)
+        db.delete_room(room)
@@ -0,0 +1,45 @@
+"""
+This file holds the tests for benchmark.py.
+"""
+
+from unittest import TestCase, skipUnless
+
+import API.benchmark as bench
+import db.db_connect as db_connect
+
+# the benchmark wipes the rooms and users it seeds over:
+IN_MEMORY = db_connect.backend_nm == db_connect.MEMORY
+
+
+class BenchmarkTestCase(TestCase):
+    def test_percentile(self):
+        """
+        Post-condition 1: nearest-rank percentiles of 1..100.
+        """
+        samples = list(range(100, 0, -1))
+        self.assertEqual(bench.percentile(samples, 50), 50)
+        self.assertEqual(bench.percentile(samples, 99), 99)
+        self.assertEqual(bench.percentile([7], 95), 7)
+
+    def test_local_uri(self):
+        """
+        Post-condition 1: only servers on this machine count as local.
+        """
+        self.assertTrue(bench.local_uri("mongodb://localhost:27017"))
+        self.assertTrue(bench.local_uri("mongodb://127.0.0.1,[::1]/x"))
+        self.assertFalse(bench.local_uri(""))
+        self.assertFalse(bench.local_uri("mongodb://db.example.com"))
+        self.assertFalse(bench.local_uri("mongodb+srv://localhost"))
+
+    @skipUnless(IN_MEMORY, "seeding wipes the database")
+    def test_run_benchmark(self):
+        """
+        Post-condition 1: every requested resource has latency stats.
+        Post-condition 2: DB round-trips are counted.
+        """
+        results = bench.run_benchmark([5], 3, only=["RoomID", "ListRooms"])
+        self.assertEqual(set(results["5"]), {"RoomID", "ListRooms"})
+        stats = results["5"]["RoomID"]
+        for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+            self.assertIn(key, stats)
+        self.assertGreater(stats["db_ops_per_request"], 0)
@@ -2,13 +2,21 @@
 This file holds the tests for endpoints.py.
 """
 
-from unittest import TestCase, skip 
+from unittest import TestCase, skip, skipIf
 from flask_restx import Resource, Api
-import random             
+import gzip
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
 
 import API.endpoints as ep
 import db.data as db
 import db.db_connect as db_connect
+from db import events, names, trace
 
 # field names in our DB:
 ROOMS = "rooms"
@@ -21,6 +29,14 @@ ID = "_id"
 
 HUGE_NUM = 10000000000000
 
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+# how long a fresh interpreter may take to import our app:
+IMPORT_BUDGET_SECS = 1.5
+
+# some tests rely on rooms seeded in our shared test database:
+IN_MEMORY = db_connect.backend_nm == db_connect.MEMORY
+
 def new_entity_name(entity_name):
     int_name = random.randint(0, HUGE_NUM)
     return "new " + str(entity_name) + " - " + str(int_name)
@@ -133,6 +149,7 @@ class EndpointTestCase(TestCase):
                 found = True
         self.assertTrue(found)
 
+    @skipIf(IN_MEMORY, "needs the seeded test database")
     def test_join_room_code(self):
         """
         Checks to see if a user can successfully join a room using a specific roomcode.
@@ -159,6 +176,7 @@ class EndpointTestCase(TestCase):
                 found = True
         self.assertTrue(found)
 
+    @skipIf(IN_MEMORY, "needs the seeded test database")
     def test_join_room_interests(self):
         """
         Checks to see if a user can successfully join a room using a specific set of interests.
@@ -171,3 +189,429 @@ class EndpointTestCase(TestCase):
         if "test_username" in rooms["Software Engineering"]["list_users"]:
             found = True
         self.assertTrue(found)
+
+    def test_list_rooms_paged(self):
+        """
+        Checks that room listings can be paged with a cursor.
+        Post-condition 1: pages hold at most `limit` rooms.
+        Post-condition 2: the next page starts after the previous one.
+        """
+        for i in range(3):
+            db.add_room(new_entity_name("room"))
+        client = ep.app.test_client()
+        first = client.get('/rooms/list?limit=2').get_json()
+        self.assertEqual(len(first[ep.ITEMS]), 2)
+        second = client.get(f'/rooms/list?limit=2&after={first[ep.NEXT]}')
+        second = second.get_json()
+        first_ids = [room[ID] for room in first[ep.ITEMS]]
+        for room in second[ep.ITEMS]:
+            self.assertNotIn(room[ID], first_ids)
+        self.assertEqual(first[ep.NEXT], first_ids[-1]["$oid"])
+
+    def test_list_rooms_encoding(self):
+        """
+        Post-condition 1: listings read as stored are sent with ids and
+        timestamps in extended JSON, whichever way they are asked for.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        client = ep.app.test_client()
+        listings = [client.get('/rooms/list').get_json(),
+                    client.get('/rooms/list?limit=1000').get_json()[ep.ITEMS],
+                    [json.loads(line) for line in
+                     client.get('/rooms/list?format=ndjson').get_data(
+                         as_text=True).splitlines()]]
+        for listing in listings:
+            found = [entry for entry in listing if entry[ROOM_NM] == room]
+            self.assertEqual(found[0][ID], {"$oid": code})
+            self.assertIn("$date", found[0][db.LAST_ACTIVITY])
+        db.delete_room(room)
+
+    def test_list_rooms_bad_cursor(self):
+        """
+        Post-condition 1: an invalid cursor is a bad request.
+        """
+        resp = ep.app.test_client().get('/rooms/list?after=nope')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_list_rooms_ndjson(self):
+        """
+        Post-condition 1: streamed listings have one JSON room per line.
+        """
+        db.add_room(new_entity_name("room"))
+        resp = ep.app.test_client().get('/rooms/list?format=ndjson')
+        self.assertEqual(resp.mimetype, ep.NDJSON)
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertGreater(len(lines), 0)
+        for line in lines:
+            self.assertIn(ROOM_NM, json.loads(line))
+
+    def test_db_trace_headers(self):
+        """
+        Post-condition 1: with DB_TRACE on, responses report their DB work.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        ep.app.config["DB_TRACE"] = True
+        try:
+            resp = ep.app.test_client().get(f'/rooms/{room}/id')
+        finally:
+            ep.app.config["DB_TRACE"] = False
+        self.assertIn(ep.DB_OPS_HEADER, resp.headers)
+        self.assertLessEqual(int(resp.headers[ep.DB_OPS_HEADER]), 1)
+
+    def test_query_budgets(self):
+        """
+        Checks that single-room endpoints don't scan the rooms collection.
+        Post-condition 1: each stays within one operation on one document,
+        and has only that document examined.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        user = new_entity_name("user")
+        client = ep.app.test_client()
+        requests = [
+            ('get', f'/rooms/{room}/id'),
+            ('get', f'/users/list/{room}'),
+            ('post', f'/rooms/join/{code}/{user}'),
+            ('put', f'/users/remove/{user}/{room}'),
+            ('post', f'/rooms/create/{new_entity_name("room")}'),
+            ('post', f'/users/create/{new_entity_name("user")}'),
+        ]
+        for method, url in requests:
+            db.room_changed()
+            with trace.budget(max_ops=1, max_docs=1, max_scanned=1):
+                getattr(client, method)(url)
+
+    def test_query_budget_exceeded(self):
+        """
+        Post-condition 1: going over budget fails with the operations made.
+        """
+        with self.assertRaises(AssertionError):
+            with trace.budget(max_ops=0):
+                db.room_exists(new_entity_name("room"))
+
+    def test_messages(self):
+        """
+        Post-condition 1: posted messages get sequence numbers.
+        Post-condition 2: reading after `next` returns only new messages.
+        Post-condition 3: a user outside the room gets a 406.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        db.join_room_code(code, user)
+        client = ep.app.test_client()
+        resp = client.post(f'/rooms/{code}/messages/{user}',
+                           json={'texts': ['hello', 'there']})
+        self.assertEqual(resp.get_json(), {ep.SEQS: [1, 2]})
+        resp = client.get(f'/rooms/{code}/messages')
+        page = resp.get_json()
+        self.assertEqual(len(page[ep.ITEMS]), 2)
+        self.assertEqual(page[ep.NEXT], 2)
+        client.post(f'/rooms/{code}/messages/{user}', json={'texts': ['!']})
+        resp = client.get(f'/rooms/{code}/messages?after={page[ep.NEXT]}')
+        self.assertEqual([msg[db.TEXT] for msg in resp.get_json()[ep.ITEMS]],
+                         ['!'])
+        resp = client.post(f'/rooms/{code}/messages/{new_entity_name("u")}',
+                           json={'texts': ['hi']})
+        self.assertEqual(resp.status_code, 406)
+        db.delete_room(room)
+
+    def test_room_events(self):
+        """
+        Post-condition 1: the stream replays messages after `after`.
+        Post-condition 2: live events follow, and the stream ends when the
+        room closes.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        db.join_room_code(code, user)
+        db.add_messages(code, user, ["old", "new"])
+        resp = ep.app.test_client().get(f'/rooms/{code}/events?after=1',
+                                        buffered=False)
+        self.assertEqual(resp.mimetype, ep.EVENT_STREAM)
+        db.delete_room(room)
+        body = "".join(chunk.decode() for chunk in resp.response)
+        self.assertNotIn('"old"', body)
+        self.assertIn('id: 2\nevent: message\n', body)
+        self.assertTrue(body.endswith('event: closed\ndata: null\n\n'))
+        self.assertEqual(events.num_subscribers(), 0)
+
+    def test_room_events_long_backlog(self):
+        """
+        Post-condition 1: a client more than a page behind is sent every
+        message it missed.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        db.join_room_code(code, user)
+        db.add_messages(code, user, [str(i) for i in range(5)])
+        limit = db.MAX_MESSAGE_LIMIT
+        db.MAX_MESSAGE_LIMIT = 2
+        try:
+            resp = ep.app.test_client().get(f'/rooms/{code}/events?after=0',
+                                            buffered=False)
+            events.publish(code, events.CLOSED)
+            body = "".join(chunk.decode() for chunk in resp.response)
+        finally:
+            db.MAX_MESSAGE_LIMIT = limit
+        for seq in range(1, 6):
+            self.assertIn(f'id: {seq}\nevent: message\n', body)
+        db.delete_room(room)
+
+    def test_room_events_gap(self):
+        """
+        Post-condition 1: a message whose event was lost is read from the
+        log before the next one is sent.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        db.join_room_code(code, user)
+        db.add_messages(code, user, ["first", "lost", "third"])
+        first, _, third = db.get_messages(code)
+        heartbeat = ep.HEARTBEAT_SECS
+        # the stream waits for its first event as soon as it's opened:
+        ep.HEARTBEAT_SECS = 0.01
+        try:
+            resp = ep.app.test_client().get(f'/rooms/{code}/events',
+                                            buffered=False)
+            events.publish(code, events.MESSAGE, first)
+            events.publish(code, events.MESSAGE, third)
+            events.publish(code, events.CLOSED)
+            body = "".join(chunk.decode() for chunk in resp.response)
+        finally:
+            ep.HEARTBEAT_SECS = heartbeat
+        self.assertLess(body.index('"first"'), body.index('"lost"'))
+        self.assertLess(body.index('"lost"'), body.index('"third"'))
+        self.assertEqual(body.count('"third"'), 1)
+        db.delete_room(room)
+
+    def test_room_events_out_of_order(self):
+        """
+        Checks a message whose event arrives before an earlier message
+        is written.
+        Post-condition 1: the stream holds it, and sends both in order.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        ob_id = db.room_object_id(code)
+        db.join_room_code(code, user)
+
+        def write_first():
+            first = db.new_messages(reserved[db.MSG_SEQ], user, ["first"])
+            db_connect.insert_docs(db.MESSAGES, db.message_docs(ob_id, first))
+            db.messages_added(ob_id, room, first)
+            events.publish(code, events.CLOSED)
+
+        heartbeat = ep.HEARTBEAT_SECS
+        ep.HEARTBEAT_SECS = 0.01
+        try:
+            resp = ep.app.test_client().get(f'/rooms/{code}/events?after=0',
+                                            buffered=False)
+            reserved = db_connect.fetch_and_update(db.ROOMS, {db.ID: ob_id},
+                                                   db.reserve_seqs(1),
+                                                   {db.MSG_SEQ: 1})
+            db.add_message(code, user, "second")
+            writer = threading.Timer(0.1, write_first)
+            writer.start()
+            body = "".join(chunk.decode() for chunk in resp.response)
+            writer.join()
+        finally:
+            ep.HEARTBEAT_SECS = heartbeat
+        self.assertEqual(body.count('"first"'), 1)
+        self.assertEqual(body.count('"second"'), 1)
+        self.assertLess(body.index('"first"'), body.index('"second"'))
+        db.delete_room(room)
+
+    def test_room_events_closed_elsewhere(self):
+        """
+        Post-condition 1: a stream whose room was closed by another
+        process, which sends no event, ends with a closed event.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        heartbeat = ep.HEARTBEAT_SECS
+        ep.HEARTBEAT_SECS = 0.01
+        try:
+            resp = ep.app.test_client().get(f'/rooms/{code}/events',
+                                            buffered=False)
+            db_connect.delete_docs(db.ROOMS, {db.ID: db.room_object_id(code)})
+            body = "".join(chunk.decode() for chunk in resp.response)
+        finally:
+            ep.HEARTBEAT_SECS = heartbeat
+        self.assertTrue(body.endswith("event: closed\ndata: null\n\n"))
+        self.assertIsNone(db.get_room_code(room))
+
+    def test_room_events_missing_room(self):
+        """
+        Post-condition 1: a stream on a missing room is a 404.
+        """
+        resp = ep.app.test_client().get('/rooms/nonexistent/events')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_bulk_create(self):
+        """
+        Post-condition 1: new names are added and taken ones reported.
+        Post-condition 2: too many names are refused.
+        """
+        taken = new_entity_name("room")
+        new = new_entity_name("room")
+        db.add_room(taken)
+        client = ep.app.test_client()
+        resp = client.post('/rooms/create', json={'names': [taken, new]})
+        self.assertEqual(resp.get_json(), {ep.ADDED: [new],
+                                           ep.DUPLICATES: [taken]})
+        resp = client.post('/users/create',
+                           json={'names': ['x'] * (ep.MAX_BULK + 1)})
+        self.assertEqual(resp.status_code, 400)
+        resp = client.post('/users/create', json={'names': 'x'})
+        self.assertEqual(resp.status_code, 400)
+        db.delete_room(taken)
+        db.delete_room(new)
+
+    def test_join_anonymous_room(self):
+        """
+        Post-condition 1: the newcomer is told their room and name.
+        """
+        resp = ep.app.test_client().post('/rooms/join/anonymous')
+        body = resp.get_json()
+        self.assertIn(body[ep.USER], db.get_users_room(body[ep.ROOM]))
+        db.remove_user_from_room(body[ep.USER], body[ep.ROOM])
+
+    def test_remove_user_from_all_rooms(self):
+        """
+        Post-condition 1: the user's rooms are listed.
+        Post-condition 2: the user can be taken out of all of them.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        db.join_room_code(db.get_room_code(room), user)
+        client = ep.app.test_client()
+        self.assertEqual(client.get(f'/users/{user}/rooms').get_json(),
+                         [room])
+        self.assertEqual(client.put(f'/users/remove/{user}').status_code,
+                         200)
+        self.assertEqual(client.put(f'/users/remove/{user}').status_code,
+                         404)
+        anonymous = names.load()[0]
+        self.assertEqual(client.put(f'/users/remove/{anonymous}').status_code,
+                         406)
+        db.delete_room(room)
+
+    def test_list_etags(self):
+        """
+        Checks conditional GETs of the room and user listings.
+        Post-condition 1: listings carry an ETag.
+        Post-condition 2: an If-None-Match with it gets a 304 with no
+        database work.
+        Post-condition 3: a write moves the listing to a new ETag.
+        Post-condition 4: the ETag doesn't change without writes, e.g.
+        from a worker that has never read the listing.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        client = ep.app.test_client()
+        for url in ('/rooms/list', '/users/list', f'/users/list/{room}'):
+            resp = client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers['ETag']
+            with trace.budget(max_ops=0):
+                resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+            self.assertEqual(resp.data, b"")
+            db.versions.clear()
+            ep.body_cache.clear()
+            resp = client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+        etag = client.get(f'/users/list/{room}').headers['ETag']
+        db.add_user(user)
+        db.join_room_code(db.get_room_code(room), user)
+        resp = client.get(f'/users/list/{room}',
+                          headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(user, resp.get_json())
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        db.delete_room(room)
+        db.delete_user(user)
+
+    def test_list_encoding(self):
+        """
+        Checks how full listings are encoded.
+        Post-condition 1: a listing is encoded once per version.
+        Post-condition 2: large listings are gzipped for clients that
+        accept it, and not for others.
+        """
+        names = [new_entity_name("user") for i in range(50)]
+        db.add_users(names)
+        client = ep.app.test_client()
+        plain = client.get('/users/list')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        with trace.budget(max_ops=0):
+            again = client.get('/users/list')
+        self.assertEqual(again.data, plain.data)
+        self.assertGreater(len(plain.data), ep.COMPRESS_MIN_BYTES)
+        zipped = client.get('/users/list',
+                            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(zipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(zipped.data), plain.data)
+        self.assertEqual(zipped.headers['ETag'], plain.headers['ETag'])
+        listed = {user[USER_NM] for user in json.loads(plain.data)}
+        self.assertTrue(set(names) <= listed)
+        for name in names:
+            db.delete_user(name)
+
+    def test_import_budget(self):
+        """
+        Checks that importing our app is cheap.
+        Post-condition 1: it takes less than IMPORT_BUDGET_SECS.
+        Post-condition 2: it neither connects to the database nor starts
+        any threads, even without APP_HOME.
+        """
+        env = {key: value for key, value in os.environ.items()
+               if key not in ("APP_HOME", "DB_BACKEND")}
+        # a server nobody listens on, so any connection attempt shows:
+        env["MONGO_URI"] = "mongodb://127.0.0.1:9/?connectTimeoutMS=1"
+        env["EVENT_BROKER_DIR"] = tempfile.mkdtemp()
+        script = ("import json, sys, threading, time\n"
+                  + "started = time.perf_counter()\n"
+                  + "import API.endpoints as ep\n"
+                  + "secs = time.perf_counter() - started\n"
+                  + "from db import broker, db_connect\n"
+                  + "print(json.dumps([secs, db_connect.client is None,\n"
+                  + "    db_connect.backend is None, broker.broker is None,\n"
+                  + "    threading.active_count()]))\n")
+        out = subprocess.run([sys.executable, "-c", script], env=env,
+                             cwd=REPO_ROOT, capture_output=True, text=True,
+                             check=True).stdout
+        secs, no_client, no_backend, no_broker, threads = json.loads(out)
+        self.assertLess(secs, IMPORT_BUDGET_SECS)
+        self.assertTrue(no_client and no_backend and no_broker)
+        self.assertEqual(threads, 1)
+
+    def test_ready(self):
+        """
+        Post-condition 1: a worker that has started is ready.
+        Post-condition 2: starting it again does nothing.
+        """
+        client = ep.app.test_client()
+        self.assertEqual(client.get('/ready').get_json(), {ep.READY: True})
+        with trace.budget(max_ops=0):
+            ep.start_worker()
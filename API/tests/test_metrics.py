@@ -0,0 +1,50 @@
+"""
+This file holds the tests for metrics.py.
+"""
+
+from unittest import TestCase
+
+import API.endpoints as ep
+import API.metrics as metrics
+
+
+class MetricsTestCase(TestCase):
+    def test_histogram_buckets(self):
+        """
+        Post-condition 1: buckets are cumulative and end with +Inf.
+        """
+        histogram = metrics.Histogram((0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value)
+        self.assertEqual(list(histogram.cumulative()),
+                         [(0.1, 1), (1.0, 2), (float("inf"), 3)])
+        self.assertEqual(histogram.count, 3)
+        self.assertAlmostEqual(histogram.total, 5.55)
+
+    def test_render(self):
+        """
+        Post-condition 1: counters and histograms render with labels.
+        """
+        registry = metrics.Registry()
+        registry.describe("hits_total", "counter", "Hits.", ("page",))
+        registry.describe("took_seconds", "histogram", "Took.", ("page",))
+        registry.inc("hits_total", ("home",))
+        registry.observe("took_seconds", ("home",), 0.2)
+        text = registry.render()
+        self.assertIn('# TYPE hits_total counter', text)
+        self.assertIn('hits_total{page="home"} 1', text)
+        self.assertIn('took_seconds_bucket{page="home",le="+Inf"} 1', text)
+        self.assertIn('took_seconds_count{page="home"} 1', text)
+
+    def test_metrics_endpoint(self):
+        """
+        Post-condition 1: requests and DB operations show up in /metrics.
+        """
+        client = ep.app.test_client()
+        client.get('/rooms/list')
+        resp = client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        text = resp.get_data(as_text=True)
+        self.assertIn(metrics.REQUESTS, text)
+        self.assertIn(metrics.DB_LATENCY, text)
+        self.assertIn("crow_cache_lookups_total", text)
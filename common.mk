@@ -14,6 +14,10 @@ tests: unit
 unit: FORCE
 	$(TESTFINDER) --with-coverage
 
+# runs the tests against the in-memory backend; no database needed:
+fast_tests: FORCE
+	DB_BACKEND=memory $(TESTFINDER)
+
 lint: FORCE
 	$(LINTER) *.py
 
@@ -0,0 +1,113 @@
+"""
+This file holds async versions of the db.data functions behind our
+chat-heavy routes, for the ASGI app.
+They share db.data's filters, updates, room cache, events and result
+codes; only the database calls are awaited.
+"""
+
+import db.async_db as adb
+import db.data as data
+from db.data import (ID, ROOMS, MESSAGES, ROOM_NM, USERS_LIST, ROOM_ID,
+                     SEQ, MSG_SEQ, ROOM_CODE, OK, NOT_FOUND, NOT_ACCEPTABLE,
+                     MESSAGE_LIMIT, MAX_MESSAGE_LIMIT)
+
+
+async def get_room_code(roomname):
+    """
+    Returns the room code for a specific room, or None if it doesn't
+    exist.
+    """
+    code = data.room_cache.get((ROOM_CODE, roomname))
+    if code is None:
+        since = data.last_write
+        room = await adb.fetch_doc(ROOMS, {ROOM_NM: roomname}, {ID: 1})
+        if room is None:
+            return None
+        code = str(room[ID])
+        data.cache_room((ROOM_CODE, roomname), code, since)
+        data.remember_room(roomname, room[ID])
+    return code
+
+
+async def get_users_room(roomname):
+    """
+    Returns the users in a specific room, or None if it doesn't exist.
+    """
+    users = data.room_cache.get((USERS_LIST, roomname))
+    if users is None:
+        since = data.last_write
+        room = await adb.fetch_doc(ROOMS, {ROOM_NM: roomname},
+                                   {USERS_LIST: 1})
+        if room is None:
+            return None
+        users = room.get(USERS_LIST, [])
+        data.cache_room((USERS_LIST, roomname), users, since)
+        data.remember_room(roomname, room[ID])
+    return users
+
+
+async def get_room_by_code(roomcode, projection = None):
+    """
+    Returns the room with a specific room code, or None.
+    """
+    ob_id = data.room_object_id(roomcode)
+    if ob_id is None:
+        return None
+    return await adb.fetch_doc(ROOMS, {ID: ob_id}, projection)
+
+
+async def join_room_code(roomcode, username):
+    """
+    Adds a user to a chat room using a specific room code.
+    Returns OK, NOT_ACCEPTABLE or ROOM_FULL like db.data.join_room_code.
+    """
+    ob_id = data.room_object_id(roomcode)
+    if ob_id is None:
+        return NOT_ACCEPTABLE
+    room = await adb.fetch_and_update(
+        ROOMS, {ID: ob_id, **data.open_rooms(username)},
+        data.join_update(username), {ROOM_NM: 1})
+    if room is not None:
+        data.room_joined(room, username)
+        return OK
+    return data.join_outcome(
+        await adb.fetch_doc(ROOMS, {ID: ob_id}, {USERS_LIST: 1}), username)
+
+
+async def add_messages(roomcode, username, texts):
+    """
+    Appends a batch of messages to a room's message log.
+    Returns their sequence numbers, or NOT_FOUND / NOT_ACCEPTABLE like
+    db.data.add_messages.
+    """
+    ob_id = data.room_object_id(roomcode)
+    if ob_id is None:
+        return NOT_FOUND
+    if not texts:
+        return []
+    room = await adb.fetch_and_update(ROOMS,
+                                      {ID: ob_id, USERS_LIST: username},
+                                      data.reserve_seqs(len(texts)),
+                                      {MSG_SEQ: 1, ROOM_NM: 1})
+    if room is None:
+        return data.add_outcome(await adb.fetch_doc(ROOMS, {ID: ob_id},
+                                                    {ID: 1}))
+    messages = data.new_messages(room[MSG_SEQ], username, texts)
+    await adb.insert_docs(MESSAGES, data.message_docs(ob_id, messages))
+    return data.messages_added(ob_id, room[ROOM_NM], messages)
+
+
+async def get_messages(roomcode, after = 0, limit = MESSAGE_LIMIT):
+    """
+    Returns up to limit of a room's messages after sequence number after,
+    oldest first, stopping short of any still being written like
+    db.data.get_messages, or None if roomcode is malformed.
+    """
+    ob_id = data.room_object_id(roomcode)
+    if ob_id is None:
+        return None
+    limit = max(1, min(limit, MAX_MESSAGE_LIMIT))
+    return data.written_messages(
+        await adb.fetch_docs(MESSAGES, {ROOM_ID: ob_id, SEQ: {"$gt": after}},
+                             {ID: 0, ROOM_ID: 0}, limit=limit, sort_key=SEQ,
+                             raw=True), after)
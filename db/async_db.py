@@ -0,0 +1,158 @@
+"""
+This file is the asyncio counterpart of db_connect, used by our ASGI app.
+It reaches the same database through pymongo's async client, so a request
+waiting on Mongo doesn't hold a thread. Only the operations the async
+routes need are here, and they return documents in the same JSON-ready
+form as db_connect's.
+"""
+
+import asyncio
+import time
+
+import pymongo as pm
+
+import db.db_connect as db
+from db import codec, trace
+from db.backends import DUP_KEY_CODE
+
+ID = db.ID
+
+client = None
+client_loop = None
+
+
+def get_client():
+    """
+    Returns the async client, created on first use. Async clients are tied
+    to an event loop, so a new loop (e.g. in tests) gets a new client.
+    """
+    global client, client_loop
+    loop = asyncio.get_running_loop()
+    if client is None or client_loop is not loop:
+        client = pm.AsyncMongoClient(db.get_uri(),
+                                     maxPoolSize=db.pool_size,
+                                     connectTimeoutMS=db.timeout_ms,
+                                     serverSelectionTimeoutMS=db.timeout_ms,
+                                     connect=False)
+        client_loop = loop
+    return client
+
+
+class AsyncMongoBackend:
+    """
+    Awaits MongoDB through the async client.
+    """
+    def collection(self, collect_nm):
+        return get_client()[db.database_name][collect_nm]
+
+    async def fetch_doc(self, collect_nm, filters, projection=None):
+        return await self.collection(collect_nm).find_one(filters,
+                                                          projection)
+
+    async def fetch_docs(self, collect_nm, filters, projection=None,
+                         limit=0, sort_key=ID):
+        cursor = self.collection(collect_nm).find(filters, projection,
+                                                  limit=limit)
+        return await cursor.sort(sort_key, pm.ASCENDING).to_list()
+
+    async def insert_docs(self, collect_nm, docs, ordered=True):
+        try:
+            await self.collection(collect_nm).insert_many(docs,
+                                                          ordered=ordered)
+        except pm.errors.BulkWriteError as err:
+            errors = err.details.get("writeErrors", [])
+            if any(error["code"] != DUP_KEY_CODE for error in errors):
+                raise
+            return [error["index"] for error in errors]
+        return []
+
+    async def fetch_and_update(self, collect_nm, filters, update_string,
+                               projection=None):
+        return await self.collection(collect_nm).find_one_and_update(
+            filters, update_string, projection,
+            return_document=pm.ReturnDocument.AFTER)
+
+
+class AsyncMemoryBackend:
+    """
+    Runs operations on db_connect's in-memory backend, so the sync and
+    async apps see the same data. None of them block.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def fetch_doc(self, collect_nm, filters, projection=None):
+        return self.backend.fetch_doc(collect_nm, filters, projection)
+
+    async def fetch_docs(self, collect_nm, filters, projection=None,
+                         limit=0, sort_key=ID):
+        return list(self.backend.iter_docs(collect_nm, filters, projection,
+                                           0, limit, sort_key))
+
+    async def insert_docs(self, collect_nm, docs, ordered=True):
+        return self.backend.insert_docs(collect_nm, docs, ordered)
+
+    async def fetch_and_update(self, collect_nm, filters, update_string,
+                               projection=None):
+        return self.backend.fetch_and_update(collect_nm, filters,
+                                             update_string, projection)
+
+
+def get_backend():
+    """
+    Returns the async backend matching db_connect's DB_BACKEND.
+    """
+    if db.backend_nm == db.MEMORY:
+        return AsyncMemoryBackend(db.get_backend())
+    return AsyncMongoBackend()
+
+
+async def fetch_doc(collect_nm, filters = {}, projection = None):
+    """
+    Fetch one document that meets filters.
+    """
+    started = time.perf_counter()
+    doc = await get_backend().fetch_doc(collect_nm, filters, projection)
+    trace.record(collect_nm, "fetch_doc", filters, int(doc is not None),
+                 started)
+    return doc
+
+
+async def fetch_docs(collect_nm, filters = {}, projection = None,
+                     limit = 0, sort_key = ID, raw = False):
+    """
+    Returns up to limit documents that meet filters, in sort_key order,
+    as JSON-ready dictionaries, or as the database returns them with raw
+    (see db_connect.iter_docs). A limit of 0 means no limit.
+    """
+    started = time.perf_counter()
+    docs = await get_backend().fetch_docs(collect_nm, filters, projection,
+                                          limit, sort_key)
+    trace.record(collect_nm, "iter_docs", filters, len(docs), started)
+    return docs if raw else codec.json_ready(docs)
+
+
+async def insert_docs(collect_nm, docs, ordered = True):
+    """
+    Inserts many documents in one round-trip.
+    Returns the positions in docs of the ones rejected as duplicates.
+    """
+    started = time.perf_counter()
+    duplicates = await get_backend().insert_docs(collect_nm, docs, ordered)
+    trace.record(collect_nm, "insert_docs", {}, len(docs) - len(duplicates),
+                 started)
+    return duplicates
+
+
+async def fetch_and_update(collect_nm, filters = {}, update_string = {},
+                           projection = None):
+    """
+    Atomically updates one document that meets filters.
+    Returns the updated document, or None if nothing matched.
+    """
+    started = time.perf_counter()
+    doc = await get_backend().fetch_and_update(collect_nm, filters,
+                                               update_string, projection)
+    trace.record(collect_nm, "fetch_and_update", filters,
+                 int(doc is not None), started)
+    return doc
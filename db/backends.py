@@ -0,0 +1,231 @@
+"""
+This file defines the storage interface db_connect talks to, and its
+MongoDB implementation.
+Every method works on one collection, named by collect_nm, and takes
+filters, projections and update strings in MongoDB's format.
+"""
+
+from abc import ABC, abstractmethod
+
+import pymongo as pm
+
+ID = "_id"
+DUP_KEY_CODE = 11000
+
+
+class Unsupported(Exception):
+    """
+    Raised by a backend for an operation its kind of storage can't do.
+    """
+
+
+class Backend(ABC):
+    """
+    The operations a storage engine has to support; a backend missing
+    one can't be created.
+    Documents handed back are the caller's to keep: changing them must not
+    change what is stored.
+    An operation a backend's storage can't do at all raises Unsupported.
+    """
+    @abstractmethod
+    def create_index(self, collect_nm, keys, unique=False):
+        """
+        Creates an index on keys (a field name or a list of
+        (field name, direction) pairs) if it does not already exist.
+        """
+
+    @abstractmethod
+    def fetch_doc(self, collect_nm, filters, projection=None):
+        """
+        Returns one document that meets filters, or None.
+        """
+
+    @abstractmethod
+    def fetch_docs(self, collect_nm, filters, projection=None):
+        """
+        Returns every document that meets filters as a list.
+        """
+
+    @abstractmethod
+    def iter_docs(self, collect_nm, filters, projection=None,
+                  batch_size=0, limit=0, sort_key=ID):
+        """
+        Yields documents that meet filters one at a time, in ascending
+        sort_key order. A limit of 0 means no limit.
+        """
+
+    @abstractmethod
+    def distinct(self, collect_nm, key_nm, filters):
+        """
+        Returns the distinct values of key_nm among documents that meet
+        filters.
+        """
+
+    @abstractmethod
+    def aggregate(self, collect_nm, pipeline):
+        """
+        Runs an aggregation pipeline and returns the results as a list.
+        """
+
+    @abstractmethod
+    def insert_doc(self, collect_nm, doc):
+        """
+        Inserts one document, raising DuplicateKeyError if a unique index
+        already holds one of its keys.
+        """
+
+    @abstractmethod
+    def insert_docs(self, collect_nm, docs, ordered=True):
+        """
+        Inserts many documents in one round-trip.
+        An ordered insert stops at the first failure; an unordered one
+        goes on with the rest.
+        Returns the positions in docs of the documents rejected as
+        duplicates by a unique index.
+        """
+
+    @abstractmethod
+    def upsert_docs(self, collect_nm, key_nm, docs):
+        """
+        Writes many documents in one round-trip, replacing the document
+        with the same key_nm value if there is one.
+        Returns the number of documents that were new.
+        """
+
+    @abstractmethod
+    def update_doc(self, collect_nm, filters, update_string):
+        """
+        Applies update_string to one document that meets filters.
+        Returns the number of documents matched (0 or 1).
+        """
+
+    @abstractmethod
+    def update_docs(self, collect_nm, filters, update_string):
+        """
+        Applies update_string to every document that meets filters.
+        Returns the number of documents matched.
+        """
+
+    @abstractmethod
+    def fetch_and_update(self, collect_nm, filters, update_string,
+                         projection=None):
+        """
+        Atomically applies update_string to one document that meets
+        filters and returns the updated document, or None.
+        """
+
+    @abstractmethod
+    def delete_doc(self, collect_nm, filters):
+        """
+        Deletes one document that meets filters.
+        Returns the number of documents deleted (0 or 1).
+        """
+
+    @abstractmethod
+    def delete_docs(self, collect_nm, filters):
+        """
+        Deletes every document that meets filters.
+        Returns the number of documents deleted.
+        """
+
+    def examined(self, collect_nm, filters):
+        """
+        Returns how many documents the database examines to find the ones
+        meeting filters, or None if it can't tell.
+        """
+        return None
+
+    @abstractmethod
+    def watch(self, collect_nm, full_document=None):
+        """
+        Opens a stream of the changes made to a collection.
+        With full_document="updateLookup", update events carry the
+        document as it is after the change.
+        Raises Unsupported if the storage has no change streams.
+        """
+
+
+class MongoBackend(Backend):
+    """
+    Stores everything in MongoDB.
+    get_collection is called with a collection name on every operation, so
+    the client it uses can be swapped (e.g. after a fork).
+    """
+    def __init__(self, get_collection):
+        self.get_collection = get_collection
+
+    def create_index(self, collect_nm, keys, unique=False):
+        return self.get_collection(collect_nm).create_index(keys,
+                                                            unique=unique)
+
+    def fetch_doc(self, collect_nm, filters, projection=None):
+        return self.get_collection(collect_nm).find_one(filters, projection)
+
+    def fetch_docs(self, collect_nm, filters, projection=None):
+        return list(self.get_collection(collect_nm).find(filters, projection))
+
+    def iter_docs(self, collect_nm, filters, projection=None,
+                  batch_size=0, limit=0, sort_key=ID):
+        cursor = self.get_collection(collect_nm).find(filters, projection,
+                                                      batch_size=batch_size,
+                                                      limit=limit)
+        return cursor.sort(sort_key, pm.ASCENDING)
+
+    def distinct(self, collect_nm, key_nm, filters):
+        return self.get_collection(collect_nm).distinct(key_nm, filters)
+
+    def aggregate(self, collect_nm, pipeline):
+        return list(self.get_collection(collect_nm).aggregate(pipeline))
+
+    def insert_doc(self, collect_nm, doc):
+        self.get_collection(collect_nm).insert_one(doc)
+
+    def insert_docs(self, collect_nm, docs, ordered=True):
+        try:
+            self.get_collection(collect_nm).insert_many(docs, ordered=ordered)
+        except pm.errors.BulkWriteError as err:
+            errors = err.details.get("writeErrors", [])
+            if any(error["code"] != DUP_KEY_CODE for error in errors):
+                raise
+            return [error["index"] for error in errors]
+        return []
+
+    def upsert_docs(self, collect_nm, key_nm, docs):
+        if not docs:
+            return 0
+        ret = self.get_collection(collect_nm).bulk_write(
+            [pm.ReplaceOne({key_nm: doc[key_nm]}, doc, upsert=True)
+             for doc in docs], ordered=False)
+        return ret.upserted_count
+
+    def update_doc(self, collect_nm, filters, update_string):
+        ret = self.get_collection(collect_nm).update_one(filters,
+                                                         update_string)
+        return ret.matched_count
+
+    def update_docs(self, collect_nm, filters, update_string):
+        ret = self.get_collection(collect_nm).update_many(filters,
+                                                          update_string)
+        return ret.matched_count
+
+    def fetch_and_update(self, collect_nm, filters, update_string,
+                         projection=None):
+        return self.get_collection(collect_nm).find_one_and_update(
+            filters, update_string, projection,
+            return_document=pm.ReturnDocument.AFTER)
+
+    def delete_doc(self, collect_nm, filters):
+        return self.get_collection(collect_nm).delete_one(filters) \
+            .deleted_count
+
+    def delete_docs(self, collect_nm, filters):
+        return self.get_collection(collect_nm).delete_many(filters) \
+            .deleted_count
+
+    def examined(self, collect_nm, filters):
+        plan = self.get_collection(collect_nm).find(filters).explain()
+        return plan.get("executionStats", {}).get("totalDocsExamined")
+
+    def watch(self, collect_nm, full_document=None):
+        return self.get_collection(collect_nm).watch(
+            full_document=full_document)
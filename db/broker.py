@@ -0,0 +1,154 @@
+"""
+This file passes room events between the worker processes on a node, so
+a message posted to one gunicorn worker reaches the subscribers connected
+to the others.
+Each worker binds a Unix datagram socket in a shared directory. Every event
+published in a worker is sent to the other sockets there, and each
+worker's reader thread hands what it receives to its own subscribers. No
+database reads are made, however many subscribers there are.
+Set EVENT_BROKER_DIR to the directory to use it.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+
+import bson.json_util as bsutil
+
+from db import events
+
+BROKER_DIR = os.environ.get("EVENT_BROKER_DIR", "")
+SUFFIX = ".sock"
+# the largest event we pass on (datagrams can't be split):
+MAX_EVENT_BYTES = 64 * 1024
+# how often, in seconds, we look for workers that started or stopped:
+PEER_REFRESH_SECS = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class Broker:
+    """
+    One worker's end of the broker.
+    name picks its socket in directory; it defaults to our process id.
+    """
+    def __init__(self, directory, name=None):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory,
+                                 f"{name or os.getpid()}{SUFFIX}")
+        # a worker that died without cleaning up may have left it behind:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.reader = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.reader.bind(self.path)
+        # a worker whose buffer is full shouldn't hold up the sender:
+        self.writer = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.writer.setblocking(False)
+        self.peers = []
+        self.peers_read = 0
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.thread = None
+
+    def get_peers(self):
+        """
+        Returns the sockets of the other workers, re-reading the directory
+        at most every PEER_REFRESH_SECS.
+        """
+        if time.monotonic() - self.peers_read > PEER_REFRESH_SECS:
+            self.peers = [os.path.join(self.directory, entry)
+                          for entry in os.listdir(self.directory)
+                          if entry.endswith(SUFFIX)
+                          and os.path.join(self.directory, entry)
+                          != self.path]
+            self.peers_read = time.monotonic()
+        return self.peers
+
+    def send(self, event):
+        """
+        Sends event to every other worker; registered as an events
+        listener.
+        """
+        data = bsutil.dumps(event).encode()
+        if len(data) > MAX_EVENT_BYTES:
+            logger.warning(f"Event too large to pass on: {len(data)} bytes")
+            self.dropped += 1
+            return
+        for peer in list(self.get_peers()):
+            try:
+                self.writer.sendto(data, peer)
+                self.sent += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # that worker is gone.
+                self.peers.remove(peer)
+                try:
+                    os.unlink(peer)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                self.dropped += 1
+
+    def run(self):
+        """
+        Hands the events other workers send us to our subscribers, until
+        the broker is closed.
+        """
+        while True:
+            try:
+                data = self.reader.recv(MAX_EVENT_BYTES)
+            except OSError:
+                return
+            self.received += 1
+            try:
+                events.deliver(bsutil.loads(data))
+            except ValueError:
+                logger.warning("Dropped a malformed event")
+
+    def start(self):
+        events.listeners.append(self.send)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        if self.send in events.listeners:
+            events.listeners.remove(self.send)
+        # shutting down wakes the reader thread up.
+        try:
+            self.reader.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.reader.close()
+        self.writer.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+broker = None
+broker_lock = threading.Lock()
+
+
+def start(directory = None):
+    """
+    Starts this process's broker if it isn't running yet, e.g. in a
+    freshly forked worker.
+    Returns the broker, or None if no directory is configured.
+    """
+    global broker
+    directory = directory or BROKER_DIR
+    if not directory:
+        return None
+    with broker_lock:
+        path = os.path.join(directory, f"{os.getpid()}{SUFFIX}")
+        if broker is None or broker.path != path:
+            # one inherited from our parent must not send for us.
+            if broker is not None and broker.send in events.listeners:
+                events.listeners.remove(broker.send)
+            broker = Broker(directory).start()
+    return broker
@@ -0,0 +1,59 @@
+"""
+This file turns our documents into JSON.
+Documents straight from the database hold BSON types such as ObjectIds
+and datetimes; they come out in the same extended JSON as
+bson.json_util (e.g. {"$oid": ...}), which is what our API has always
+sent, but without building the intermediate copy json_util does.
+orjson is used when it is installed, as it is several times faster than
+the json module.
+"""
+
+import json
+
+import bson.json_util as bsutil
+from bson import ObjectId
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    """
+    Returns the extended JSON form of a value JSON has no type for.
+    """
+    # by far the most common, so it skips json_util's type checks:
+    if type(obj) is ObjectId:
+        return {"$oid": str(obj)}
+    return bsutil.default(obj, bsutil.DEFAULT_JSON_OPTIONS)
+
+
+def dumps(obj):
+    """
+    Encodes obj, documents and all, as JSON bytes.
+    """
+    if orjson is not None:
+        # datetimes are passed to default, to keep json_util's form, and
+        # keys that aren't strings are turned into strings, as json does:
+        return orjson.dumps(obj, default=default,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME
+                            | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=default).encode()
+
+
+def loads(data):
+    """
+    Decodes JSON bytes or text.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_ready(obj):
+    """
+    Returns a copy of obj holding only JSON types, BSON values converted
+    as by dumps.
+    """
+    return loads(dumps(obj))
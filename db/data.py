@@ -5,36 +5,270 @@ Gradually, we will fill in actual calls to our datastore.
 """
 
 from http.client import NOT_ACCEPTABLE
+from datetime import datetime, timedelta, timezone
+import hashlib
+import itertools
 import os
 import random
+import threading
+import time
+from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError
 import db.db_connect as db
+from db import events, names
+from db.cache import TTLCache
 
-APP_HOME = os.environ["APP_HOME"]
+APP_HOME = os.environ.get("APP_HOME",
+                          os.path.dirname(os.path.dirname(
+                              os.path.abspath(__file__))))
 
 # field names in our DB:
 ROOMS = "rooms"
 USERS = "users"
+MESSAGES = "messages"
 USER_NM = "user_name"
 ROOM_NM = "room_name"
 NUM_USERS = "num_users"
 COMMON_INTERESTS = "common_interests"
 USERS_LIST = "list_users"
+LAST_ACTIVITY = "last_activity"
+MSG_SEQ = "msg_seq"
+ROOM_ID = "room_id"
+SEQ = "seq"
+TEXT = "text"
+SENT_AT = "sent_at"
 ID = "_id"
+MATCH_SCORE = "score"
 
 OK = 0
 NOT_FOUND = 1
 DUPLICATE = 2
 NOT_ACCEPTABLE = 3
+ROOM_FULL = 4
+
+# every room has a limited number of user slots:
+ROOM_CAPACITY = 10
+# how many random rooms we try before giving up on a join:
+JOIN_ATTEMPTS = 3
+# how random joins place users: in the least occupied open rooms, or in
+# any open room:
+LEAST_LOADED = "least_loaded"
+RANDOM = "random"
+PLACEMENT = os.environ.get("ROOM_PLACEMENT", LEAST_LOADED)
+# how many of the emptiest rooms a join picks from, so concurrent joins
+# don't all pile into the same one:
+PLACEMENT_CHOICES = 8
+PUBLIC_ROOM = "Public room"
+
+# rooms close after this many seconds without activity:
+ROOM_IDLE_SECS = int(os.environ.get("ROOM_IDLE_SECS", 20 * 60))
+
+# room reads are cached for a few seconds; our own writes invalidate them.
+ROOM_CACHE_TTL = float(os.environ.get("ROOM_CACHE_TTL", 5))
+ROOM_CACHE_SIZE = int(os.environ.get("ROOM_CACHE_SIZE", 1024))
+ROOM_CACHE_WATCH = os.environ.get("ROOM_CACHE_WATCH", "") == "1"
+ROOM_CODE = "room_code"
+
+# listings are paged by _id:
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# message reads are paged by sequence number:
+MESSAGE_LIMIT = 100
+MAX_MESSAGE_LIMIT = 1000
+# a message's number is reserved before it is written; a gap in a room's
+# log older than this many seconds is a write that failed:
+MESSAGE_WRITE_SECS = float(os.environ.get("MESSAGE_WRITE_SECS", 30))
+
+room_cache = TTLCache(ROOM_CACHE_SIZE, ROOM_CACHE_TTL)
+
+# the versions of our listings, which the API hands out as ETags: ROOMS,
+# USERS, and (USERS_LIST, roomname) for a room's users. A version is a
+# digest of the listing as sent, so it is the same in every worker and
+# only changes with the listing. We remember them until our own writes
+# drop them, or they expire like the room cache, so writes by other
+# workers show up within a few seconds.
+versions = TTLCache(ROOM_CACHE_SIZE, ROOM_CACHE_TTL)
+VERSION_BYTES = 16
+# numbers our writes to rooms and users, so what was read while one
+# happened isn't cached, nor its version remembered; taken with
+# write_lock, along with dropping what the write changed:
+write_numbers = itertools.count(1)
+last_write = 0
+write_lock = threading.Lock()
+
+
+@db.on_connect
+def create_indexes():
+    """
+    Creates the indexes our lookups rely on.
+    Runs when a process first connects; safe to call more than once.
+    """
+    db.create_index(ROOMS, ROOM_NM, unique=True)
+    db.create_index(ROOMS, NUM_USERS)
+    db.create_index(ROOMS, COMMON_INTERESTS)
+    db.create_index(ROOMS, USERS_LIST)
+    db.create_index(ROOMS, LAST_ACTIVITY)
+    db.create_index(USERS, USER_NM, unique=True)
+    db.create_index(MESSAGES, [(ROOM_ID, 1), (SEQ, 1)], unique=True)
+
+
+def now():
+    """
+    Returns the current time, as stored in our activity timestamps.
+    """
+    return datetime.now(timezone.utc)
+
+
+def room_changed(roomname = None):
+    """
+    Drops cached state for a room after it was written to.
+    Without a room name every cached room is dropped.
+    """
+    global last_write
+    with write_lock:
+        last_write = next(write_numbers)
+        if roomname is None:
+            room_cache.clear()
+            versions.clear()
+        else:
+            room_cache.delete(ROOMS)
+            room_cache.delete((ROOM_CODE, roomname))
+            room_cache.delete((USERS_LIST, roomname))
+            versions.delete(ROOMS)
+            versions.delete((USERS_LIST, roomname))
+
+
+def users_changed():
+    """
+    Drops the users listing's version after it was written to.
+    """
+    global last_write
+    with write_lock:
+        last_write = next(write_numbers)
+        versions.delete(USERS)
+
+
+def get_version(key):
+    """
+    Returns the version of a listing, as named in versions, or None if
+    it may have changed since we last read it.
+    """
+    return versions.get(key)
+
+
+def set_version(key, body, since):
+    """
+    Returns the version of a listing from its encoded body, and
+    remembers it if nothing was written since last_write was since, i.e.
+    while the listing was read.
+    """
+    version = hashlib.blake2b(body, digest_size=VERSION_BYTES).hexdigest()
+    with write_lock:
+        if last_write == since:
+            versions.set(key, version)
+    return version
+
+
+def cache_room(key, value, since):
+    """
+    Caches value, read from a room, in room_cache unless something was
+    written since last_write was since, i.e. while it was read: that
+    write has already dropped the entry, and value may be from before it.
+    """
+    with write_lock:
+        if last_write == since:
+            room_cache.set(key, value)
+
+
+def forget_room(roomcode):
+    """
+    Drops what this process holds for a room another process closed,
+    e.g. the clock process expiring it, once it is found to be gone.
+    """
+    names.forget(roomcode)
+    roomname = room_cache.get((ROOM_NM, str(roomcode)))
+    if roomname is not None:
+        room_changed(roomname)
+
+
+def remember_room(roomname, ob_id):
+    """
+    Notes which room an id belongs to while we cache it by name, so a
+    change to it can be traced back to its cache entries.
+    """
+    room_cache.set((ROOM_NM, str(ob_id)), roomname)
+
+
+def _room_change(change):
+    """
+    Drops what we cache about the room a change stream event is about:
+    it is named by the event's document (after the change) and by what
+    we noted it was called. If we know neither, every room is dropped.
+    """
+    roomnames = {room_cache.get((ROOM_NM, str(change["documentKey"][ID]))),
+                 (change.get("fullDocument") or {}).get(ROOM_NM)}
+    roomnames.discard(None)
+    if not roomnames:
+        room_changed()
+    for roomname in roomnames:
+        room_changed(roomname)
+
+
+def _watch_rooms():
+    """
+    Follows the rooms change stream and drops the cached state of each
+    room any worker writes to.
+    """
+    while True:
+        try:
+            with db.watch(ROOMS, "updateLookup") as stream:
+                for change in stream:
+                    _room_change(change)
+        except Exception as err:
+            print(f"Room change stream stopped: {err}")
+            room_changed()
+            time.sleep(ROOM_CACHE_TTL)
+
 
-client = db.get_client()
-print(client)
+def watch_rooms():
+    """
+    Keeps the room cache coherent across processes by following the
+    rooms change stream in a background thread.
+    """
+    watcher = threading.Thread(target=_watch_rooms, daemon=True)
+    watcher.start()
+    return watcher
+
+
+def start():
+    """
+    Does up front what would otherwise slow down a process's first
+    requests: connects to the database (creating our indexes), loads the
+    name corpus and, with ROOM_CACHE_WATCH=1, starts following room
+    changes. The in-memory backend has no change stream, and nothing to
+    follow: it lives in this one process.
+    Nothing here reads our collections, whose size has no bound, and
+    nothing runs at import, so importing this file stays cheap; call it
+    once per process.
+    """
+    db.get_backend()
+    names.load()
+    if ROOM_CACHE_WATCH and db.backend_nm != db.MEMORY:
+        watch_rooms()
 
 
 def get_rooms():
     """
     A function to return a list of all rooms.
+    Listings hold the rooms as stored, ids and timestamps still BSON
+    values, to be encoded with db.codec.
     """
-    return db.fetch_all(ROOMS, ROOM_NM)
+    rooms = room_cache.get(ROOMS)
+    if rooms is None:
+        since = last_write
+        rooms = db.fetch_all(ROOMS, ROOM_NM, raw=True)
+        cache_room(ROOMS, rooms, since)
+    return rooms
 
 
 def get_rooms_as_dict():
@@ -46,25 +280,113 @@ def get_rooms_as_dict():
 
 def get_users():
     """
-    A function to return a list of all users.
+    A function to return a list of all users, as stored, like
+    get_rooms.
     """
-    return db.fetch_all(USERS, USER_NM)
+    return db.fetch_all(USERS, USER_NM, raw=True)
+
+
+def _get_page(collect_nm, after = None, limit = PAGE_SIZE):
+    """
+    Returns up to limit documents whose id comes after the cursor after,
+    as stored. Returns None if after is not a valid cursor.
+    """
+    filters = {}
+    if after:
+        try:
+            filters = {ID: {"$gt": db.create_object_id(after)}}
+        except (InvalidId, TypeError):
+            return None
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return list(db.iter_docs(collect_nm, filters, limit=limit, raw=True))
+
+
+def get_rooms_page(after = None, limit = PAGE_SIZE):
+    """
+    A function to return one page of rooms, starting after the room
+    whose code is after.
+    Returns None if after is not a valid room code.
+    """
+    return _get_page(ROOMS, after, limit)
+
+
+def get_users_page(after = None, limit = PAGE_SIZE):
+    """
+    A function to return one page of users, starting after the user
+    whose id is after.
+    Returns None if after is not a valid user id.
+    """
+    return _get_page(USERS, after, limit)
+
+
+def iter_rooms():
+    """
+    A function to go through all rooms one at a time, as stored.
+    """
+    return db.iter_docs(ROOMS, raw=True)
+
+
+def iter_users():
+    """
+    A function to go through all users one at a time, as stored.
+    """
+    return db.iter_docs(USERS, raw=True)
 
 
 def get_room_code(roomname):
     """
     A function to return the room code for a specific room.
+    Returns None if the room does not exist.
     """
-    rooms = db.fetch_all_as_dict(ROOMS, ROOM_NM)
-    return str(rooms[roomname][ID])
+    code = room_cache.get((ROOM_CODE, roomname))
+    if code is None:
+        since = last_write
+        room = db.fetch_doc(ROOMS, {ROOM_NM: roomname}, {ID: 1})
+        if room is None:
+            return None
+        code = str(room[ID])
+        cache_room((ROOM_CODE, roomname), code, since)
+        remember_room(roomname, room[ID])
+    return code
+
 
-    
 def get_users_room(roomname):
     """
     A function to return a list of all users from a specific room.
+    Returns None if the room does not exist.
     """
-    rooms = db.fetch_all_as_dict(ROOMS, ROOM_NM)
-    return rooms[roomname][USERS_LIST]
+    users = room_cache.get((USERS_LIST, roomname))
+    if users is None:
+        since = last_write
+        room = db.fetch_doc(ROOMS, {ROOM_NM: roomname}, {USERS_LIST: 1})
+        if room is None:
+            return None
+        users = room.get(USERS_LIST, [])
+        cache_room((USERS_LIST, roomname), users, since)
+        remember_room(roomname, room[ID])
+    return users
+
+
+def room_object_id(roomcode):
+    """
+    Returns the id of the room with a specific room code, or None if the
+    code is malformed.
+    """
+    try:
+        return db.create_object_id(roomcode)
+    except (InvalidId, TypeError):
+        return None
+
+
+def get_room_by_code(roomcode, projection = None):
+    """
+    A function to return the room with a specific room code.
+    Returns None if the code is malformed or no such room exists.
+    """
+    ob_id = room_object_id(roomcode)
+    if ob_id is None:
+        return None
+    return db.fetch_doc(ROOMS, {ID: ob_id}, projection)
 
 
 def get_users_as_dict():
@@ -79,7 +401,7 @@ def room_exists(roomname):
     See if a room with roomname is in the db.
     Returns True of False.
     """
-    rec = db.fetch_doc(ROOMS, {ROOM_NM: roomname})
+    rec = db.fetch_doc(ROOMS, {ROOM_NM: roomname}, {ID: 1})
     return rec is not None
 
 
@@ -88,47 +410,97 @@ def user_exists(username):
     See if a user with username is in the db.
     Returns True of False.
     """
-    rec = db.fetch_doc(USERS, filters={USER_NM: username})
+    rec = db.fetch_doc(USERS, filters={USER_NM: username},
+                       projection={ID: 1})
     return rec is not None
 
 
+def _new_room(roomname):
+    return {ROOM_NM: roomname, NUM_USERS: 0, USERS_LIST: [],
+            LAST_ACTIVITY: now()}
+
+
 def add_room(roomname):
     """
     Add a room to the room database.
+    The unique index on room names catches duplicates, so this is a
+    single insert.
     """
-    rooms = get_rooms()
-    if rooms is None:
-        return NOT_FOUND
-    elif room_exists(roomname):
+    try:
+        db.insert_doc(ROOMS, _new_room(roomname))
+    except DuplicateKeyError:
         return DUPLICATE
-    else:
-        db.insert_doc(ROOMS, {ROOM_NM: roomname, NUM_USERS: 0, USERS_LIST: []})
-        return OK
+    room_changed(roomname)
+    return OK
+
+
+def add_rooms(roomnames):
+    """
+    Adds many rooms with one bulk insert.
+    Returns a dictionary of each name to OK, or DUPLICATE if a room by
+    that name already exists (or the name was given twice).
+    """
+    new_names = list(dict.fromkeys(roomnames))
+    results = {name: OK for name in new_names}
+    if not new_names:
+        return results
+    duplicates = db.insert_docs(ROOMS, [_new_room(name) for name in new_names],
+                                ordered=False)
+    for pos in duplicates:
+        results[new_names[pos]] = DUPLICATE
+    room_changed()
+    return results
 
 
 def add_user(username):
     """
     This function adds a new user to the user db.
+    The unique index on usernames catches duplicates, so this is a single
+    insert. Names from our anonymous name corpus are shared, so they only
+    need one document.
     """
-    defaultUsernames = ["Crow", "Owl", "Raven", "Eagle", "Sparrow", "Penguin", "Flamingo", "Crane", "Hummingbird", "Dove"]
-    users = get_users()
-    if users is None:
-        return NOT_FOUND
-    elif user_exists(username) and username not in defaultUsernames:
-        return DUPLICATE
-    else:
+    try:
         db.insert_doc(USERS, {USER_NM: username})
-        return OK
+    except DuplicateKeyError:
+        if names.is_name(username):
+            return OK
+        return DUPLICATE
+    users_changed()
+    return OK
+
+
+def add_users(usernames):
+    """
+    Adds many users with one bulk insert.
+    Returns a dictionary of each name to OK, or DUPLICATE if the name is
+    already taken.
+    """
+    new_names = list(dict.fromkeys(usernames))
+    results = {name: OK for name in new_names}
+    if not new_names:
+        return results
+    duplicates = db.insert_docs(USERS, [{USER_NM: name} for name in new_names],
+                                ordered=False)
+    for pos in duplicates:
+        if not names.is_name(new_names[pos]):
+            results[new_names[pos]] = DUPLICATE
+    users_changed()
+    return results
 
 
 def delete_room(roomname):
     """
     Deletes a room from the room database.
     """
-    if not room_exists(roomname):
+    room = db.fetch_doc(ROOMS, {ROOM_NM: roomname}, {ID: 1})
+    if room is None:
         return NOT_FOUND
     else:
-        db.delete_doc(ROOMS, {ROOM_NM: roomname})
+        db.delete_doc(ROOMS, {ID: room[ID]})
+        db.delete_docs(MESSAGES, {ROOM_ID: room[ID]})
+        room_changed(roomname)
+        names.forget(room[ID])
+        events.publish(room[ID], events.CLOSED)
         return OK
 
 
@@ -140,166 +512,498 @@ def delete_user(username):
         return NOT_FOUND
     else:
         db.delete_doc(USERS, {USER_NM: username})
+        users_changed()
         return OK
 
 
-def remove_user_from_room(username, roomname):
-    rooms = get_rooms_as_dict()
-    requested_room = rooms[roomname]
-    lst = requested_room[USERS_LIST]
-    num = requested_room[NUM_USERS]
-    ob_id = requested_room[ID]
-    try:
-        lst.remove(username)
-        num -= 1
-    except:
+def _leave_update(username):
+    """
+    Returns the update that takes username out of a room.
+    """
+    return {"$pull": {USERS_LIST: username},
+            "$inc": {NUM_USERS: -1},
+            "$set": {LAST_ACTIVITY: now()}}
+
+
+def join_update(username):
+    """
+    Returns the update that puts username in a room.
+    """
+    return {"$addToSet": {USERS_LIST: username},
+            "$inc": {NUM_USERS: 1},
+            "$set": {LAST_ACTIVITY: now()}}
+
+
+def _leave_room(filters, username):
+    """
+    Atomically takes username out of the room matching filters.
+    Returns OK, or NOT_FOUND if the user wasn't in that room.
+    """
+    room = db.fetch_and_update(ROOMS, {**filters, USERS_LIST: username},
+                               _leave_update(username), {ROOM_NM: 1})
+    if room is None:
         return NOT_FOUND
-    db.update_doc(ROOMS, {ID : ob_id}, { "$set" : {USERS_LIST: lst, NUM_USERS: num}})
+    room_changed(room[ROOM_NM])
+    names.release(room[ID], username)
+    events.publish(room[ID], events.LEAVE, {USER_NM: username})
     return OK
 
 
+def remove_user_from_room(username, roomname):
+    """
+    Removes a user from a chat room.
+    """
+    return _leave_room({ROOM_NM: roomname}, username)
+
+
 def remove_user_from_room_id(username, roomcode):
-    rooms = db.fetch_all_as_dict(ROOMS, ID)
-    ob_id = db.create_object_id(roomcode)
-    requested_room = rooms[ob_id]
-    lst = requested_room[USERS_LIST]
-    num = requested_room[NUM_USERS]
-    try:
-        lst.remove(username)
-        num -= 1
-    except:
+    """
+    Removes a user from a chat room using its room code.
+    """
+    ob_id = room_object_id(roomcode)
+    if ob_id is None:
         return NOT_FOUND
-    db.update_doc(ROOMS, {ID : ob_id}, { "$set" : {USERS_LIST: lst, NUM_USERS: num}})
-    return OK
+    return _leave_room({ID: ob_id}, username)
 
 
-def join_preset_room(username):
-    rooms = get_rooms_as_dict()
-    if rooms is None:
-        return NOT_FOUND
-    else:
-        found_room = False
-        while(not found_room):
-            random_room = random.choice(list(rooms))
-            ob_id = rooms[random_room][ID]
-            roomname = rooms[random_room][ROOM_NM]
-            if username not in get_users_room(roomname):
-                found_room = True
-    if found_room:
-        join_room_code(ob_id, username)
-        return roomname
-    else:
-        return join_random_room(username)
+def is_user_in_room(username, roomname):
+    """
+    Checks whether a user is in a chat room, with one indexed lookup that
+    doesn't fetch the room's list of users.
+    """
+    return db.fetch_doc(ROOMS, {ROOM_NM: roomname, USERS_LIST: username},
+                        {ID: 1}) is not None
 
 
-def join_random_room(username):
+def get_user_rooms(username):
     """
-    Adds a user to a random chat room.
+    Returns the names of the chat rooms a user is in, found through the
+    list_users index.
     """
-    rooms = get_rooms_as_dict()
-    if rooms is None:
+    return [room[ROOM_NM] for room in
+            db.fetch_docs(ROOMS, {USERS_LIST: username}, {ROOM_NM: 1})]
+
+
+def remove_user_from_all_rooms(username):
+    """
+    Takes a user out of every chat room they are in, e.g. when their
+    session expires. One indexed read and one bulk update, however many
+    rooms that is.
+    Names from our corpus are shared by anonymous users in different
+    rooms, so they can't be taken out everywhere at once.
+    Returns the names of the rooms left, NOT_FOUND if there were none, or
+    NOT_ACCEPTABLE for a corpus name.
+    """
+    if names.is_name(username):
+        return NOT_ACCEPTABLE
+    rooms = db.fetch_docs(ROOMS, {USERS_LIST: username}, {ROOM_NM: 1})
+    if not rooms:
         return NOT_FOUND
+    # a room the user left in the meantime isn't changed twice.
+    db.update_docs(ROOMS, {ID: {"$in": [room[ID] for room in rooms]},
+                           USERS_LIST: username},
+                   _leave_update(username))
+    for room in rooms:
+        room_changed(room[ROOM_NM])
+        names.release(room[ID], username)
+        events.publish(room[ID], events.LEAVE, {USER_NM: username})
+    return [room[ROOM_NM] for room in rooms]
+
+
+def open_rooms(username = None):
+    """
+    Returns the filter for rooms username is allowed to join: rooms with
+    a free slot that the user isn't already in.
+    """
+    filters = {NUM_USERS: {"$lt": ROOM_CAPACITY}}
+    if username is not None:
+        filters[USERS_LIST] = {"$ne": username}
+    return filters
+
+
+def _join_room(filters, username):
+    """
+    Atomically adds username to the room matching filters, as long as the
+    room has a free slot and the user isn't already in it.
+    Returns the joined room (name and id only), or None if no room
+    qualified.
+    """
+    room = db.fetch_and_update(ROOMS,
+                               {**filters, **open_rooms(username)},
+                               join_update(username), {ROOM_NM: 1})
+    if room is not None:
+        room_joined(room, username)
+    return room
+
+
+def room_joined(room, username):
+    """
+    Tells everyone that username joined room (its name and id).
+    """
+    room_changed(room[ROOM_NM])
+    events.publish(room[ID], events.JOIN, {USER_NM: username})
+
+
+def join_outcome(room, username):
+    """
+    Finds out why a join by room code didn't happen, from the room's
+    users list as read afterwards (None if there's no such room).
+    Returns OK if username is already in the room, NOT_ACCEPTABLE if it
+    doesn't exist, or ROOM_FULL.
+    """
+    if room is None:
+        return NOT_ACCEPTABLE
+    elif username in room.get(USERS_LIST, []):
+        return OK
     else:
-        random_room = random.choice(list(rooms))
-        lst = rooms[random_room][USERS_LIST]
-        num = rooms[random_room][NUM_USERS]
-        ob_id = rooms[random_room][ID]
-        lst.append(username)
-        num += 1
-        db.update_doc(ROOMS, {ID : ob_id}, { "$set" : {USERS_LIST: lst, NUM_USERS: num}})
-        return rooms[random_room][ROOM_NM]
+        return ROOM_FULL
+
+
+def join_preset_room(username):
+    """
+    Adds a user with a preset username to a random chat room they
+    aren't already in.
+    """
+    return join_random_room(username)
+
+
+def _least_loaded_rooms(username = None):
+    """
+    Returns a few of the open rooms with the fewest users, in random order
+    among equally full ones, read through the num_users index.
+    """
+    rooms = list(db.iter_docs(ROOMS, open_rooms(username),
+                              {ID: 1, NUM_USERS: 1},
+                              limit=PLACEMENT_CHOICES, sort_key=NUM_USERS,
+                              raw=True))
+    random.shuffle(rooms)
+    rooms.sort(key=lambda room: room[NUM_USERS])
+    return [{ID: room[ID]} for room in rooms[:JOIN_ATTEMPTS]]
+
+
+def _new_public_room(username):
+    """
+    Opens a new public room with username in it, for when every room is
+    full. Returns its name.
+    """
+    while True:
+        roomname = f"{PUBLIC_ROOM} {random.getrandbits(32):08x}"
+        room = {**_new_room(roomname), USERS_LIST: [username],
+                NUM_USERS: 1}
+        try:
+            db.insert_doc(ROOMS, room)
+        except DuplicateKeyError:
+            continue
+        room_changed(roomname)
+        events.publish(room[ID], events.JOIN, {USER_NM: username})
+        return roomname
+
+
+def join_random_room(username, placement = None):
+    """
+    Adds a user to an open chat room.
+    By default (placement LEAST_LOADED) the room is one of the emptiest,
+    so rooms fill up evenly; if every room is full, a new public room is
+    opened. With placement RANDOM, the server samples a few rooms
+    instead, falling back to the emptiest ones if none of those is open,
+    and NOT_FOUND is returned if no room has a free slot.
+    Either way the cost doesn't grow with the number of rooms.
+    """
+    placement = placement or PLACEMENT
+    candidates = []
+    if placement != LEAST_LOADED:
+        candidates = db.sample_docs(ROOMS, open_rooms(username),
+                                    JOIN_ATTEMPTS, {ID: 1})
+    if not candidates:
+        candidates = _least_loaded_rooms(username)
+    for room in candidates:
+        # another request may have filled the room since we sampled it.
+        joined = _join_room({ID: room[ID]}, username)
+        if joined is not None:
+            return joined[ROOM_NM]
+    if placement == LEAST_LOADED:
+        return _new_public_room(username)
+    return NOT_FOUND
+
+
+def join_anonymous_room():
+    """
+    Places a newcomer in one of the emptiest open rooms, under a name
+    from our corpus that nobody in that room is using. Names come from
+    the room's pool, so no users are read.
+    Returns the room name and the username.
+    """
+    for room in _least_loaded_rooms():
+        username = names.allocate(room[ID])
+        if username is None:
+            continue
+        # the room may have filled up, or another worker given out the
+        # name: either way, move on.
+        joined = _join_room({ID: room[ID]}, username)
+        if joined is not None:
+            return joined[ROOM_NM], username
+        # a name someone has stays out of the pool; any other goes back.
+        if db.fetch_doc(ROOMS, {ID: room[ID], USERS_LIST: username},
+                        {ID: 1}) is None:
+            names.release(room[ID], username)
+    username = random.choice(names.load())
+    return _new_public_room(username), username
 
 
 def join_room_code(roomcode, username):
     """
     Adds a user to a chat room using a specific room code.
+    Returns ROOM_FULL if the room has no free slots.
     """
-    rooms = db.fetch_all_as_dict(ROOMS, ID)
-    if rooms is None:
-        return NOT_FOUND
-    else:
-        ob_id = db.create_object_id(roomcode) 
-
-        if not room_exists(rooms[ob_id][ROOM_NM]):
-            return NOT_ACCEPTABLE
-        else:	
-            requested_room = rooms[ob_id]
-            lst = requested_room[USERS_LIST]
-            num = requested_room[NUM_USERS]
-            lst.append(username)
-            num += 1
-            db.update_doc(ROOMS, {ID : ob_id}, { "$set" : {USERS_LIST: lst, NUM_USERS: num}})
-            return OK
+    ob_id = room_object_id(roomcode)
+    if ob_id is None:
+        return NOT_ACCEPTABLE
+    if _join_room({ID: ob_id}, username) is not None:
+        return OK
+    return join_outcome(db.fetch_doc(ROOMS, {ID: ob_id}, {USERS_LIST: 1}),
+                        username)
+
 
 def join_room_interests(interests, username):
     """
     Adds a user to a chat room based on their specific interests.
+    Open rooms sharing at least one interest are found through the
+    common_interests index and ranked by how many interests they share;
+    ties go to the emptier room.
     """
-    #This algorithm is O(n^2) runtime. Contains nested for loops."
-    rooms = db.fetch_all_as_dict(ROOMS, ID)
-    max_count = 0
-    max_id = 0
-    count = 0
-    if rooms is None:
+    if not interests:
         return NOT_FOUND
-    else:
-        for room in rooms:
-            try:
-                for interest in interests:
-                    if interest in rooms[room][COMMON_INTERESTS]:
-                        count += 1
-            except KeyError:
-                pass
-            if count > max_count:
-                max_count = count
-                max_id = room
-            count = 0
-        if max_id == 0:
-            return NOT_FOUND
-        else:
-            lst = rooms[max_id][USERS_LIST]
-            num = rooms[max_id][NUM_USERS]
-            lst.append(username)
-            num += 1
-            db.update_doc(ROOMS, {ID : max_id}, { "$set" : {USERS_LIST: lst, NUM_USERS: num}})
-            return rooms[max_id][ROOM_NM]
+    interests = list(set(interests))
+    pipeline = [
+        {"$match": {COMMON_INTERESTS: {"$in": interests},
+                    **open_rooms(username)}},
+        {"$project": {NUM_USERS: 1,
+                      MATCH_SCORE: {"$size": {"$setIntersection":
+                                              [f"${COMMON_INTERESTS}",
+                                               interests]}}}},
+        {"$sort": {MATCH_SCORE: -1, NUM_USERS: 1}},
+        {"$limit": JOIN_ATTEMPTS},
+    ]
+    for room in db.aggregate(ROOMS, pipeline):
+        # another request may have filled the room since we ranked it.
+        joined = _join_room({ID: room[ID]}, username)
+        if joined is not None:
+            return joined[ROOM_NM]
+    return NOT_FOUND
 
 
 def update_room(roomname, newname):
     """
-    Updates a room in the room database.
+    Renames a room in the room database with one atomic update; the
+    unique index on room names turns away a name that is already taken.
+    create_indexes won't let us run without that index.
+    Returns the old name, NOT_FOUND, or DUPLICATE.
     """
-    rooms = get_rooms_as_dict()
-    found = False
-    if rooms is None:
+    try:
+        room = db.fetch_and_update(ROOMS, {ROOM_NM: roomname},
+                                   {"$set": {ROOM_NM: newname,
+                                             LAST_ACTIVITY: now()}},
+                                   {ID: 1})
+    except DuplicateKeyError:
+        return DUPLICATE
+    if room is None:
         return NOT_FOUND
-    else:
-        for room in rooms:
-            if rooms[room][ROOM_NM] == roomname:
-                ob_id = rooms[room][ID]
-                found = True
-        if not found:
-            return NOT_FOUND
-        else:
-            db.update_doc(ROOMS, {ID : ob_id}, { "$set" : {ROOM_NM: newname}})
-            return rooms[roomname][ROOM_NM]
+    room_changed(roomname)
+    room_changed(newname)
+    return roomname
 
 
 def update_user(username, newname):
     """
-    Updates a user in the user database.
+    Renames a user in the user database with one atomic update, like
+    update_room.
+    Returns the old name, NOT_FOUND, or DUPLICATE.
     """
-    users = get_users_as_dict()
-    found = False
-    if users is None:
+    try:
+        user = db.fetch_and_update(USERS, {USER_NM: username},
+                                   {"$set": {USER_NM: newname}}, {ID: 1})
+    except DuplicateKeyError:
+        return DUPLICATE
+    if user is None:
         return NOT_FOUND
-    else:
-        for user in users:
-            if users[user][USER_NM] == username:
-                ob_id = users[user][ID]
-                found = True
-        if not found:
-            return NOT_FOUND
-        else:
-            db.update_doc(USERS, {ID : ob_id}, { "$set" : {USER_NM: newname}})
-            return users[username][USER_NM]
+    users_changed()
+    return username
+
+
+def expire_idle_rooms(idle_secs = ROOM_IDLE_SECS):
+    """
+    Closes every room that has had no activity for idle_secs seconds,
+    along with its messages and the users that aren't in any other room.
+    Everything is done with a handful of bulk operations on indexed
+    fields, however many rooms have expired.
+    Rooms with no recorded activity (e.g. loaded by mongo_port) are
+    stamped with the time of the sweep that finds them, so they close
+    one idle period later instead of never.
+    Returns the number of rooms closed.
+    """
+    if db.update_docs(ROOMS, {LAST_ACTIVITY: {"$exists": False}},
+                      {"$set": {LAST_ACTIVITY: now()}}):
+        room_changed()
+    cutoff = now() - timedelta(seconds=idle_secs)
+    idle = {LAST_ACTIVITY: {"$lt": cutoff}}
+    rooms = db.fetch_docs(ROOMS, idle, {USERS_LIST: 1})
+    if not rooms:
+        return 0
+    # a room that became active since we looked is left alone.
+    ids = [room[ID] for room in rooms]
+    closed = db.delete_docs(ROOMS, {**idle, ID: {"$in": ids}})
+    room_changed()
+    if closed < len(ids):
+        survivors = db.distinct(ROOMS, ID, {ID: {"$in": ids}})
+        ids = [ob_id for ob_id in ids if ob_id not in survivors]
+    db.delete_docs(MESSAGES, {ROOM_ID: {"$in": ids}})
+    for ob_id in ids:
+        names.forget(ob_id)
+        events.publish(ob_id, events.CLOSED)
+    users = {user for room in rooms for user in room.get(USERS_LIST, [])}
+    if users:
+        still_in_room = db.distinct(ROOMS, USERS_LIST,
+                                    {USERS_LIST: {"$in": list(users)}})
+        db.delete_docs(USERS,
+                       {USER_NM: {"$in": list(users - set(still_in_room))}})
+        users_changed()
+    return closed
+
+
+def reserve_seqs(num_messages):
+    """
+    Returns the update that hands out num_messages sequence numbers from
+    a room's counter.
+    """
+    return {"$inc": {MSG_SEQ: num_messages},
+            "$set": {LAST_ACTIVITY: now()}}
+
+
+def new_messages(last_seq, username, texts):
+    """
+    Returns the messages for texts, numbered up to last_seq.
+    """
+    sent_at = now()
+    first = last_seq - len(texts) + 1
+    return [{SEQ: first + i, USER_NM: username, TEXT: text, SENT_AT: sent_at}
+            for i, text in enumerate(texts)]
+
+
+def message_docs(ob_id, messages):
+    """
+    Returns the message log documents for a room's new messages.
+    """
+    return [{ROOM_ID: ob_id, **message} for message in messages]
+
+
+def messages_added(ob_id, roomname, messages):
+    """
+    Tells everyone in a room about its new messages, once they're in the
+    log, and drops the cached listings, which show the room's sequence
+    number and last activity. Returns their sequence numbers.
+    """
+    room_changed(roomname)
+    for message in messages:
+        events.publish(ob_id, events.MESSAGE, message)
+    return [message[SEQ] for message in messages]
+
+
+def add_outcome(room):
+    """
+    Returns why messages couldn't be added to a room, given the room (id
+    only) as read afterwards: NOT_FOUND if there's no such room, else
+    NOT_ACCEPTABLE, as the user isn't in it.
+    """
+    if room is None:
+        return NOT_FOUND
+    return NOT_ACCEPTABLE
+
+
+def add_messages(roomcode, username, texts):
+    """
+    Appends a batch of messages from username to a room's message log.
+    The room hands out a block of sequence numbers with one atomic
+    update, then the whole batch is written with one insert; readers
+    don't get past those numbers until it is (see written_messages).
+    Returns the sequence numbers given to the messages, NOT_FOUND if the
+    room doesn't exist, or NOT_ACCEPTABLE if the user isn't in it.
+    """
+    ob_id = room_object_id(roomcode)
+    if ob_id is None:
+        return NOT_FOUND
+    if not texts:
+        return []
+    room = db.fetch_and_update(ROOMS, {ID: ob_id, USERS_LIST: username},
+                               reserve_seqs(len(texts)),
+                               {MSG_SEQ: 1, ROOM_NM: 1})
+    if room is None:
+        return add_outcome(db.fetch_doc(ROOMS, {ID: ob_id}, {ID: 1}))
+    messages = new_messages(room[MSG_SEQ], username, texts)
+    db.insert_docs(MESSAGES, message_docs(ob_id, messages))
+    return messages_added(ob_id, room[ROOM_NM], messages)
+
+
+def add_message(roomcode, username, text):
+    """
+    Appends one message from username to a room's message log.
+    Returns its sequence number, or an error code like add_messages.
+    """
+    ret = add_messages(roomcode, username, [text])
+    if isinstance(ret, list):
+        return ret[0]
+    return ret
+
+
+def get_messages(roomcode, after = 0, limit = MESSAGE_LIMIT):
+    """
+    Returns up to limit of a room's messages with sequence numbers
+    greater than after, oldest first, so clients only fetch what they
+    haven't seen. One indexed read on (room_id, seq).
+    They stop short of any message still being written (see
+    written_messages), so the last one is always safe to fetch after.
+    Returns None if roomcode is malformed; an unknown room has no
+    messages.
+    """
+    ob_id = room_object_id(roomcode)
+    if ob_id is None:
+        return None
+    limit = max(1, min(limit, MAX_MESSAGE_LIMIT))
+    return written_messages(
+        list(db.iter_docs(MESSAGES, {ROOM_ID: ob_id, SEQ: {"$gt": after}},
+                          {ID: 0, ROOM_ID: 0}, limit=limit, sort_key=SEQ,
+                          raw=True)), after)
+
+
+def written_messages(messages, after):
+    """
+    Returns messages, read from a log in order after sequence number
+    after, up to the first gap in their numbers. add_messages reserves
+    numbers before writing the messages, so a concurrent sender's later
+    messages can be in the log before its earlier ones; a reader that
+    went past the gap would never see them.
+    A gap after which messages were sent more than MESSAGE_WRITE_SECS
+    ago is a write that failed, and is passed over.
+    """
+    for i, message in enumerate(messages):
+        if message[SEQ] != after + 1:
+            sent_at = message[SENT_AT]
+            if sent_at.tzinfo is None:
+                # the database may hand back UTC times without a zone.
+                sent_at = sent_at.replace(tzinfo=timezone.utc)
+            if now() - sent_at < timedelta(seconds=MESSAGE_WRITE_SECS):
+                return messages[:i]
+        after = message[SEQ]
+    return messages
+
+
+def iter_messages(roomcode, after = 0):
+    """
+    Yields all of a room's messages after sequence number after, oldest
+    first, reading them a page of MAX_MESSAGE_LIMIT at a time.
+    """
+    while True:
+        page = get_messages(roomcode, after, MAX_MESSAGE_LIMIT) or []
+        yield from page
+        if len(page) < MAX_MESSAGE_LIMIT:
+            return
+        after = page[-1][SEQ]
@@ -1,12 +1,18 @@
 """
 This file contains some common MongoDB code.
+Every operation goes through a storage backend: MongoDB by default, or an
+in-memory engine when DB_BACKEND=memory.
 """
 import os
+import threading
+import time
 import pymongo as pm
-import json
-import bson.json_util as bsutil
+from pymongo import monitoring
 from bson import ObjectId
 
+from db import codec, trace
+from db.backends import MongoBackend
+
 
 # all of these will eventually be put in the env:
 user_nm = "oabouelnour"
@@ -17,74 +23,324 @@ db_params = "retryWrites=true&w=majority"
 db_nm = "chatDB"
 test_db = "testDB"
 
+ID = "_id"
+# how many documents the server sends per round-trip when we iterate:
+BATCH_SIZE = int(os.environ.get("MONGO_BATCH_SIZE", 500))
+# how many documents sample_docs draws for each one it may return:
+SAMPLE_FACTOR = 4
+
+# a full connection string (e.g. mongodb://localhost:27017) overrides Atlas:
+mongo_uri = os.environ.get("MONGO_URI", '')
+pool_size = int(os.environ.get("MONGO_POOL_SIZE", 100))
+timeout_ms = int(os.environ.get("MONGO_TIMEOUT_MS", 5000))
+
+MONGO = "mongo"
+MEMORY = "memory"
+backend_nm = os.environ.get("DB_BACKEND", MONGO)
+
+backend = None
+backend_lock = threading.Lock()
 client = None
+client_pid = None
+client_lock = threading.Lock()
+connect_hooks = []
 test = True
 
 if test:
-    database_name = test_db
+    database_name = os.environ.get("MONGO_DB", test_db)
 else:
-    database_name = db_nm
+    database_name = os.environ.get("MONGO_DB", db_nm)
+
+
+def get_uri():
+    """
+    Returns the connection string for our database.
+    """
+    if mongo_uri:
+        return mongo_uri
+    return (f"{cloud_mdb}://{user_nm}:{passwd}@{cloud_svc}/{database_name}?"
+            + db_params)
+
+
+def on_connect(hook):
+    """
+    Registers hook to be called when the storage backend is set up,
+    e.g. to make sure indexes exist.
+    """
+    connect_hooks.append(hook)
+    return hook
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Keeps count of the connections in our pools and how many are in use.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Starts counting afresh, e.g. for a new client after a fork.
+        """
+        self.open = 0
+        self.checked_out = 0
+        self.check_out_failures = 0
+
+    def connection_created(self, event):
+        self.open += 1
+
+    def connection_closed(self, event):
+        self.open -= 1
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def connection_check_out_failed(self, event):
+        self.check_out_failures += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+
+pool_monitor = PoolMonitor()
 
 
 def get_client():
     """
     This provides a uniform way to get the client across all uses.
-    Returns a mongo client object... maybe we shouldn't?
-    Also set global client variable.
-    """
-    global client
-    if test:
-        print("Connecting to testDB.")
-        client = pm.MongoClient(f"mongodb+srv://oabouelnour:{passwd}@"
-                                + f"{cloud_svc}/{test_db}?"
-                                + db_params)
-    else:
-        print("Connecting to chatDB.")
-        client = pm.MongoClient(f"mongodb+srv://oabouelnour:{passwd}@"
-                                + f"{cloud_svc}/{db_nm}?"
-                                + db_params)
+    The client is only created on first use, and once per process: a
+    process forked after the client was made gets a fresh one, since
+    pymongo clients must not be shared across a fork. Its connection pool
+    is then reused by every request the process serves.
+    """
+    global client, client_pid
+    if client is not None and client_pid == os.getpid():
+        return client
+    with client_lock:
+        if client is not None and client_pid == os.getpid():
+            return client
+        pool_monitor.reset()
+        client = pm.MongoClient(get_uri(),
+                                maxPoolSize=pool_size,
+                                connectTimeoutMS=timeout_ms,
+                                serverSelectionTimeoutMS=timeout_ms,
+                                event_listeners=[pool_monitor],
+                                connect=False)
+        client_pid = os.getpid()
     return client
 
 
-def fetch_doc(collect_nm, filters = {}):
+def get_collection(collect_nm):
+    """
+    Returns the collection called collect_nm in our database.
+    """
+    return get_client()[database_name][collect_nm]
+
+
+def examined(collect_nm, filters):
+    """
+    Asks the backend how many documents it examines for filters; trace
+    calls this when a budget needs to know.
+    """
+    return get_backend().examined(collect_nm, filters)
+
+
+trace.explain = examined
+
+
+def get_backend():
+    """
+    Returns the storage backend picked by DB_BACKEND, creating it on first
+    use and running the on_connect hooks for it.
+    """
+    global backend
+    if backend is not None:
+        return backend
+    with backend_lock:
+        if backend is not None:
+            return backend
+        if backend_nm == MEMORY:
+            # only imported when it is used, to keep our imports light:
+            from db.memory_backend import MemoryBackend
+            new_backend = MemoryBackend()
+        else:
+            new_backend = MongoBackend(get_collection)
+        backend = new_backend
+    try:
+        for hook in connect_hooks:
+            hook()
+    except Exception:
+        # a backend that isn't set up isn't used: the next call retries.
+        backend = None
+        raise
+    return backend
+
+
+def create_index(collect_nm, keys, unique = False):
+    """
+    Creates an index on collection if it does not already exist.
+    Raises RuntimeError if a unique index can't be built because
+    documents already share a key: our duplicate checks rely on unique
+    indexes, so we won't run without them. The duplicates have to be
+    removed first.
+    """
+    try:
+        return get_backend().create_index(collect_nm, keys, unique)
+    except pm.errors.DuplicateKeyError as err:
+        # not a DuplicateKeyError, which callers take for a taken name:
+        raise RuntimeError(f"Duplicates in {collect_nm} stop a unique "
+                           f"{keys} index being built: {err}") from err
+
+
+def fetch_doc(collect_nm, filters = {}, projection = None):
     """
     Fetch one document that meets filters.
+    Only the fields in projection are returned if it is given.
+    """
+    started = time.perf_counter()
+    doc = get_backend().fetch_doc(collect_nm, filters, projection)
+    trace.record(collect_nm, "fetch_doc", filters, int(doc is not None),
+                 started)
+    return doc
+
+
+def fetch_docs(collect_nm, filters = {}, projection = None):
+    """
+    Returns every document that meets filters as a list.
+    """
+    started = time.perf_counter()
+    docs = get_backend().fetch_docs(collect_nm, filters, projection)
+    trace.record(collect_nm, "fetch_docs", filters, len(docs), started)
+    return docs
+
+
+def distinct(collect_nm, key_nm, filters = {}):
+    """
+    Returns the distinct values of key_nm among documents that meet filters.
+    """
+    started = time.perf_counter()
+    values = get_backend().distinct(collect_nm, key_nm, filters)
+    trace.record(collect_nm, "distinct", filters, len(values), started)
+    return values
+
+
+def sample_docs(collect_nm, filters = {}, size = 1, projection = None):
+    """
+    Returns a list of up to size random documents that meet filters.
+    The server draws SAMPLE_FACTOR times size random documents and only
+    then filters them: with $sample first it picks them straight from
+    storage, so the cost doesn't grow with the collection. The price is
+    that fewer than size documents, or none, may come back even though
+    more meet filters.
+    """
+    pipeline = [{"$sample": {"size": size * SAMPLE_FACTOR}},
+                {"$match": filters}, {"$limit": size}]
+    if projection:
+        pipeline.append({"$project": projection})
+    return aggregate(collect_nm, pipeline)
+
+
+def aggregate(collect_nm, pipeline = []):
+    """
+    Runs an aggregation pipeline on collection.
+    Returns the resulting documents as a list.
     """
-    return client[database_name][collect_nm].find_one(filters)
+    started = time.perf_counter()
+    docs = get_backend().aggregate(collect_nm, pipeline)
+    first_match = pipeline[0].get("$match", {}) if pipeline else {}
+    trace.record(collect_nm, "aggregate", first_match, len(docs), started)
+    return docs
 
 
 def delete_doc(collect_nm, filters = {}):
     """
     Deletes one document from collection.
+    Returns the number of documents deleted.
     """
-    return client[database_name][collect_nm].delete_one(filters)
+    started = time.perf_counter()
+    deleted = get_backend().delete_doc(collect_nm, filters)
+    trace.record(collect_nm, "delete_doc", filters, deleted, started)
+    return deleted
 
 
-def fetch_all(collect_nm, key_nm):
+def iter_docs(collect_nm, filters = {}, projection = None,
+              batch_size = BATCH_SIZE, limit = 0, sort_key = ID,
+              raw = False):
     """
-    Returns all documents as a list.
+    Yields documents that meet filters one at a time, in sort_key order
+    (_id by default), as JSON-ready dictionaries.
+    With raw they keep the BSON types the database gives them, for
+    callers that only encode them with codec.dumps or pass them back to
+    the database, which saves turning each one into JSON types first.
+    The server sends them batch_size at a time, so memory use doesn't
+    grow with the size of the collection. A limit of 0 means no limit.
     """
-    all_docs = []
-    for doc in client[database_name][collect_nm].find():
-        # print(doc)
-        all_docs.append(json.loads(bsutil.dumps(doc)))
-    return all_docs
+    started = time.perf_counter()
+    count = 0
+    try:
+        for doc in get_backend().iter_docs(collect_nm, filters, projection,
+                                           batch_size, limit, sort_key):
+            count += 1
+            yield doc if raw else codec.json_ready(doc)
+    finally:
+        trace.record(collect_nm, "iter_docs", filters, count, started)
+
+
+def delete_docs(collect_nm, filters = {}):
+    """
+    Deletes every document that meets filters.
+    Returns the number of documents deleted.
+    """
+    started = time.perf_counter()
+    deleted = get_backend().delete_docs(collect_nm, filters)
+    trace.record(collect_nm, "delete_docs", filters, deleted, started)
+    return deleted
+
+
+def fetch_all(collect_nm, key_nm, raw = False):
+    """
+    Returns all documents as a list; raw is as for iter_docs.
+    """
+    return list(iter_docs(collect_nm, raw=raw))
 
 
 def fetch_all_as_dict(collect_nm, key_nm):
     """
     Returns all documents as a dictionary.
     """
-    all_docs = []
-    for doc in client[database_name][collect_nm].find():
-        all_docs.append(doc)
+    started = time.perf_counter()
     all_dict = {}
-    for doc in all_docs:
-        # print(f'{doc=}')
+    for doc in get_backend().iter_docs(collect_nm, {}):
         all_dict[doc[key_nm]] = doc
+    trace.record(collect_nm, "fetch_all_as_dict", {}, len(all_dict), started)
     return all_dict
 
 
+def watch(collect_nm, full_document = None):
+    """
+    Opens a change stream on collection.
+    """
+    return get_backend().watch(collect_nm, full_document)
+
+
 def create_object_id(ob_id):
     """
     Returns an object_id object
@@ -96,11 +352,71 @@ def insert_doc(collect_nm, doc):
     """
     Inserts a document into collection.
     """
-    client[database_name][collect_nm].insert_one(doc)
+    started = time.perf_counter()
+    inserted = 0
+    try:
+        get_backend().insert_doc(collect_nm, doc)
+        inserted = 1
+    finally:
+        # duplicates are rejected by the server, so they cost a trip too.
+        trace.record(collect_nm, "insert_doc", {}, inserted, started)
+
+
+def insert_docs(collect_nm, docs, ordered = True):
+    """
+    Inserts many documents into collection in one round-trip.
+    Returns the positions in docs of the ones rejected as duplicates.
+    """
+    started = time.perf_counter()
+    duplicates = get_backend().insert_docs(collect_nm, docs, ordered)
+    trace.record(collect_nm, "insert_docs", {}, len(docs) - len(duplicates),
+                 started)
+    return duplicates
+
+
+def upsert_docs(collect_nm, key_nm, docs):
+    """
+    Writes many documents in one round-trip, replacing the ones whose
+    key_nm value is already in the collection.
+    Returns the number of documents that were new.
+    """
+    started = time.perf_counter()
+    inserted = get_backend().upsert_docs(collect_nm, key_nm, docs)
+    trace.record(collect_nm, "upsert_docs", {}, len(docs), started)
+    return inserted
+
+
+def fetch_and_update(collect_nm, filters = {}, update_string = {},
+                     projection = None):
+    """
+    Atomically updates one document that meets filters.
+    Returns the updated document, or None if nothing matched.
+    """
+    started = time.perf_counter()
+    doc = get_backend().fetch_and_update(collect_nm, filters,
+                                         update_string, projection)
+    trace.record(collect_nm, "fetch_and_update", filters,
+                 int(doc is not None), started)
+    return doc
 
 
 def update_doc(collect_nm, filters = {}, update_string = {}):
     """
-    Inserts a document into collection.
+    Updates one document that meets filters.
+    Returns the number of documents matched.
+    """
+    started = time.perf_counter()
+    matched = get_backend().update_doc(collect_nm, filters, update_string)
+    trace.record(collect_nm, "update_doc", filters, matched, started)
+    return matched
+
+
+def update_docs(collect_nm, filters = {}, update_string = {}):
+    """
+    Updates every document that meets filters.
+    Returns the number of documents matched.
     """
-    client[database_name][collect_nm].update_one(filters, update_string)
+    started = time.perf_counter()
+    matched = get_backend().update_docs(collect_nm, filters, update_string)
+    trace.record(collect_nm, "update_docs", filters, matched, started)
+    return matched
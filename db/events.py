@@ -0,0 +1,155 @@
+"""
+This file fans room events (new messages, joins, leaves and closures) out
+to the clients listening on a room, within this process.
+A write publishes its event once; every subscriber of the room gets it on
+its own queue, so reaching them takes no database reads:
+    sub = events.subscribe(room_id)
+    event = sub.get(timeout=15)
+"""
+
+import asyncio
+import queue
+import threading
+
+# event types:
+MESSAGE = "message"
+JOIN = "join"
+LEAVE = "leave"
+CLOSED = "closed"
+
+TYPE = "type"
+ROOM = "room"
+DATA = "data"
+
+# events a slow subscriber can fall behind by before it is cut off:
+QUEUE_SIZE = 1000
+
+lock = threading.Lock()
+# room id -> the subscriptions listening on it:
+subscribers = {}
+
+# called with every event published in this process (e.g. to pass it on
+# to other workers):
+listeners = []
+
+
+class Subscription:
+    """
+    One client's queue of events for one room.
+    A subscriber that lets its queue fill up is marked as dropped rather
+    than slowing down the writers; it should reconnect and catch up from
+    the message log.
+    """
+    def __init__(self, room_id, size=QUEUE_SIZE):
+        self.room_id = str(room_id)
+        self.queue = queue.Queue(size)
+        self.dropped = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped = True
+
+    def get(self, timeout=None):
+        """
+        Returns the next event, or None if none came within timeout
+        seconds.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncSubscription(Subscription):
+    """
+    A subscription read from an asyncio event loop. Events published from
+    other threads are handed over to the loop, so waiting for one doesn't
+    hold a thread.
+    """
+    def __init__(self, room_id, loop, size=QUEUE_SIZE):
+        self.room_id = str(room_id)
+        self.loop = loop
+        self.queue = asyncio.Queue(size)
+        self.dropped = False
+
+    def put(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # the loop is gone.
+            self.dropped = True
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped = True
+
+    async def get(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def _add(sub):
+    with lock:
+        subscribers.setdefault(sub.room_id, set()).add(sub)
+    return sub
+
+
+def subscribe(room_id):
+    """
+    Starts listening on a room's events.
+    """
+    return _add(Subscription(room_id))
+
+
+def subscribe_async(room_id):
+    """
+    Starts listening on a room's events from the running event loop.
+    """
+    return _add(AsyncSubscription(room_id, asyncio.get_running_loop()))
+
+
+def unsubscribe(sub):
+    """
+    Stops listening; safe to call more than once.
+    """
+    with lock:
+        room_subs = subscribers.get(sub.room_id)
+        if room_subs is not None:
+            room_subs.discard(sub)
+            if not room_subs:
+                del subscribers[sub.room_id]
+
+
+def num_subscribers():
+    """
+    Returns how many subscriptions are open in this process.
+    """
+    with lock:
+        return sum(len(room_subs) for room_subs in subscribers.values())
+
+
+def deliver(event):
+    """
+    Hands event to every subscriber of its room in this process.
+    """
+    with lock:
+        room_subs = list(subscribers.get(event[ROOM], ()))
+    for sub in room_subs:
+        sub.put(event)
+
+
+def publish(room_id, kind, data=None):
+    """
+    Sends an event of type kind about a room to everyone listening.
+    """
+    event = {TYPE: kind, ROOM: str(room_id), DATA: data}
+    deliver(event)
+    for listener in listeners:
+        listener(event)
+    return event
@@ -0,0 +1,580 @@
+"""
+This file contains an in-memory storage engine with the same behaviour as
+our MongoDB backend, for tests and for single-process deployments that
+don't need Mongo.
+Data lives in the process: it is lost on restart and is not shared
+between gunicorn workers.
+It understands the subset of MongoDB's query, update and aggregation
+language that db.data uses.
+"""
+
+import copy
+import random
+import threading
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from db import trace
+from db.backends import Backend, Unsupported
+
+ID = "_id"
+DUP_KEY_CODE = 11000
+
+# stands in for a field a document doesn't have:
+MISSING = object()
+
+
+def get_field(doc, field):
+    """
+    Returns doc's value for a (possibly dotted) field name, or MISSING.
+    """
+    value = doc
+    for part in field.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def _equals(value, target):
+    """
+    Mongo equality: an array field matches if any element does.
+    """
+    if value is MISSING:
+        return target is None
+    if isinstance(value, list) and not isinstance(target, list):
+        return target in value
+    return value == target
+
+
+def _compare(value, target, test):
+    """
+    Mongo range comparison: an array field matches if any element does.
+    Values of different types never match.
+    """
+    values = value if isinstance(value, list) else [value]
+    for val in values:
+        if val is MISSING:
+            continue
+        try:
+            if test(val, target):
+                return True
+        except TypeError:
+            pass
+    return False
+
+
+OPERATORS = {
+    "$eq": lambda value, target: _equals(value, target),
+    "$ne": lambda value, target: not _equals(value, target),
+    "$lt": lambda value, target: _compare(value, target,
+                                          lambda a, b: a < b),
+    "$lte": lambda value, target: _compare(value, target,
+                                           lambda a, b: a <= b),
+    "$gt": lambda value, target: _compare(value, target,
+                                          lambda a, b: a > b),
+    "$gte": lambda value, target: _compare(value, target,
+                                           lambda a, b: a >= b),
+    "$in": lambda value, target: any(_equals(value, t) for t in target),
+    "$nin": lambda value, target: not any(_equals(value, t)
+                                          for t in target),
+    "$exists": lambda value, target: (value is not MISSING) == target,
+}
+
+
+def _is_operator_dict(cond):
+    return (isinstance(cond, dict) and len(cond) > 0
+            and all(key.startswith("$") for key in cond))
+
+
+def matches(doc, filters):
+    """
+    Checks whether doc meets filters.
+    """
+    for key, cond in filters.items():
+        if key == "$and":
+            if not all(matches(doc, sub) for sub in cond):
+                return False
+        elif key == "$or":
+            if not any(matches(doc, sub) for sub in cond):
+                return False
+        elif _is_operator_dict(cond):
+            value = get_field(doc, key)
+            for op, target in cond.items():
+                if not OPERATORS[op](value, target):
+                    return False
+        elif not _equals(get_field(doc, key), cond):
+            return False
+    return True
+
+
+def _each(value):
+    """
+    Unwraps the {"$each": [...]} form of $push and $addToSet.
+    """
+    if isinstance(value, dict) and "$each" in value:
+        return value["$each"]
+    return [value]
+
+
+def apply_update(doc, update_string, inserting=False):
+    """
+    Applies a Mongo update string to doc in place.
+    """
+    for op, fields in update_string.items():
+        for field, value in fields.items():
+            if op == "$set":
+                doc[field] = copy.deepcopy(value)
+            elif op == "$setOnInsert":
+                if inserting:
+                    doc[field] = copy.deepcopy(value)
+            elif op == "$unset":
+                doc.pop(field, None)
+            elif op == "$inc":
+                doc[field] = doc.get(field, 0) + value
+            elif op == "$max":
+                if field not in doc or doc[field] < value:
+                    doc[field] = value
+            elif op == "$min":
+                if field not in doc or doc[field] > value:
+                    doc[field] = value
+            elif op == "$push":
+                doc.setdefault(field, []).extend(_each(value))
+            elif op == "$addToSet":
+                lst = doc.setdefault(field, [])
+                for item in _each(value):
+                    if item not in lst:
+                        lst.append(item)
+            elif op == "$pull":
+                lst = doc.get(field, [])
+                if _is_operator_dict(value):
+                    doc[field] = [item for item in lst
+                                  if not matches({field: item},
+                                                 {field: value})]
+                else:
+                    doc[field] = [item for item in lst if item != value]
+            else:
+                raise ValueError(f"Unsupported update operator {op}")
+
+
+def project(doc, projection):
+    """
+    Returns a copy of doc holding only the fields projection asks for.
+    """
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    include = {field for field, keep in projection.items()
+               if keep and field != ID}
+    if include:
+        ret = {field: doc[field] for field in include if field in doc}
+        if projection.get(ID, 1) and ID in doc:
+            ret[ID] = doc[ID]
+        return ret
+    for field, keep in projection.items():
+        if not keep:
+            doc.pop(field, None)
+    return doc
+
+
+def evaluate(doc, expr):
+    """
+    Evaluates an aggregation expression against doc.
+    """
+    if isinstance(expr, str) and expr.startswith("$"):
+        value = get_field(doc, expr[1:])
+        return None if value is MISSING else value
+    if isinstance(expr, list):
+        return [evaluate(doc, item) for item in expr]
+    if _is_operator_dict(expr):
+        (op, args), = expr.items()
+        if op == "$size":
+            return len(evaluate(doc, args) or [])
+        if op == "$setIntersection":
+            first, *rest = [evaluate(doc, arg) or [] for arg in args]
+            return [item for item in dict.fromkeys(first)
+                    if all(item in other for other in rest)]
+        if op == "$literal":
+            return args
+        raise ValueError(f"Unsupported expression operator {op}")
+    return expr
+
+
+def _sort_key(value):
+    """
+    Orders missing and null values first, like Mongo does.
+    """
+    if value is MISSING or value is None:
+        return (0, 0)
+    return (1, value)
+
+
+def sort_docs(docs, sort_spec):
+    """
+    Sorts docs by a Mongo sort specification.
+    """
+    for field, direction in reversed(list(sort_spec.items())):
+        docs.sort(key=lambda doc: _sort_key(get_field(doc, field)),
+                  reverse=direction < 0)
+    return docs
+
+
+class Index:
+    """
+    Maps the values of one or more fields to the ids of the documents
+    holding them. Single-field indexes on arrays index every element.
+    """
+    def __init__(self, fields, unique):
+        self.fields = fields
+        self.unique = unique
+        self.entries = {}
+        # documents without the indexed field, which aren't in entries:
+        self.missing = 0
+
+    def keys_for(self, doc):
+        if len(self.fields) == 1:
+            value = get_field(doc, self.fields[0])
+            if value is MISSING:
+                return []
+            values = value if isinstance(value, list) else [value]
+            return [(self._hashable(val),) for val in values]
+        return [tuple(self._hashable(get_field(doc, field))
+                      for field in self.fields)]
+
+    @staticmethod
+    def _hashable(value):
+        if value is MISSING:
+            return None
+        if isinstance(value, (list, dict)):
+            return repr(value)
+        return value
+
+    def key_for_filters(self, filters):
+        """
+        Returns the index key selected by equality filters, or None if
+        the filters don't pin every indexed field to one value.
+        """
+        key = []
+        for field in self.fields:
+            cond = filters.get(field, MISSING)
+            if isinstance(cond, dict) and list(cond) == ["$eq"]:
+                cond = cond["$eq"]
+            if cond is MISSING or isinstance(cond, (dict, list)):
+                return None
+            key.append(cond)
+        return tuple(key)
+
+    def check(self, doc):
+        if not self.unique:
+            return
+        for key in self.keys_for(doc):
+            holders = self.entries.get(key, set()) - {doc[ID]}
+            if holders:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error: {self.fields} {key}",
+                    DUP_KEY_CODE)
+
+    def add(self, doc):
+        keys = self.keys_for(doc)
+        if not keys:
+            self.missing += 1
+        for key in keys:
+            self.entries.setdefault(key, set()).add(doc[ID])
+
+    def remove(self, doc):
+        keys = self.keys_for(doc)
+        if not keys:
+            self.missing -= 1
+        for key in keys:
+            ids = self.entries.get(key)
+            if ids is not None:
+                ids.discard(doc[ID])
+                if not ids:
+                    del self.entries[key]
+
+
+class Collection:
+    """
+    The documents of one collection, keyed by _id, and their indexes.
+    """
+    def __init__(self):
+        self.docs = {}
+        self.indexes = {}
+
+    def candidates(self, filters):
+        """
+        Returns the documents that could meet filters, using an index
+        when the filters allow it.
+        """
+        id_cond = filters.get(ID, MISSING)
+        if id_cond is not MISSING and not isinstance(id_cond, dict):
+            doc = self.docs.get(id_cond)
+            return [] if doc is None else [doc]
+        for index in self.indexes.values():
+            key = index.key_for_filters(filters)
+            if key is not None:
+                ids = index.entries.get(key, ())
+                return [self.docs[ob_id] for ob_id in ids]
+        return list(self.docs.values())
+
+    def find(self, filters):
+        candidates = self.candidates(filters)
+        trace.add_scanned(len(candidates))
+        return [doc for doc in candidates if matches(doc, filters)]
+
+    def find_sorted(self, filters, sort_key, limit):
+        """
+        Returns the first limit documents that meet filters in sort_key
+        order. An index on sort_key is walked in order when there is one,
+        so only the documents up to the limit are looked at.
+        """
+        index = self.indexes.get(sort_key)
+        if (index is None or index.missing or not limit
+                or self._pinned(filters)):
+            docs = sort_docs(self.find(filters), {sort_key: 1})
+            return docs[:limit] if limit else docs
+        found = []
+        seen = set()
+        try:
+            for key in sorted(index.entries,
+                              key=lambda key: _sort_key(key[0])):
+                # like Mongo, ties come back in no particular order.
+                for ob_id in index.entries[key]:
+                    if ob_id in seen:
+                        continue
+                    seen.add(ob_id)
+                    doc = self.docs[ob_id]
+                    if not matches(doc, filters):
+                        continue
+                    found.append(doc)
+                    if len(found) == limit:
+                        return found
+            return found
+        finally:
+            trace.add_scanned(len(seen))
+
+    def _pinned(self, filters):
+        """
+        Checks whether filters select documents by _id or an index key,
+        which is cheaper than walking the sort index.
+        """
+        id_cond = filters.get(ID, MISSING)
+        if id_cond is not MISSING and not isinstance(id_cond, dict):
+            return True
+        return any(index.key_for_filters(filters) is not None
+                   for index in self.indexes.values())
+
+    def insert(self, doc):
+        for index in self.indexes.values():
+            index.check(doc)
+        self.docs[doc[ID]] = doc
+        for index in self.indexes.values():
+            index.add(doc)
+
+    def replace(self, old, new):
+        for index in self.indexes.values():
+            index.check(new)
+        for index in self.indexes.values():
+            index.remove(old)
+            index.add(new)
+        self.docs[new[ID]] = new
+
+    def delete(self, doc):
+        for index in self.indexes.values():
+            index.remove(doc)
+        del self.docs[doc[ID]]
+
+
+class MemoryBackend(Backend):
+    """
+    Keeps every collection in dictionaries, indexed like the Mongo ones.
+    All operations take one lock, so each is atomic.
+    """
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.RLock()
+
+    def _collection(self, collect_nm):
+        if collect_nm not in self.collections:
+            self.collections[collect_nm] = Collection()
+        return self.collections[collect_nm]
+
+    def create_index(self, collect_nm, keys, unique=False):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        fields = tuple(field for field, direction in keys)
+        name = "_".join(fields)
+        with self.lock:
+            collection = self._collection(collect_nm)
+            if name not in collection.indexes:
+                index = Index(fields, unique)
+                for doc in collection.docs.values():
+                    index.check(doc)
+                    index.add(doc)
+                collection.indexes[name] = index
+        return name
+
+    def fetch_doc(self, collect_nm, filters, projection=None):
+        with self.lock:
+            for doc in self._collection(collect_nm).find(filters):
+                return project(doc, projection)
+        return None
+
+    def fetch_docs(self, collect_nm, filters, projection=None):
+        with self.lock:
+            return [project(doc, projection)
+                    for doc in self._collection(collect_nm).find(filters)]
+
+    def iter_docs(self, collect_nm, filters, projection=None,
+                  batch_size=0, limit=0, sort_key=ID):
+        with self.lock:
+            docs = self._collection(collect_nm).find_sorted(filters,
+                                                            sort_key, limit)
+            docs = [project(doc, projection) for doc in docs]
+        return iter(docs)
+
+    def distinct(self, collect_nm, key_nm, filters):
+        values = []
+        with self.lock:
+            for doc in self._collection(collect_nm).find(filters):
+                value = get_field(doc, key_nm)
+                if value is MISSING:
+                    continue
+                for val in value if isinstance(value, list) else [value]:
+                    if val not in values:
+                        values.append(val)
+        return values
+
+    def aggregate(self, collect_nm, pipeline):
+        pipeline = list(pipeline)
+        with self.lock:
+            collection = self._collection(collect_nm)
+            if pipeline and "$match" in pipeline[0]:
+                # the first $match can use our indexes.
+                docs = collection.find(pipeline.pop(0)["$match"])
+            else:
+                docs = list(collection.docs.values())
+                trace.add_scanned(len(docs))
+            # no stage changes the documents it is given, so we only copy
+            # the ones we hand back.
+            docs = self._run_pipeline(docs, pipeline)
+            return [copy.deepcopy(doc) for doc in docs]
+
+    def _run_pipeline(self, docs, pipeline):
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if op == "$match":
+                docs = [doc for doc in docs if matches(doc, arg)]
+            elif op == "$sample":
+                docs = random.sample(docs, min(arg["size"], len(docs)))
+            elif op == "$sort":
+                docs = sort_docs(docs, arg)
+            elif op == "$limit":
+                docs = docs[:arg]
+            elif op == "$skip":
+                docs = docs[arg:]
+            elif op in ("$project", "$addFields"):
+                docs = [self._reshape(doc, arg, op == "$project")
+                        for doc in docs]
+            else:
+                raise ValueError(f"Unsupported aggregation stage {op}")
+        return docs
+
+    @staticmethod
+    def _reshape(doc, spec, projecting):
+        """
+        Runs a $project or $addFields stage on one document.
+        """
+        flags = (0, 1, True, False)
+        if not projecting:
+            ret = dict(doc)
+        elif all(keep in (0, False) for keep in spec.values()):
+            return project(doc, spec)
+        else:
+            ret = {ID: doc[ID]} if spec.get(ID, 1) and ID in doc else {}
+            for field, keep in spec.items():
+                if keep in (1, True) and field in doc:
+                    ret[field] = doc[field]
+        for field, expr in spec.items():
+            if not (projecting and expr in flags):
+                ret[field] = evaluate(doc, expr)
+        return ret
+
+    def insert_doc(self, collect_nm, doc):
+        with self.lock:
+            if ID not in doc:
+                doc[ID] = ObjectId()
+            self._collection(collect_nm).insert(copy.deepcopy(doc))
+
+    def insert_docs(self, collect_nm, docs, ordered=True):
+        duplicates = []
+        with self.lock:
+            for i, doc in enumerate(docs):
+                try:
+                    self.insert_doc(collect_nm, doc)
+                except DuplicateKeyError:
+                    duplicates.append(i)
+                    if ordered:
+                        break
+        return duplicates
+
+    def upsert_docs(self, collect_nm, key_nm, docs):
+        inserted = 0
+        with self.lock:
+            collection = self._collection(collect_nm)
+            for doc in docs:
+                found = collection.find({key_nm: doc[key_nm]})
+                if found:
+                    new = copy.deepcopy(doc)
+                    new[ID] = found[0][ID]
+                    collection.replace(found[0], new)
+                else:
+                    self.insert_doc(collect_nm, doc)
+                    inserted += 1
+        return inserted
+
+    def fetch_and_update(self, collect_nm, filters, update_string,
+                         projection=None):
+        with self.lock:
+            collection = self._collection(collect_nm)
+            for doc in collection.find(filters):
+                new = copy.deepcopy(doc)
+                apply_update(new, update_string)
+                collection.replace(doc, new)
+                return project(new, projection)
+        return None
+
+    def update_doc(self, collect_nm, filters, update_string):
+        found = self.fetch_and_update(collect_nm, filters, update_string,
+                                      {ID: 1})
+        return 0 if found is None else 1
+
+    def update_docs(self, collect_nm, filters, update_string):
+        with self.lock:
+            collection = self._collection(collect_nm)
+            docs = collection.find(filters)
+            for doc in docs:
+                new = copy.deepcopy(doc)
+                apply_update(new, update_string)
+                collection.replace(doc, new)
+        return len(docs)
+
+    def delete_doc(self, collect_nm, filters):
+        with self.lock:
+            collection = self._collection(collect_nm)
+            for doc in collection.find(filters):
+                collection.delete(doc)
+                return 1
+        return 0
+
+    def delete_docs(self, collect_nm, filters):
+        with self.lock:
+            collection = self._collection(collect_nm)
+            docs = collection.find(filters)
+            for doc in docs:
+                collection.delete(doc)
+        return len(docs)
+
+    def watch(self, collect_nm, full_document=None):
+        raise Unsupported("Change streams need the Mongo backend.")
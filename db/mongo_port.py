@@ -10,22 +10,26 @@ It assumes the JSON files have the structure:
         "some_fldN": { some more fields },
     }
 It assumes that cause that's what we've been using!
+The file is parsed as it is read and written in insert_many batches, so
+memory use doesn't grow with the size of the file:
+    python3 mongo_port.py chatDB rooms room_name --batch-size 5000
+A load that stopped part way can be picked up again with --skip, using
+the offset from its last progress report.
 """
-import sys
+import argparse
+import itertools
 import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import db_connect as dbc
-
+BATCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+# how often, in entities, we report progress:
+REPORT_EVERY = 100000
 
-def read_collection(json_version):
-    """
-    A function to read a colleciton off of disk.
-    """
-    try:
-        with open(json_version) as file:
-            return json.loads(file.read())
-    except FileNotFoundError:
-        return None
+decoder = json.JSONDecoder()
 
 
 def new_ent_from_json(key_name, ent_name, ent_data):
@@ -33,35 +37,180 @@ def new_ent_from_json(key_name, ent_name, ent_data):
     return {**dict1, **ent_data}
 
 
-client = dbc.get_client()
-print(client)
+def iter_entities(file, chunk_size = CHUNK_SIZE):
+    """
+    Yields the (name, data) pairs of the JSON object in file one at a
+    time, reading chunk_size characters at a time.
+    Raises ValueError if the file isn't a JSON object.
+    """
+    buf = ""
+    pos = 0
+    eof = False
 
-if len(sys.argv) < 4:
-    # the key in the JSON file will become an ordinary field
-    # in the Mongo DB, but we need to give it a name!
-    print(f"Usage: {sys.argv[0]} db_name collection_name key_name")
-    exit(1)
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = file.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip_space():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    def expect(chars):
+        nonlocal pos
+        skip_space()
+        if pos >= len(buf) or buf[pos] not in chars:
+            found = buf[pos:pos + 20] if pos < len(buf) else "end of file"
+            raise ValueError(f"Expected one of {chars!r}, found {found!r}")
+        pos += 1
+        return buf[pos - 1]
+
+    def value():
+        nonlocal pos
+        skip_space()
+        while True:
+            try:
+                val, end = decoder.raw_decode(buf, pos)
+                # a number may go on in the next chunk:
+                if end < len(buf) or eof:
+                    pos = end
+                    return val
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+
+    expect("{")
+    skip_space()
+    if pos < len(buf) and buf[pos] == "}":
+        return
+    while True:
+        name = value()
+        if not isinstance(name, str):
+            raise ValueError(f"Expected a name, found {name!r}")
+        expect(":")
+        yield name, value()
+        if expect(",}") == "}":
+            return
 
-db = client[sys.argv[1]]
-print(db)
 
-collect_nm = sys.argv[2]
-print(f"{collect_nm=}")
-collection = db[collect_nm]
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
 
-json_file = collect_nm + ".json"
-print(f"{json_file=}")
 
-key_name = sys.argv[3]
-print(f"{key_name=}")
+def load(dbc, collect_nm, key_name, entities, batch_size = BATCH_SIZE,
+         writers = 1, upsert = False, skip = 0, report = print):
+    """
+    Writes entities, (name, data) pairs, to a collection in batches of
+    batch_size, using up to writers batches in flight at once.
+    The first skip entities are passed over, to resume a load.
+    In upsert mode an entity replaces the one already stored under its
+    name; otherwise names already stored are counted as duplicates.
+    Progress reports start with the "done" offset: every entity before
+    it has been written, so a load that stops can be resumed from there
+    (batches written after it may be written again).
+    Returns the number of entities read, done, written and found to be
+    duplicates.
+    """
+    stats = {"read": skip, "done": skip, "written": 0, "duplicates": 0}
+    started = time.perf_counter()
+    next_report = skip + REPORT_EVERY
+
+    def write(docs):
+        if upsert:
+            dbc.upsert_docs(collect_nm, key_name, docs)
+            return len(docs), 0
+        dups = len(dbc.insert_docs(collect_nm, docs, ordered=False))
+        return len(docs) - dups, dups
+
+    def collect():
+        # batches are collected in the order they were read, so every
+        # entity before this one's end has been written:
+        end, future = pending.pop(0)
+        written, dups = future.result()
+        stats["written"] += written
+        stats["duplicates"] += dups
+        stats["done"] = end
+
+    entities = itertools.islice(entities, skip, None)
+    pending = []
+    try:
+        with ThreadPoolExecutor(max_workers=writers) as pool:
+            for batch in batched(entities, batch_size):
+                docs = [new_ent_from_json(key_name, name, data)
+                        for name, data in batch]
+                # keep memory bounded: wait for the oldest batch first.
+                if len(pending) >= writers * 2:
+                    collect()
+                while pending and pending[0][1].done():
+                    collect()
+                stats["read"] += len(batch)
+                pending.append((stats["read"], pool.submit(write, docs)))
+                if stats["read"] >= next_report:
+                    report(progress(stats, skip, started))
+                    next_report += REPORT_EVERY
+            while pending:
+                collect()
+    finally:
+        report(progress(stats, skip, started))
+    return stats
+
+
+def progress(stats, skip, started):
+    elapsed = time.perf_counter() - started
+    rate = (stats["read"] - skip) / elapsed if elapsed else 0
+    return (f"offset {stats['done']}: {stats['read']} read,"
+            + f" {stats['written']} written,"
+            + f" {stats['duplicates']} duplicates,"
+            + f" {rate:,.0f} entities/s")
 
-collect = read_collection(json_file)
 
-for entity_nm in collect:
-    new_entity = new_ent_from_json(key_name,
-                                   entity_nm,
-                                   collect[entity_nm])
-    print(f"{new_entity=}")
-    collection.insert_one(new_entity)
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument("db_name")
+    parser.add_argument("collection_name")
+    # the key in the JSON file will become an ordinary field
+    # in the Mongo DB, but we need to give it a name!
+    parser.add_argument("key_name")
+    parser.add_argument("--file",
+                        help="the JSON file (collection_name.json)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--writers", type=int, default=1,
+                        help="batches to write concurrently")
+    parser.add_argument("--upsert", action="store_true",
+                        help="replace entities that are already stored")
+    parser.add_argument("--skip", type=int, default=0,
+                        help="entities to skip, to resume a load")
+    args = parser.parse_args()
+
+    import db.db_connect as dbc
+    dbc.database_name = args.db_name
+
+    json_file = args.file or args.collection_name + ".json"
+    print(f"{json_file=}")
+    try:
+        with open(json_file) as file:
+            load(dbc, args.collection_name, args.key_name,
+                 iter_entities(file), args.batch_size, args.writers,
+                 args.upsert, args.skip)
+    except FileNotFoundError:
+        print(f"{json_file} not found.")
+        exit(1)
+
 
-print(collection)
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    main()
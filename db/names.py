@@ -0,0 +1,112 @@
+"""
+This file hands out the anonymous usernames we give people joining a
+room, drawn from the corpus in names.txt.
+The corpus is read once. Each room gets its own pool of unused names: a
+shuffled array of name numbers, so taking a name is a pop and giving one
+back on leave is an append, whatever the size of the corpus.
+The pools only make collisions unlikely; the room's own list of users is
+what keeps a name unique in a room, so other workers can use them too.
+"""
+
+import array
+import os
+import random
+import threading
+
+NAMES_FILE = os.environ.get("NAMES_FILE",
+                            os.path.join(os.path.dirname(__file__),
+                                         "names.txt"))
+
+lock = threading.Lock()
+names = None
+# name -> its number in names:
+numbers = None
+# room id -> its RoomPool:
+pools = {}
+
+
+class RoomPool:
+    """
+    The names still free in one room: their numbers in a shuffled array,
+    and a flag per name so a name is never handed back twice.
+    """
+    def __init__(self, size):
+        order = list(range(size))
+        random.shuffle(order)
+        self.free = array.array("I", order)
+        self.is_free = bytearray(b"\x01") * size
+
+    def take(self):
+        if not self.free:
+            return None
+        num = self.free.pop()
+        self.is_free[num] = 0
+        return num
+
+    def give_back(self, num):
+        if not self.is_free[num]:
+            self.is_free[num] = 1
+            self.free.append(num)
+
+
+def load(path = None):
+    """
+    Reads the corpus if it hasn't been yet, and returns it.
+    """
+    global names, numbers
+    if names is not None and path is None:
+        return names
+    with lock:
+        if names is None or path is not None:
+            with open(path or NAMES_FILE) as file:
+                corpus = list(dict.fromkeys(line.strip() for line in file
+                                            if line.strip()))
+            numbers = {name: num for num, name in enumerate(corpus)}
+            names = tuple(corpus)
+            pools.clear()
+    return names
+
+
+def is_name(name):
+    """
+    Checks whether name comes from our corpus.
+    """
+    load()
+    return name in numbers
+
+
+def allocate(room_id):
+    """
+    Takes a name that isn't in use in the room, as far as this process
+    knows. Returns None if the room has run out of names.
+    """
+    load()
+    room_id = str(room_id)
+    with lock:
+        pool = pools.get(room_id)
+        if pool is None:
+            pool = pools[room_id] = RoomPool(len(names))
+        num = pool.take()
+    return None if num is None else names[num]
+
+
+def release(room_id, name):
+    """
+    Gives a name back to the room's pool when its user leaves.
+    """
+    load()
+    num = numbers.get(name)
+    if num is None:
+        return
+    with lock:
+        pool = pools.get(str(room_id))
+        if pool is not None:
+            pool.give_back(num)
+
+
+def forget(room_id):
+    """
+    Drops the pool of a room that has closed.
+    """
+    with lock:
+        pools.pop(str(room_id), None)
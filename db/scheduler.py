@@ -1,31 +1,24 @@
-from schedule import every, repeat, run_pending
+"""
+This file runs our periodic clean-up jobs.
+Idle rooms are closed by one bulk sweep over the indexed last_activity
+field, so a sweep costs the same whether one room expired or thousands.
+"""
+from schedule import every, idle_seconds, repeat, run_pending
 import time
 import db.data as db
-import db.db_connect as db_connect
 
-@repeat(every(1).minute)
-def test_scheduler():
-    db.add_room("test_room")
+# a room closes at most this long after its idle period is up:
+SWEEP_SECS = 60
 
-@repeat(every(1).minute)
-def test2_scheduler():
-    try:
-        db.delete_room("test_room")
-    except:
-        pass
 
-@repeat(every(24).hours)
-def auto_delete_rooms():
-    lst = db.get_rooms()
-    for room in lst:
-        db.delete_room(room)
+@repeat(every(SWEEP_SECS).seconds)
+def expire_idle_rooms():
+    closed = db.expire_idle_rooms()
+    if closed:
+        print(f"Closed {closed} idle rooms.")
 
-@repeat(every(24).hours)
-def auto_delete_users():
-    lst = db.get_users()
-    for user in lst:
-        db.delete_user(user)
 
-while True:
-    run_pending()
-    time.sleep(1)
\ No newline at end of file
+if __name__ == "__main__":
+    while True:
+        run_pending()
+        time.sleep(max(idle_seconds(), 0))
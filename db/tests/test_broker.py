@@ -0,0 +1,96 @@
+"""
+This file holds the tests for broker.py.
+"""
+
+from unittest import TestCase
+import os
+import socket
+import tempfile
+
+from db import broker, events
+
+
+def wait_for(sub, timeout=2):
+    return sub.get(timeout=timeout)
+
+
+class BrokerTestCase(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.brokers = []
+
+    def tearDown(self):
+        for each in self.brokers:
+            each.close()
+        self.dir.cleanup()
+
+    def new_broker(self, name):
+        each = broker.Broker(self.dir.name, name)
+        self.brokers.append(each)
+        return each
+
+    def test_event_reaches_other_worker(self):
+        """
+        Post-condition 1: an event sent by one worker is delivered to the
+        subscribers of another.
+        """
+        sender = self.new_broker("sender")
+        receiver = self.new_broker("receiver").start()
+        sub = events.subscribe("room a")
+        try:
+            sender.send({events.TYPE: events.MESSAGE, events.ROOM: "room a",
+                         events.DATA: {"seq": 1, "text": "hi"}})
+            event = wait_for(sub)
+        finally:
+            events.unsubscribe(sub)
+        self.assertEqual(event[events.DATA], {"seq": 1, "text": "hi"})
+        self.assertEqual(receiver.received, 1)
+
+    def test_not_sent_to_self(self):
+        """
+        Post-condition 1: a worker doesn't get its own events back.
+        """
+        only = self.new_broker("only")
+        only.send({events.TYPE: events.CLOSED, events.ROOM: "room b",
+                   events.DATA: None})
+        self.assertEqual(only.sent, 0)
+
+    def test_dead_peer_removed(self):
+        """
+        Post-condition 1: the socket of a worker that died is cleaned up.
+        """
+        path = os.path.join(self.dir.name, "dead" + broker.SUFFIX)
+        dead = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        dead.bind(path)
+        dead.close()
+        sender = self.new_broker("sender")
+        sender.send({events.TYPE: events.CLOSED, events.ROOM: "room c",
+                     events.DATA: None})
+        self.assertFalse(os.path.exists(path))
+
+    def test_close(self):
+        """
+        Post-condition 1: closing stops the reader and removes the socket.
+        """
+        each = broker.Broker(self.dir.name, "closing").start()
+        each.close()
+        each.thread.join(timeout=2)
+        self.assertFalse(each.thread.is_alive())
+        self.assertFalse(os.path.exists(each.path))
+        self.assertNotIn(each.send, events.listeners)
+
+    def test_start_once_per_process(self):
+        """
+        Post-condition 1: starting again in the same process reuses the
+        running broker.
+        Post-condition 2: nothing starts without a directory.
+        """
+        try:
+            first = broker.start(self.dir.name)
+            self.assertIs(broker.start(self.dir.name), first)
+        finally:
+            if broker.broker is not None:
+                broker.broker.close()
+                broker.broker = None
+        if not broker.BROKER_DIR:
+            self.assertIsNone(broker.start())
@@ -0,0 +1,62 @@
+"""
+This file holds the tests for cache.py.
+"""
+
+from unittest import TestCase
+import time
+
+from db.cache import TTLCache
+
+
+class CacheTestCase(TestCase):
+    def test_get_set(self):
+        """
+        Post-condition 1: a stored value is returned and counted as a hit.
+        """
+        cache = TTLCache()
+        cache.set("key", "value")
+        self.assertEqual(cache.get("key"), "value")
+        self.assertEqual(cache.hits, 1)
+
+    def test_missing(self):
+        """
+        Post-condition 1: a missing key returns None and counts as a miss.
+        """
+        cache = TTLCache()
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.misses, 1)
+
+    def test_expiry(self):
+        """
+        Post-condition 1: entries are forgotten after ttl seconds.
+        """
+        cache = TTLCache(ttl=0.01)
+        cache.set("key", "value")
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        """
+        Post-condition 1: the least recently used entry is evicted first.
+        """
+        cache = TTLCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_delete_clear(self):
+        """
+        Post-condition 1: deleted and cleared entries are gone.
+        """
+        cache = TTLCache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+        cache.clear()
+        self.assertIsNone(cache.get("b"))
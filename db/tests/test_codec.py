@@ -0,0 +1,37 @@
+"""
+This file holds the tests for codec.py.
+"""
+
+from unittest import TestCase
+from datetime import datetime, timezone
+import json
+
+import bson.json_util as bsutil
+from bson import Binary, Decimal128, Int64, ObjectId
+
+from db import codec
+
+
+class CodecTestCase(TestCase):
+    def test_dumps(self):
+        """
+        Post-condition 1: documents come out as json_util writes them.
+        Post-condition 2: the result is bytes.
+        """
+        docs = [{"_id": ObjectId(), "name": "room é",
+                 "at": datetime.now(timezone.utc),
+                 "naive": datetime(2020, 1, 2, 3, 4, 5, 6000),
+                 "old": datetime(1960, 1, 1),
+                 "count": Int64(5), "price": Decimal128("1.5"),
+                 "blob": Binary(b"ab"), "ids": [ObjectId(), None, 1.5]}]
+        data = codec.dumps(docs)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(json.loads(data), json.loads(bsutil.dumps(docs)))
+
+    def test_json_ready(self):
+        """
+        Post-condition 1: BSON values are replaced by JSON ones.
+        """
+        ob_id = ObjectId()
+        self.assertEqual(codec.json_ready({"_id": ob_id, 1: "one"}),
+                         {"_id": {"$oid": str(ob_id)}, "1": "one"})
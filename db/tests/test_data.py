@@ -2,11 +2,15 @@
 This file holds the tests for db.py.
 """
 
+from datetime import timedelta
 from unittest import TestCase, skip
+from unittest.mock import patch
 import random
+import threading
 
 import db.data as db
 import db.db_connect as db_connect
+from db import events, names, trace
 
 # field names in our DB:
 ROOMS = "rooms"
@@ -94,4 +98,641 @@ class DBTestCase(TestCase):
         new_user = new_entity_name("user")
         db.add_user(new_user)
         users = db.get_users_as_dict()
-        self.assertIn(new_user, users)
\ No newline at end of file
+        self.assertIn(new_user, users)
+
+    def test_get_room_code_missing(self):
+        """
+        Post-condition 1: return is None for a room that doesn't exist.
+        """
+        self.assertIsNone(db.get_room_code(new_entity_name("room")))
+
+    def test_get_users_room_missing(self):
+        """
+        Post-condition 1: return is None for a room that doesn't exist.
+        """
+        self.assertIsNone(db.get_users_room(new_entity_name("room")))
+
+    def test_join_room_code_bad_code(self):
+        """
+        Post-condition 1: a malformed room code is not acceptable.
+        """
+        ret = db.join_room_code("not a room code", new_entity_name("user"))
+        self.assertEqual(ret, db.NOT_ACCEPTABLE)
+
+    def test_join_outcome(self):
+        """
+        Post-condition 1: a failed join is explained the same way for
+        the sync and async paths.
+        """
+        room = {db.USERS_LIST: ["in"]}
+        self.assertEqual(db.join_outcome(None, "in"), db.NOT_ACCEPTABLE)
+        self.assertEqual(db.join_outcome(room, "in"), db.OK)
+        self.assertEqual(db.join_outcome(room, "out"), db.ROOM_FULL)
+
+    def test_join_room_code_full(self):
+        """
+        Checks that a room stops accepting users once its slots are taken.
+        Post-condition 1: every join up to capacity succeeds.
+        Post-condition 2: the next join is rejected and not recorded.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        for i in range(db.ROOM_CAPACITY):
+            self.assertEqual(db.join_room_code(code, f"user {i}"), db.OK)
+        self.assertEqual(db.join_room_code(code, "one too many"),
+                         db.ROOM_FULL)
+        users = db.get_users_room(room)
+        self.assertEqual(len(users), db.ROOM_CAPACITY)
+        self.assertNotIn("one too many", users)
+        db.delete_room(room)
+
+    def test_join_room_code_twice(self):
+        """
+        Post-condition 1: joining the same room twice lists the user once.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        db.join_room_code(code, user)
+        self.assertEqual(db.join_room_code(code, user), db.OK)
+        self.assertEqual(db.get_users_room(room).count(user), 1)
+        db.delete_room(room)
+
+    def test_remove_user_from_room(self):
+        """
+        Post-condition 1: user is no longer in the room.
+        Post-condition 2: removing them again reports NOT_FOUND.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        db.join_room_code(db.get_room_code(room), user)
+        self.assertEqual(db.remove_user_from_room(user, room), db.OK)
+        self.assertNotIn(user, db.get_users_room(room))
+        self.assertEqual(db.remove_user_from_room(user, room), db.NOT_FOUND)
+        db.delete_room(room)
+
+    def test_join_preset_room_new_room(self):
+        """
+        Post-condition 1: a preset user is never placed in a room twice.
+        """
+        user = new_entity_name("user")
+        first = db.join_preset_room(user)
+        second = db.join_preset_room(user)
+        if first != db.NOT_FOUND and second != db.NOT_FOUND:
+            self.assertNotEqual(first, second)
+            db.remove_user_from_room(user, second)
+        if first != db.NOT_FOUND:
+            db.remove_user_from_room(user, first)
+
+    def test_join_room_interests_best_match(self):
+        """
+        Post-condition 1: user joins the room sharing the most interests.
+        """
+        interests = [new_entity_name("interest"), new_entity_name("interest")]
+        weak = new_entity_name("room")
+        strong = new_entity_name("room")
+        db.add_room(weak)
+        db.add_room(strong)
+        db_connect.update_doc(ROOMS, {ROOM_NM: weak},
+                              {"$set": {db.COMMON_INTERESTS: interests[:1]}})
+        db_connect.update_doc(ROOMS, {ROOM_NM: strong},
+                              {"$set": {db.COMMON_INTERESTS: interests}})
+        user = new_entity_name("user")
+        self.assertEqual(db.join_room_interests(interests, user), strong)
+        self.assertIn(user, db.get_users_room(strong))
+        db.delete_room(weak)
+        db.delete_room(strong)
+
+    def test_join_room_interests_no_match(self):
+        """
+        Post-condition 1: NOT_FOUND when no room shares an interest.
+        """
+        interests = [new_entity_name("interest")]
+        ret = db.join_room_interests(interests, new_entity_name("user"))
+        self.assertEqual(ret, db.NOT_FOUND)
+
+    def test_get_users_room_after_join(self):
+        """
+        Checks that cached room state is invalidated by our own writes.
+        Post-condition 1: a join shows up right away.
+        Post-condition 2: a removal shows up right away.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        self.assertEqual(db.get_users_room(room), [])
+        db.join_room_code(db.get_room_code(room), user)
+        self.assertIn(user, db.get_users_room(room))
+        db.remove_user_from_room(user, room)
+        self.assertNotIn(user, db.get_users_room(room))
+        db.delete_room(room)
+        self.assertIsNone(db.get_room_code(room))
+
+    def test_expire_idle_rooms(self):
+        """
+        Checks that idle rooms are closed along with their users.
+        Post-condition 1: an idle room is deleted.
+        Post-condition 2: its users are deleted.
+        Post-condition 3: an active room is kept.
+        """
+        idle_room = new_entity_name("room")
+        active_room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(idle_room)
+        db.add_room(active_room)
+        db.add_user(user)
+        db.join_room_code(db.get_room_code(idle_room), user)
+        long_ago = db.now() - timedelta(days=1)
+        db_connect.update_doc(ROOMS, {ROOM_NM: idle_room},
+                              {"$set": {db.LAST_ACTIVITY: long_ago}})
+        self.assertGreaterEqual(db.expire_idle_rooms(), 1)
+        self.assertFalse(db.room_exists(idle_room))
+        self.assertFalse(db.user_exists(user))
+        self.assertTrue(db.room_exists(active_room))
+        db.delete_room(active_room)
+
+    def test_expire_rooms_without_activity(self):
+        """
+        Post-condition 1: a room with no recorded activity is given some
+        by a sweep, so later sweeps can close it.
+        """
+        room = new_entity_name("room")
+        db_connect.insert_doc(ROOMS, {ROOM_NM: room, NUM_USERS: 0,
+                                      USERS_LIST: []})
+        db.expire_idle_rooms()
+        self.assertTrue(db.room_exists(room))
+        self.assertIsNotNone(db_connect.fetch_doc(
+            ROOMS, {ROOM_NM: room}, {db.LAST_ACTIVITY: 1})
+            .get(db.LAST_ACTIVITY))
+        db.delete_room(room)
+
+    def test_iter_messages(self):
+        """
+        Post-condition 1: every message after `after` is read, page by
+        page.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        db.join_room_code(code, user)
+        db.add_messages(code, user, [str(i) for i in range(5)])
+        limit = db.MAX_MESSAGE_LIMIT
+        db.MAX_MESSAGE_LIMIT = 2
+        try:
+            with trace.budget(max_ops=3):
+                seqs = [msg[db.SEQ] for msg in db.iter_messages(code, 1)]
+        finally:
+            db.MAX_MESSAGE_LIMIT = limit
+        self.assertEqual(seqs, [2, 3, 4, 5])
+        db.delete_room(room)
+
+    def test_add_messages(self):
+        """
+        Checks that messages are numbered in order within a room.
+        Post-condition 1: a batch gets consecutive sequence numbers.
+        Post-condition 2: later messages get later numbers.
+        Post-condition 3: reads after a sequence number return only newer
+        messages, oldest first.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        db.join_room_code(code, user)
+        self.assertEqual(db.add_messages(code, user, ["a", "b", "c"]),
+                         [1, 2, 3])
+        self.assertEqual(db.add_message(code, user, "d"), 4)
+        messages = db.get_messages(code, after=2)
+        self.assertEqual([msg[db.TEXT] for msg in messages], ["c", "d"])
+        self.assertEqual([msg[db.SEQ] for msg in messages], [3, 4])
+        self.assertEqual(len(db.get_messages(code, limit=1)), 1)
+        db.delete_room(room)
+
+    def test_messages_written_out_of_order(self):
+        """
+        Checks a sender that reserved a number but hasn't written its
+        message yet, while a later sender's message is in the log.
+        Post-condition 1: readers don't get past the reserved number.
+        Post-condition 2: once it is written, both messages are read.
+        Post-condition 3: a number reserved long ago is passed over.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        ob_id = db.room_object_id(code)
+        db.join_room_code(code, user)
+        reserved = db_connect.fetch_and_update(ROOMS, {ID: ob_id},
+                                               db.reserve_seqs(1),
+                                               {db.MSG_SEQ: 1})
+        self.assertEqual(db.add_message(code, user, "second"), 2)
+        self.assertEqual(db.get_messages(code), [])
+        self.assertEqual(list(db.iter_messages(code)), [])
+        write_secs = db.MESSAGE_WRITE_SECS
+        db.MESSAGE_WRITE_SECS = 0
+        try:
+            self.assertEqual([msg[db.SEQ] for msg in db.get_messages(code)],
+                             [2])
+        finally:
+            db.MESSAGE_WRITE_SECS = write_secs
+        first = db.new_messages(reserved[db.MSG_SEQ], user, ["first"])
+        db_connect.insert_docs(db.MESSAGES, db.message_docs(ob_id, first))
+        self.assertEqual([msg[db.TEXT] for msg in db.get_messages(code)],
+                         ["first", "second"])
+        db.delete_room(room)
+
+    def test_add_messages_not_in_room(self):
+        """
+        Post-condition 1: a user outside the room can't post to it.
+        Post-condition 2: a missing room is reported as not found.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        self.assertEqual(db.add_message(code, new_entity_name("user"), "hi"),
+                         db.NOT_ACCEPTABLE)
+        db.delete_room(room)
+        self.assertEqual(db.add_message(code, new_entity_name("user"), "hi"),
+                         db.NOT_FOUND)
+        self.assertIsNone(db.get_messages("not a code"))
+
+    def test_delete_room_purges_messages(self):
+        """
+        Post-condition 1: closing a room deletes its messages.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        db.join_room_code(code, user)
+        db.add_messages(code, user, ["a", "b"])
+        db.delete_room(room)
+        self.assertEqual(db.get_messages(code), [])
+
+    def test_room_events(self):
+        """
+        Checks that room writes are pushed to the room's subscribers.
+        Post-condition 1: joins, messages, leaves and closure are published
+        in order.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        sub = events.subscribe(code)
+        try:
+            db.join_room_code(code, user)
+            db.add_message(code, user, "hi")
+            db.remove_user_from_room(user, room)
+            db.delete_room(room)
+            kinds = []
+            while (event := sub.get(timeout=0)) is not None:
+                kinds.append(event[events.TYPE])
+        finally:
+            events.unsubscribe(sub)
+        self.assertEqual(kinds, [events.JOIN, events.MESSAGE, events.LEAVE,
+                                 events.CLOSED])
+
+    def test_add_room_duplicate(self):
+        """
+        Post-condition 1: adding a room twice reports a duplicate.
+        """
+        room = new_entity_name("room")
+        self.assertEqual(db.add_room(room), db.OK)
+        self.assertEqual(db.add_room(room), db.DUPLICATE)
+        db.delete_room(room)
+
+    def test_add_rooms(self):
+        """
+        Post-condition 1: new rooms are added.
+        Post-condition 2: existing names are reported as duplicates.
+        Post-condition 3: it takes one database operation.
+        """
+        taken = new_entity_name("room")
+        new = [new_entity_name("room"), new_entity_name("room")]
+        db.add_room(taken)
+        with trace.budget(max_ops=1):
+            results = db.add_rooms(new + [taken, new[0]])
+        self.assertEqual(results, {new[0]: db.OK, new[1]: db.OK,
+                                   taken: db.DUPLICATE})
+        for room in new + [taken]:
+            self.assertTrue(db.room_exists(room))
+            db.delete_room(room)
+
+    def test_add_users(self):
+        """
+        Post-condition 1: taken names are reported as duplicates.
+        Post-condition 2: preset names are shared, not duplicates.
+        """
+        taken = new_entity_name("user")
+        new = new_entity_name("user")
+        db.add_user(taken)
+        results = db.add_users([taken, new, names.load()[0]])
+        self.assertEqual(results, {taken: db.DUPLICATE, new: db.OK,
+                                   names.load()[0]: db.OK})
+        self.assertTrue(db.user_exists(new))
+        db.delete_user(taken)
+        db.delete_user(new)
+
+    def test_join_random_room_least_loaded(self):
+        """
+        Post-condition 1: the user lands in one of the emptiest open rooms.
+        Post-condition 2: it takes two database operations.
+        """
+        db.add_room(new_entity_name("room"))
+        user = new_entity_name("user")
+        open_counts = [room[NUM_USERS] for room
+                       in db.get_rooms_as_dict().values()
+                       if room[NUM_USERS] < db.ROOM_CAPACITY]
+        with trace.budget(max_ops=2):
+            joined = db.join_random_room(user, db.LEAST_LOADED)
+        room = db.get_rooms_as_dict()[joined]
+        self.assertEqual(room[NUM_USERS] - 1, min(open_counts))
+        db.remove_user_from_room(user, joined)
+
+    def test_join_random_room_sample_missed(self):
+        """
+        Post-condition 1: a random join whose sample holds no open room
+        still finds one.
+        Post-condition 2: samples only hold documents meeting the filter.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        sample_docs = db.db.sample_docs
+        db.db.sample_docs = lambda *args: []
+        try:
+            joined = db.join_random_room(user, db.RANDOM)
+        finally:
+            db.db.sample_docs = sample_docs
+        self.assertIn(user, db.get_users_room(joined))
+        db.remove_user_from_room(user, joined)
+        for doc in db.db.sample_docs(ROOMS, {ROOM_NM: room}, 3):
+            self.assertEqual(doc[ROOM_NM], room)
+        db.delete_room(room)
+
+    def test_join_random_room_all_full(self):
+        """
+        Post-condition 1: when every room is full, a new public room is
+        opened with the user in it.
+        Post-condition 2: random placement reports that nothing is free.
+        """
+        user = new_entity_name("user")
+        capacity = db.ROOM_CAPACITY
+        db.ROOM_CAPACITY = 0
+        try:
+            self.assertEqual(db.join_random_room(user, db.RANDOM),
+                             db.NOT_FOUND)
+            joined = db.join_random_room(user, db.LEAST_LOADED)
+        finally:
+            db.ROOM_CAPACITY = capacity
+        self.assertTrue(joined.startswith(db.PUBLIC_ROOM))
+        self.assertEqual(db.get_users_room(joined), [user])
+        db.delete_room(joined)
+
+    def test_join_anonymous_room(self):
+        """
+        Post-condition 1: newcomers get corpus names that are unique in
+        their room.
+        Post-condition 2: no users are read.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        joined = []
+        for _ in range(5):
+            with trace.budget(max_ops=2):
+                joined.append(db.join_anonymous_room())
+        for roomname, username in joined:
+            self.assertTrue(names.is_name(username))
+            users = db.get_users_room(roomname)
+            self.assertEqual(users.count(username), 1)
+            db.remove_user_from_room(username, roomname)
+        db.delete_room(room)
+
+    def test_join_anonymous_room_full(self):
+        """
+        Post-condition 1: a name given out for a join that fails because
+        the room filled up goes back to the room's pool.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        ob_id = db.room_object_id(db.get_room_code(room))
+        with patch.object(db, "_least_loaded_rooms",
+                          lambda: [{ID: ob_id}]), \
+                patch.object(db, "_join_room", lambda filters, name: None), \
+                patch.object(db, "_new_public_room", lambda name: None):
+            db.join_anonymous_room()
+        pool = names.pools[str(ob_id)]
+        self.assertEqual(len(pool.free), len(names.load()))
+        db.delete_room(room)
+
+    def test_user_rooms(self):
+        """
+        Post-condition 1: membership is seen from both the room and the
+        user.
+        Post-condition 2: leaving every room takes two operations.
+        Post-condition 3: afterwards the user is in no room.
+        """
+        rooms = [new_entity_name("room"), new_entity_name("room")]
+        user = new_entity_name("user")
+        for room in rooms:
+            db.add_room(room)
+            db.join_room_code(db.get_room_code(room), user)
+        self.assertTrue(db.is_user_in_room(user, rooms[0]))
+        self.assertEqual(sorted(db.get_user_rooms(user)), sorted(rooms))
+        with trace.budget(max_ops=2):
+            left = db.remove_user_from_all_rooms(user)
+        self.assertEqual(sorted(left), sorted(rooms))
+        self.assertFalse(db.is_user_in_room(user, rooms[0]))
+        self.assertEqual(db.get_user_rooms(user), [])
+        self.assertEqual(db.get_users_room(rooms[1]), [])
+        self.assertEqual(db.remove_user_from_all_rooms(user), db.NOT_FOUND)
+        for room in rooms:
+            db.delete_room(room)
+
+    def test_remove_corpus_name_from_all_rooms(self):
+        """
+        Post-condition 1: a corpus name isn't taken out of every room,
+        as other anonymous users may have it.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        name = names.load()[0]
+        db.join_room_code(db.get_room_code(room), name)
+        self.assertEqual(db.remove_user_from_all_rooms(name),
+                         db.NOT_ACCEPTABLE)
+        self.assertTrue(db.is_user_in_room(name, room))
+        db.delete_room(room)
+
+    def test_update_room(self):
+        """
+        Post-condition 1: a rename is one database operation.
+        Post-condition 2: renaming onto a taken name is refused.
+        Post-condition 3: renaming a missing room reports it.
+        """
+        room = new_entity_name("room")
+        newname = new_entity_name("room")
+        taken = new_entity_name("room")
+        db.add_room(room)
+        db.add_room(taken)
+        db.get_room_code(room)
+        with trace.budget(max_ops=1):
+            self.assertEqual(db.update_room(room, newname), room)
+        self.assertIsNone(db.get_room_code(room))
+        self.assertTrue(db.room_exists(newname))
+        self.assertEqual(db.update_room(newname, taken), db.DUPLICATE)
+        self.assertTrue(db.room_exists(newname))
+        self.assertEqual(db.update_room(room, taken), db.NOT_FOUND)
+        db.delete_room(newname)
+        db.delete_room(taken)
+
+    def test_create_indexes_over_duplicates(self):
+        """
+        Post-condition 1: names that are already taken twice stop us
+        starting, rather than leaving renames unchecked.
+        """
+        from db.memory_backend import MemoryBackend
+        for collect_nm, name_nm in ((ROOMS, ROOM_NM), (USERS, USER_NM)):
+            backend = MemoryBackend()
+            for _ in range(2):
+                backend.insert_doc(collect_nm, {name_nm: "twin"})
+            with patch.object(db_connect, "backend", backend):
+                with self.assertRaises(RuntimeError):
+                    db.create_indexes()
+
+    def test_update_user(self):
+        """
+        Post-condition 1: a user can be renamed in one operation.
+        Post-condition 2: renaming onto a taken name is refused.
+        """
+        user = new_entity_name("user")
+        newname = new_entity_name("user")
+        taken = new_entity_name("user")
+        db.add_user(user)
+        db.add_user(taken)
+        with trace.budget(max_ops=1):
+            self.assertEqual(db.update_user(user, newname), user)
+        self.assertTrue(db.user_exists(newname))
+        self.assertEqual(db.update_user(newname, taken), db.DUPLICATE)
+        self.assertEqual(db.update_user(user, taken), db.NOT_FOUND)
+        db.delete_user(newname)
+        db.delete_user(taken)
+
+    def test_get_version(self):
+        """
+        Post-condition 1: a listing's version depends only on its body.
+        Post-condition 2: it is remembered until the listing is written
+        to, and only writes to that listing drop it.
+        Post-condition 3: a version read across a write isn't kept.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        in_room = (db.USERS_LIST, room)
+        version = db.set_version(db.ROOMS, b"[]", db.last_write)
+        self.assertEqual(db.set_version(db.USERS, b"[]", db.last_write),
+                         version)
+        self.assertNotEqual(db.set_version(in_room, b"[1]", db.last_write),
+                            version)
+        self.assertEqual(db.get_version(db.ROOMS), version)
+        db.add_room(room)
+        self.assertIsNone(db.get_version(db.ROOMS))
+        self.assertEqual(db.get_version(db.USERS), version)
+        db.add_user(user)
+        self.assertIsNone(db.get_version(db.USERS))
+        since = db.last_write
+        db.join_room_code(db.get_room_code(room), user)
+        self.assertIsNone(db.get_version(in_room))
+        db.set_version(in_room, b"[]", since)
+        self.assertIsNone(db.get_version(in_room))
+        db.delete_room(room)
+        db.delete_user(user)
+
+    def test_add_messages_drops_listing(self):
+        """
+        Post-condition 1: the rooms listing shows a room's new sequence
+        number once messages are added to it.
+        Post-condition 2: its version is dropped.
+        """
+        room = new_entity_name("room")
+        user = new_entity_name("user")
+        db.add_room(room)
+        code = db.get_room_code(room)
+        db.join_room_code(code, user)
+        db.get_rooms()
+        db.set_version(db.ROOMS, b"[]", db.last_write)
+        db.add_messages(code, user, ["hi", "there"])
+        self.assertIsNone(db.get_version(db.ROOMS))
+        listed = [found for found in db.get_rooms()
+                  if found[ROOM_NM] == room]
+        self.assertEqual(listed[0][db.MSG_SEQ], 2)
+        db.delete_room(room)
+
+    def test_room_change(self):
+        """
+        Post-condition 1: a change to a room drops only that room's
+        cached state.
+        Post-condition 2: a change to a room we know nothing about drops
+        everything.
+        """
+        room = new_entity_name("room")
+        other = new_entity_name("room")
+        db.add_rooms([room, other])
+        code = db.get_room_code(room)
+        db.get_room_code(other)
+        ob_id = db_connect.create_object_id(code)
+        db._room_change({"documentKey": {ID: ob_id}})
+        self.assertIsNone(db.room_cache.get((db.ROOM_CODE, room)))
+        self.assertIsNotNone(db.room_cache.get((db.ROOM_CODE, other)))
+        db._room_change({"documentKey": {ID: "unknown"}})
+        self.assertIsNone(db.room_cache.get((db.ROOM_CODE, other)))
+        db.delete_room(room)
+        db.delete_room(other)
+
+    def test_room_cache_fill_during_write(self):
+        """
+        Post-condition 1: what was read while the room was written to
+        isn't cached.
+        Post-condition 2: the next read is.
+        """
+        room = new_entity_name("room")
+        db.add_room(room)
+        fetch_doc = db_connect.fetch_doc
+
+        def fetch_during_write(*args, **kwargs):
+            doc = fetch_doc(*args, **kwargs)
+            db.room_changed(room)
+            return doc
+
+        with patch.object(db_connect, "fetch_doc", fetch_during_write):
+            self.assertEqual(db.get_users_room(room), [])
+        self.assertIsNone(db.room_cache.get((db.USERS_LIST, room)))
+        db.get_users_room(room)
+        self.assertEqual(db.room_cache.get((db.USERS_LIST, room)), [])
+        db.delete_room(room)
+
+    def test_start_reads_nothing(self):
+        """
+        Post-condition 1: starting a process that is connected reads none
+        of our collections.
+        """
+        with trace.budget(max_ops=0):
+            db.start()
+
+    def test_start_without_change_stream(self):
+        """
+        Post-condition 1: no watcher is started on the in-memory backend.
+        """
+        if db_connect.backend_nm != db_connect.MEMORY:
+            return
+        watch = db.ROOM_CACHE_WATCH
+        db.ROOM_CACHE_WATCH = True
+        threads = threading.active_count()
+        try:
+            db.start()
+        finally:
+            db.ROOM_CACHE_WATCH = watch
+        self.assertEqual(threading.active_count(), threads)
@@ -0,0 +1,85 @@
+"""
+This file holds the tests for db_connect.py.
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+
+import db.db_connect as db_connect
+from db import trace
+
+LOCAL_URI = "mongodb://localhost:27017"
+
+
+class DBConnectTestCase(TestCase):
+    def test_get_client_reused(self):
+        """
+        Post-condition 1: a process gets the same client every time.
+        """
+        self.assertIs(db_connect.get_client(), db_connect.get_client())
+
+    def test_get_client_after_fork(self):
+        """
+        Post-condition 1: a forked process gets a client of its own.
+        """
+        with patch.object(db_connect, "mongo_uri", LOCAL_URI), \
+                patch.object(db_connect, "connect_hooks", []), \
+                patch.object(db_connect, "client", db_connect.get_client()), \
+                patch.object(db_connect, "client_pid", -1):
+            old_client = db_connect.client
+            self.assertIsNot(db_connect.get_client(), old_client)
+
+    def test_get_uri_from_env(self):
+        """
+        Post-condition 1: MONGO_URI replaces the Atlas connection string.
+        """
+        with patch.object(db_connect, "mongo_uri", LOCAL_URI):
+            self.assertEqual(db_connect.get_uri(), LOCAL_URI)
+
+    def test_unique_index_over_duplicates(self):
+        """
+        Post-condition 1: a unique index isn't built, plain or otherwise,
+        over documents that already share a key.
+        Post-condition 2: a backend whose indexes fail isn't kept.
+        """
+        from db.memory_backend import MemoryBackend
+        backend = MemoryBackend()
+        for _ in range(2):
+            backend.insert_doc("users", {"user_name": "twin"})
+        with patch.object(db_connect, "backend", backend):
+            with self.assertRaises(RuntimeError):
+                db_connect.create_index("users", "user_name", unique=True)
+        self.assertEqual(backend.collections["users"].indexes, {})
+
+        def add_twins():
+            for _ in range(2):
+                db_connect.insert_doc("users", {"user_name": "twin"})
+
+        def create_indexes():
+            db_connect.create_index("users", "user_name", unique=True)
+
+        with patch.object(db_connect, "backend", None), \
+                patch.object(db_connect, "backend_nm", db_connect.MEMORY), \
+                patch.object(db_connect, "connect_hooks",
+                             [add_twins, create_indexes]):
+            with self.assertRaises(RuntimeError):
+                db_connect.get_backend()
+            self.assertIsNone(db_connect.backend)
+
+    def test_scan_budget(self):
+        """
+        Post-condition 1: a lookup on a field with no index goes over a
+        budget of documents examined, though it returns one document.
+        Post-condition 2: the same lookup by an indexed field doesn't.
+        """
+        collect_nm = "scan_test"
+        db_connect.delete_docs(collect_nm)
+        db_connect.insert_docs(collect_nm, [{"num": i, "key": i}
+                                            for i in range(50)])
+        db_connect.create_index(collect_nm, "key")
+        with self.assertRaises(AssertionError):
+            with trace.budget(max_docs=1, max_scanned=5):
+                db_connect.fetch_doc(collect_nm, {"num": 49})
+        with trace.budget(max_docs=1, max_scanned=1):
+            db_connect.fetch_doc(collect_nm, {"key": 49})
+        db_connect.delete_docs(collect_nm)
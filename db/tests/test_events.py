@@ -0,0 +1,61 @@
+"""
+This file holds the tests for events.py.
+"""
+
+from unittest import TestCase
+
+from db import events
+
+
+class EventsTestCase(TestCase):
+    def test_publish_reaches_subscribers(self):
+        """
+        Post-condition 1: every subscriber of the room gets the event.
+        Post-condition 2: subscribers of other rooms don't.
+        """
+        subs = [events.subscribe("room a"), events.subscribe("room a")]
+        other = events.subscribe("room b")
+        try:
+            events.publish("room a", events.JOIN, {"user_name": "x"})
+            for sub in subs:
+                event = sub.get(timeout=0)
+                self.assertEqual(event[events.TYPE], events.JOIN)
+                self.assertEqual(event[events.DATA], {"user_name": "x"})
+            self.assertIsNone(other.get(timeout=0))
+        finally:
+            for sub in subs + [other]:
+                events.unsubscribe(sub)
+
+    def test_unsubscribe(self):
+        """
+        Post-condition 1: an unsubscribed client gets nothing.
+        Post-condition 2: its room is forgotten once nobody listens.
+        """
+        sub = events.subscribe("room c")
+        events.unsubscribe(sub)
+        events.unsubscribe(sub)
+        events.publish("room c", events.CLOSED)
+        self.assertIsNone(sub.get(timeout=0))
+        self.assertNotIn("room c", events.subscribers)
+
+    def test_slow_subscriber_dropped(self):
+        """
+        Post-condition 1: a full queue marks the subscriber as dropped
+        instead of blocking the publisher.
+        """
+        sub = events.Subscription("room d", size=1)
+        sub.put({})
+        sub.put({})
+        self.assertTrue(sub.dropped)
+
+    def test_listeners(self):
+        """
+        Post-condition 1: listeners see every published event.
+        """
+        seen = []
+        events.listeners.append(seen.append)
+        try:
+            events.publish("room e", events.MESSAGE, {"seq": 1})
+        finally:
+            events.listeners.remove(seen.append)
+        self.assertEqual(seen[0][events.ROOM], "room e")
@@ -0,0 +1,140 @@
+"""
+This file holds the tests for memory_backend.py.
+"""
+
+from unittest import TestCase
+
+from pymongo.errors import DuplicateKeyError
+
+from db.backends import Backend, Unsupported
+from db.memory_backend import MemoryBackend
+
+ROOMS = "rooms"
+ROOM_NM = "room_name"
+NUM_USERS = "num_users"
+USERS_LIST = "list_users"
+ID = "_id"
+
+
+class MemoryBackendTestCase(TestCase):
+    def setUp(self):
+        self.store = MemoryBackend()
+        self.store.create_index(ROOMS, ROOM_NM, unique=True)
+        self.store.create_index(ROOMS, USERS_LIST)
+        for name, users in (("a", ["x"]), ("b", ["x", "y"]), ("c", [])):
+            self.store.insert_doc(ROOMS, {ROOM_NM: name,
+                                          NUM_USERS: len(users),
+                                          USERS_LIST: users})
+
+    def test_fetch_doc_projection(self):
+        """
+        Post-condition 1: only the projected fields and _id come back.
+        """
+        room = self.store.fetch_doc(ROOMS, {ROOM_NM: "b"}, {NUM_USERS: 1})
+        self.assertEqual(set(room), {ID, NUM_USERS})
+        self.assertEqual(room[NUM_USERS], 2)
+
+    def test_fetch_docs_operators(self):
+        """
+        Post-condition 1: range and array filters match like Mongo's.
+        """
+        rooms = self.store.fetch_docs(ROOMS, {NUM_USERS: {"$lt": 2},
+                                              USERS_LIST: {"$ne": "y"}})
+        self.assertEqual({room[ROOM_NM] for room in rooms}, {"a", "c"})
+        rooms = self.store.fetch_docs(ROOMS, {USERS_LIST: "x"})
+        self.assertEqual({room[ROOM_NM] for room in rooms}, {"a", "b"})
+
+    def test_unique_index(self):
+        """
+        Post-condition 1: a duplicate key is rejected on insert and update.
+        """
+        with self.assertRaises(DuplicateKeyError):
+            self.store.insert_doc(ROOMS, {ROOM_NM: "a"})
+        with self.assertRaises(DuplicateKeyError):
+            self.store.update_doc(ROOMS, {ROOM_NM: "a"},
+                                  {"$set": {ROOM_NM: "b"}})
+
+    def test_fetch_and_update(self):
+        """
+        Post-condition 1: the update is applied and the new doc returned.
+        Post-condition 2: the stored doc can't be changed through it.
+        """
+        room = self.store.fetch_and_update(ROOMS, {ROOM_NM: "c"},
+                                           {"$addToSet": {USERS_LIST: "z"},
+                                            "$inc": {NUM_USERS: 1}})
+        self.assertEqual(room[USERS_LIST], ["z"])
+        room[USERS_LIST].append("w")
+        stored = self.store.fetch_doc(ROOMS, {ROOM_NM: "c"})
+        self.assertEqual(stored[USERS_LIST], ["z"])
+        self.assertEqual(stored[NUM_USERS], 1)
+
+    def test_pull_and_delete(self):
+        """
+        Post-condition 1: $pull removes the value from the array index.
+        Post-condition 2: delete_docs removes every match.
+        """
+        self.store.update_doc(ROOMS, {ROOM_NM: "a"},
+                              {"$pull": {USERS_LIST: "x"}})
+        rooms = self.store.fetch_docs(ROOMS, {USERS_LIST: "x"})
+        self.assertEqual([room[ROOM_NM] for room in rooms], ["b"])
+        self.assertEqual(self.store.delete_docs(ROOMS, {}), 3)
+        self.assertIsNone(self.store.fetch_doc(ROOMS, {}))
+
+    def test_aggregate_scoring(self):
+        """
+        Post-condition 1: $project expressions, $sort and $limit work.
+        """
+        pipeline = [
+            {"$match": {USERS_LIST: {"$in": ["x", "y"]}}},
+            {"$project": {"score": {"$size": {"$setIntersection":
+                                              ["$list_users", ["x", "y"]]}}}},
+            {"$sort": {"score": -1}},
+            {"$limit": 1},
+        ]
+        best, = self.store.aggregate(ROOMS, pipeline)
+        self.assertEqual(best["score"], 2)
+        self.assertEqual(self.store.fetch_doc(ROOMS, {ID: best[ID]})[ROOM_NM],
+                         "b")
+
+    def test_iter_docs_order(self):
+        """
+        Post-condition 1: documents come back in _id order, up to limit.
+        """
+        rooms = list(self.store.iter_docs(ROOMS, {}, limit=2))
+        self.assertEqual([room[ROOM_NM] for room in rooms], ["a", "b"])
+
+    def test_iter_docs_sorted_by_index(self):
+        """
+        Post-condition 1: walking an index gives the same order and
+        limit as sorting.
+        Post-condition 2: documents missing the field still sort first.
+        """
+        backend = MemoryBackend()
+        backend.create_index("things", "size")
+        for size in [5, 3, 9, 3, 1, 7]:
+            backend.insert_doc("things", {"size": size})
+        docs = backend.iter_docs("things", {"size": {"$gt": 1}}, limit=3,
+                                 sort_key="size")
+        self.assertEqual([doc["size"] for doc in docs], [3, 3, 5])
+        backend.insert_doc("things", {"other": 1})
+        docs = backend.iter_docs("things", {}, limit=2, sort_key="size")
+        self.assertEqual([doc.get("size") for doc in docs], [None, 1])
+
+    def test_watch_unsupported(self):
+        """
+        Post-condition 1: change streams are refused with Unsupported.
+        """
+        with self.assertRaises(Unsupported):
+            self.store.watch(ROOMS)
+
+    def test_backend_missing_operation(self):
+        """
+        Post-condition 1: a backend that leaves out an operation can't be
+        created.
+        """
+        class Partial(Backend):
+            def fetch_doc(self, collect_nm, filters, projection=None):
+                return None
+
+        with self.assertRaises(TypeError):
+            Partial()
@@ -0,0 +1,112 @@
+"""
+This file holds the tests for mongo_port.py.
+"""
+
+from unittest import TestCase
+import io
+import json
+
+import db.db_connect as db_connect
+from db import mongo_port
+
+COLLECTION = "port_test"
+KEY = "name"
+ENTITIES = {f"entity {i}": {"num": i, "tags": ["a", "b"]} for i in range(50)}
+
+
+def quiet(line):
+    pass
+
+
+class MongoPortTestCase(TestCase):
+    def setUp(self):
+        db_connect.delete_docs(COLLECTION)
+        db_connect.create_index(COLLECTION, KEY, unique=True)
+
+    def tearDown(self):
+        db_connect.delete_docs(COLLECTION)
+
+    def test_iter_entities(self):
+        """
+        Post-condition 1: small chunks parse the same as the whole file.
+        """
+        text = json.dumps(ENTITIES, indent=4)
+        for chunk_size in (1, 7, 1000):
+            parsed = dict(mongo_port.iter_entities(io.StringIO(text),
+                                                   chunk_size))
+            self.assertEqual(parsed, ENTITIES)
+        self.assertEqual(list(mongo_port.iter_entities(io.StringIO("{ }"))),
+                         [])
+
+    def test_iter_entities_bad_file(self):
+        """
+        Post-condition 1: a file that isn't a JSON object is an error.
+        """
+        for text in ('[1, 2]', '{"a": {}', '{"a": {},}'):
+            with self.assertRaises(ValueError):
+                list(mongo_port.iter_entities(io.StringIO(text), 4))
+
+    def test_load(self):
+        """
+        Post-condition 1: every entity is written, across batches and
+        writers.
+        Post-condition 2: loading again finds only duplicates.
+        """
+        stats = mongo_port.load(db_connect, COLLECTION, KEY,
+                                ENTITIES.items(), batch_size=7, writers=3,
+                                report=quiet)
+        self.assertEqual(stats["written"], len(ENTITIES))
+        doc = db_connect.fetch_doc(COLLECTION, {KEY: "entity 3"})
+        self.assertEqual(doc["num"], 3)
+        stats = mongo_port.load(db_connect, COLLECTION, KEY,
+                                ENTITIES.items(), report=quiet)
+        self.assertEqual(stats["duplicates"], len(ENTITIES))
+
+    def test_load_resume(self):
+        """
+        Post-condition 1: skipped entities are not written.
+        """
+        stats = mongo_port.load(db_connect, COLLECTION, KEY,
+                                ENTITIES.items(), skip=40, report=quiet)
+        self.assertEqual(stats["read"], len(ENTITIES))
+        self.assertEqual(stats["written"], 10)
+        self.assertIsNone(db_connect.fetch_doc(COLLECTION,
+                                               {KEY: "entity 0"}))
+
+    def test_load_failed_batch(self):
+        """
+        Post-condition 1: the offset reported when a batch fails is the
+        end of the batches written before it, whatever later batches
+        were written.
+        Post-condition 2: resuming from it loads every entity.
+        """
+        class FailingDB:
+            def insert_docs(self, collect_nm, docs, ordered=True):
+                if docs[0][KEY] == "entity 20":
+                    raise ConnectionError("lost the server")
+                return db_connect.insert_docs(collect_nm, docs, ordered)
+
+        reports = []
+        with self.assertRaises(ConnectionError):
+            mongo_port.load(FailingDB(), COLLECTION, KEY, ENTITIES.items(),
+                            batch_size=10, writers=3, report=reports.append)
+        offset = int(reports[-1].split()[1].rstrip(":"))
+        self.assertEqual(offset, 20)
+        mongo_port.load(db_connect, COLLECTION, KEY, ENTITIES.items(),
+                        skip=offset, report=quiet)
+        self.assertEqual(len(db_connect.fetch_docs(COLLECTION)),
+                         len(ENTITIES))
+
+    def test_load_upsert(self):
+        """
+        Post-condition 1: upserts replace stored entities.
+        """
+        mongo_port.load(db_connect, COLLECTION, KEY, ENTITIES.items(),
+                        report=quiet)
+        changed = {"entity 1": {"num": 100}}
+        mongo_port.load(db_connect, COLLECTION, KEY, changed.items(),
+                        upsert=True, report=quiet)
+        docs = db_connect.fetch_docs(COLLECTION, {KEY: "entity 1"})
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]["num"], 100)
+        self.assertNotIn("tags", docs[0])
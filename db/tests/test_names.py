@@ -0,0 +1,61 @@
+"""
+This file holds the tests for names.py.
+"""
+
+from unittest import TestCase
+import os
+import tempfile
+
+from db import names
+
+
+class NamesTestCase(TestCase):
+    def tearDown(self):
+        names.forget("room a")
+
+    def test_corpus(self):
+        """
+        Post-condition 1: the corpus is loaded once, without duplicates.
+        Post-condition 2: our preset names are part of it.
+        """
+        corpus = names.load()
+        self.assertIs(names.load(), corpus)
+        self.assertEqual(len(set(corpus)), len(corpus))
+        self.assertTrue(names.is_name("Crow"))
+        self.assertFalse(names.is_name("not a name at all"))
+
+    def test_allocate_unique_per_room(self):
+        """
+        Post-condition 1: a room never gets the same name twice.
+        Post-condition 2: a room runs out once every name is taken.
+        """
+        taken = [names.allocate("room a") for _ in names.load()]
+        self.assertEqual(len(set(taken)), len(names.load()))
+        self.assertIsNone(names.allocate("room a"))
+
+    def test_release(self):
+        """
+        Post-condition 1: a released name can be handed out again.
+        Post-condition 2: releasing twice doesn't duplicate it.
+        """
+        for _ in names.load():
+            names.allocate("room a")
+        names.release("room a", "Crow")
+        names.release("room a", "Crow")
+        self.assertEqual(names.allocate("room a"), "Crow")
+        self.assertIsNone(names.allocate("room a"))
+
+    def test_load_file(self):
+        """
+        Post-condition 1: another corpus can be loaded from a file.
+        """
+        corpus = names.load()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "names.txt")
+            with open(path, "w") as file:
+                file.write("Ann\nBob\n\nAnn\n")
+            try:
+                self.assertEqual(names.load(path), ("Ann", "Bob"))
+            finally:
+                names.load(names.NAMES_FILE)
+        self.assertEqual(names.load(), corpus)
@@ -0,0 +1,168 @@
+"""
+This file records the database operations db_connect makes, so we can
+see what a request costs and catch full scans and N+1 queries in tests:
+    with trace.budget(max_ops=1, max_scanned=1):
+        db.get_room_code("AI")
+Besides the documents an operation returns or changes, we record the
+documents the database examined for it, which is what gives a full scan
+away. The in-memory backend counts those as it goes; for Mongo they are
+read from an explain of the operation's filter, and only while a budget
+on them is running, as that costs another round-trip.
+Traces nest: an operation is recorded in every trace that is running.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+current = contextvars.ContextVar("db_trace", default=None)
+# documents examined by the operation in progress, if the backend counts
+# them:
+scanned = contextvars.ContextVar("db_scanned", default=None)
+# returns the documents examined for a filter, for backends that don't
+# count them as they go; db_connect sets it:
+explain = None
+
+# called with every operation, traced or not (e.g. to collect metrics):
+listeners = []
+
+
+class Trace:
+    """
+    The database operations made while the trace was running.
+    Each operation is a dict with its collection, operation name, filter
+    shape, number of documents returned or changed, number of documents
+    examined, and duration.
+    """
+    def __init__(self, parent=None, explains=False):
+        self.parent = parent
+        self.ops = []
+        # whether to ask the database what it examined:
+        self.explains = explains
+
+    @property
+    def num_ops(self):
+        return len(self.ops)
+
+    @property
+    def num_docs(self):
+        return sum(op["docs"] for op in self.ops)
+
+    @property
+    def num_scanned(self):
+        return sum(op["scanned"] for op in self.ops)
+
+    @property
+    def duration_ms(self):
+        return sum(op["ms"] for op in self.ops)
+
+    def describe(self):
+        """
+        Returns one line per operation, for error messages and logs.
+        """
+        return "\n".join(f"  {op['collection']}.{op['operation']}"
+                         + f" {op['filter']} -> {op['docs']} docs,"
+                         + f" {op['scanned']} examined"
+                         + f" in {op['ms']:.2f}ms"
+                         for op in self.ops)
+
+
+def start(explains = False):
+    """
+    Starts recording operations made in this context.
+    """
+    trace = Trace(current.get(), explains)
+    current.set(trace)
+    return trace
+
+
+def stop(trace):
+    """
+    Stops recording into trace and returns it.
+    """
+    current.set(trace.parent)
+    return trace
+
+
+def filter_shape(filters):
+    """
+    Returns filters with their values replaced by type names, so that
+    traces show how we query without holding user data.
+    """
+    if isinstance(filters, dict):
+        return {key: filter_shape(value) for key, value in filters.items()}
+    if isinstance(filters, list):
+        return [filter_shape(value) for value in filters[:1]]
+    return type(filters).__name__
+
+
+def add_scanned(num_docs):
+    """
+    Called by backends to report the documents they examined for the
+    operation in progress.
+    """
+    scanned.set((scanned.get() or 0) + num_docs)
+
+
+def _explains(trace):
+    while trace is not None:
+        if trace.explains:
+            return True
+        trace = trace.parent
+    return False
+
+
+def record(collect_nm, operation, filters, docs, started):
+    """
+    Records one operation that began at perf_counter() time started.
+    If the backend didn't count the documents it examined, they are
+    asked for when a trace needs them, and otherwise taken to be docs.
+    """
+    num_scanned = scanned.get()
+    if num_scanned is not None:
+        scanned.set(None)
+    trace = current.get()
+    if trace is None and not listeners:
+        return
+    elapsed = time.perf_counter() - started
+    if (num_scanned is None and filters and explain is not None
+            and _explains(trace)):
+        num_scanned = explain(collect_nm, filters)
+    entry = {
+        "collection": collect_nm,
+        "operation": operation,
+        "filter": filter_shape(filters) if trace is not None else None,
+        "docs": docs,
+        "scanned": docs if num_scanned is None else num_scanned,
+        "ms": elapsed * 1000,
+    }
+    while trace is not None:
+        trace.ops.append(entry)
+        trace = trace.parent
+    for listener in listeners:
+        listener(entry)
+
+
+@contextmanager
+def budget(max_ops=None, max_docs=None, max_scanned=None):
+    """
+    Fails with an AssertionError if the code in the with block makes more
+    than max_ops database operations, has more than max_docs documents
+    returned or changed, or has the database examine more than
+    max_scanned documents.
+    """
+    trace = start(explains=max_scanned is not None)
+    try:
+        yield trace
+    finally:
+        stop(trace)
+    if max_ops is not None and trace.num_ops > max_ops:
+        raise AssertionError(f"{trace.num_ops} database operations;"
+                             + f" budget is {max_ops}:\n{trace.describe()}")
+    if max_docs is not None and trace.num_docs > max_docs:
+        raise AssertionError(f"{trace.num_docs} documents touched;"
+                             + f" budget is {max_docs}:\n{trace.describe()}")
+    if max_scanned is not None and trace.num_scanned > max_scanned:
+        raise AssertionError(f"{trace.num_scanned} documents examined;"
+                             + f" budget is {max_scanned}:\n"
+                             + trace.describe())
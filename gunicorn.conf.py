@@ -0,0 +1,23 @@
+"""
+Gunicorn settings for serving the Flask app alone:
+    gunicorn -c gunicorn.conf.py API.endpoints:app
+Each open event stream holds one of a worker's WEB_THREADS, so the
+Procfile serves web traffic from API/asgi.py instead.
+Each worker gets ready to serve as soon as it is forked, before it takes
+requests: it connects, creates our indexes, loads the name corpus and
+joins the event broker. Importing the app does none of that, so a worker
+comes up quickly; its readiness is at /ready, its liveness at /hello.
+"""
+
+import os
+
+threads = int(os.environ.get("WEB_THREADS", 16))
+
+
+def post_fork(server, worker):
+    from API import endpoints
+    try:
+        endpoints.start_worker()
+    except Exception as err:
+        # /ready and the worker's first requests will try again.
+        worker.log.warning(f"Worker {worker.pid} not ready: {err}")